@@ -25,4 +25,13 @@ class RateLimitError(LLMError):
 
 class TokenLimitError(LLMError):
     """トークン制限エラー"""
-    pass
\ No newline at end of file
+    pass
+
+class LLMTimeoutError(LLMError):
+    """LLM API の応答が期限内に返らなかった場合のエラー"""
+    pass
+
+
+class CircuitOpenError(LLMError):
+    """サーキットブレーカーが開いていて呼び出しを行わなかった場合のエラー"""
+    pass
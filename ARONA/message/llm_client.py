@@ -0,0 +1,243 @@
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+import openai
+
+from ARONA.message.error.errors import CircuitOpenError, LLMError, LLMTimeoutError
+
+
+class CircuitBreaker:
+    """連続失敗が閾値を超えたら一定時間呼び出しを遮断するサーキットブレーカー"""
+
+    def __init__(self, failure_threshold: int = 3, reset_seconds: float = 60):
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._trial_in_flight:
+            # 復旧確認のため1件だけ通す
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """成功・失敗が決まらずに終わった試行 (キャンセルや読み込みの中断) の後、次の1件を通せるようにする"""
+        self._trial_in_flight = False
+
+
+class ResilientLLMClient:
+    """タイムアウト・サーキットブレーカー・ヘッジリクエスト付きの OpenAI互換クライアント
+
+    プライマリが hedge_delay 秒以内に応答しない場合はセカンダリにも同じリクエストを送り、
+    先に成功した方を採用する。全体は timeout 秒で打ち切る。
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        secondary_base_url: Optional[str] = None,
+        timeout: float = 20,
+        hedge_delay: float = 5,
+        failure_threshold: int = 3,
+        reset_seconds: float = 60,
+    ):
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        # リトライはこのクラスで扱うので SDK 側の自動リトライは無効にする
+        self.primary = self._build_client(api_key, base_url)
+        self.secondary = self._build_client(api_key, secondary_base_url) if secondary_base_url else None
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self.latencies: deque[float] = deque(maxlen=200)
+        self.counters = {
+            'requests': 0,
+            'successes': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'short_circuits': 0,
+            'hedges': 0,
+            'hedge_wins': 0,
+        }
+
+    def _build_client(self, api_key: str, base_url: Optional[str]) -> openai.AsyncOpenAI:
+        if base_url:
+            return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=self.timeout, max_retries=0)
+        return openai.AsyncOpenAI(api_key=api_key, timeout=self.timeout, max_retries=0)
+
+    def _before_request(self) -> bool:
+        """呼び出しを許可するか判定し、復旧確認の試行として通した場合は True を返す"""
+        self.counters['requests'] += 1
+        trial = self.breaker.state == 'half_open'
+        if not self.breaker.allow():
+            self.counters['short_circuits'] += 1
+            raise CircuitOpenError('LLM API が連続して失敗しているため一時的に呼び出しを停止しています')
+        return trial
+
+    def _record_success(self, started: float):
+        self.latencies.append(time.monotonic() - started)
+        self.counters['successes'] += 1
+        self.breaker.record_success()
+
+    def _record_failure(self, timed_out: bool = False):
+        self.counters['failures'] += 1
+        if timed_out:
+            self.counters['timeouts'] += 1
+        self.breaker.record_failure()
+
+    async def create(self, **kwargs):
+        """chat.completions.create の代わりに呼び出す (stream=True も可)"""
+        trial = self._before_request()
+        if kwargs.get('stream'):
+            return await self._create_stream(trial, **kwargs)
+
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(self._hedged_create(kwargs), timeout=self.timeout)
+        except asyncio.CancelledError:
+            if trial:
+                self.breaker.release_trial()
+            raise
+        except (asyncio.TimeoutError, openai.APITimeoutError):
+            # SDK 側のタイムアウト (APITimeoutError) もタイムアウトとして数える
+            self._record_failure(timed_out=True)
+            raise LLMTimeoutError(f'LLM API が {self.timeout:g} 秒以内に応答しませんでした')
+        except openai.APIError as e:
+            self._record_failure()
+            raise LLMError(f'API エラー: {str(e)}')
+        except Exception as e:
+            self._record_failure()
+            raise LLMError(f'メッセージ生成エラー: {str(e)}')
+        self._record_success(started)
+        return response
+
+    async def _hedged_create(self, kwargs: dict):
+        primary = asyncio.create_task(self.primary.chat.completions.create(**kwargs))
+        if self.secondary is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+        if done and primary.exception() is None:
+            return primary.result()
+
+        # 遅延または失敗したのでセカンダリにも送る
+        self.counters['hedges'] += 1
+        secondary = asyncio.create_task(self.secondary.chat.completions.create(**kwargs))
+        pending = {secondary} if done else {primary, secondary}
+        last_error: Optional[BaseException] = primary.exception() if done else None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is secondary:
+                            self.counters['hedge_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in (primary, secondary):
+                if not task.done():
+                    task.cancel()
+
+    async def _create_stream(self, trial: bool, **kwargs):
+        started = time.monotonic()
+        try:
+            stream = await asyncio.wait_for(self.primary.chat.completions.create(**kwargs), timeout=self.timeout)
+        except asyncio.CancelledError:
+            if trial:
+                self.breaker.release_trial()
+            raise
+        except (asyncio.TimeoutError, openai.APITimeoutError):
+            # SDK 側のタイムアウト (APITimeoutError) もタイムアウトとして数える
+            self._record_failure(timed_out=True)
+            raise LLMTimeoutError(f'LLM API が {self.timeout:g} 秒以内に応答しませんでした')
+        except Exception as e:
+            self._record_failure()
+            raise LLMError(f'メッセージ生成エラー: {str(e)}')
+        return self._guard_stream(stream, started, trial)
+
+    async def _guard_stream(self, stream, started: float, trial: bool = False):
+        """チャンク間の待ち時間と全体の所要時間に期限を設けてストリームを中継する"""
+        deadline = started + self.timeout
+        iterator = stream.__aiter__()
+        finished = False
+        completed = False
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError
+                    chunk = await asyncio.wait_for(iterator.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    completed = True
+                    break
+                except (asyncio.TimeoutError, openai.APITimeoutError):
+                    finished = True
+                    self._record_failure(timed_out=True)
+                    raise LLMTimeoutError(f'LLM API のストリームが {self.timeout:g} 秒以内に完了しませんでした')
+                except Exception as e:
+                    finished = True
+                    self._record_failure()
+                    raise LLMError(f'メッセージ生成エラー: {str(e)}')
+                yield chunk
+            finished = True
+            self._record_success(started)
+        finally:
+            # 呼び出し側が途中で読むのをやめた (aclose / GeneratorExit) 場合やキャンセルされた場合
+            if not finished and trial:
+                self.breaker.release_trial()
+            if not completed:
+                # 最後まで読まなかったストリームは HTTP 接続を解放するため明示的に閉じる
+                await self._close_stream(stream)
+
+    @staticmethod
+    async def _close_stream(stream):
+        close = getattr(stream, 'close', None)
+        try:
+            if close is not None:
+                await close()
+        except Exception:
+            pass
+
+    def metrics(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+        return {
+            **self.counters,
+            'circuit': self.breaker.state,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+        }
@@ -1,8 +1,16 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict, deque
+
 import discord
 from discord.ext import commands
 import openai
 import yaml
+from typing import Optional
 from ARONA.message.error.errors import LLMError, ConfigError
+from ARONA.message.llm_client import ResilientLLMClient
+from ARONA.moderation.raid_mode import get_join_tracker
 
 
 class LLMCog(commands.Cog):
@@ -14,17 +22,26 @@ class LLMCog(commands.Cog):
         api_key = self.config.get('openai_api_key')
         base_url = self.config.get('openai_base_url')  # 互換API用のベースURL
 
+        secondary_base_url = self.config.get('openai_secondary_base_url')  # 遅延時のヘッジ先
+
+        # タイムアウト・サーキットブレーカー・ヘッジ付きのクライアント
+        self.llm = ResilientLLMClient(
+            api_key=api_key,
+            base_url=base_url,
+            secondary_base_url=secondary_base_url,
+            timeout=float(self.config.get('llm_timeout_seconds', 20)),
+            hedge_delay=float(self.config.get('llm_hedge_delay_seconds', 5)),
+            failure_threshold=int(self.config.get('llm_circuit_failure_threshold', 3)),
+            reset_seconds=float(self.config.get('llm_circuit_reset_seconds', 60)),
+        )
         if base_url:
             # カスタムベースURLを使用（OpenAI互換API）
-            self.client = openai.AsyncOpenAI(
-                api_key=api_key,
-                base_url=base_url
-            )
             print(f'🔗 カスタムAPI: {base_url}')
         else:
             # 通常のOpenAI API
-            self.client = openai.AsyncOpenAI(api_key=api_key)
             print(f'🔗 OpenAI API を使用')
+        if secondary_base_url:
+            print(f'🔗 セカンダリAPI: {secondary_base_url}')
 
         self.system_prompt = self.config.get('system_prompt', '')
         self.model = self.config.get('model', 'gpt-4-turbo-preview')
@@ -39,6 +56,43 @@ class LLMCog(commands.Cog):
             except (TypeError, ValueError):
                 pass
 
+        # 事前生成プール: ギルドごとに {member} プレースホルダー付きのテンプレートを保持
+        # (参加があったギルドだけ補充し、期限切れやサーバー名・メンバー数の区分が変わったものは使わない)
+        self.pool_size = max(int(self.config.get('welcome_pool_size', 3)), 0)
+        self.pool_ttl_seconds = float(self.config.get('welcome_pool_ttl_seconds', 3600))
+        self.welcome_pools: dict[int, deque[tuple[float, tuple, str]]] = {}  # (期限, キャッシュキー, テンプレート)
+        self._refill_tasks: dict[int, asyncio.Task] = {}
+        # LLM呼び出しの同時実行数制限
+        self.llm_semaphore = asyncio.Semaphore(max(int(self.config.get('welcome_max_concurrency', 2)), 1))
+        # 短時間の連続参加をまとめて1通にする待機秒数 (0で無効)
+        self.coalesce_seconds = float(self.config.get('welcome_coalesce_seconds', 5))
+        self.max_mentions_per_message = 20
+        self._pending_joins: dict[int, list[discord.Member]] = {}
+        self._flush_tasks: dict[int, asyncio.Task] = {}
+        # 参加レートの追跡は Anti-nuke と共有する
+        raid_settings = (self.config.get('anti_nuke') or {}).get('raid_mode') or {}
+        self.raid_mode_enabled = bool(raid_settings.get('enabled', True))
+        self.join_tracker = get_join_tracker(bot, raid_settings)
+        self.raid_batch_seconds = 30
+        # 解決済みのようこそチャンネル (チャンネル・ロール・Botの権限の変更イベントで破棄)
+        self._welcome_channel_cache: dict[int, list] = {}
+        # ギルドごとの同時送信数制限
+        self.send_concurrency = max(int(self.config.get('welcome_send_concurrency', 3)), 1)
+        self._send_semaphores: dict[int, asyncio.Semaphore] = {}
+        # 生成結果のキャッシュ: (ギルドID, プロンプトのハッシュ, メンバー数の区分) → (期限, テンプレート)
+        self.cache_ttl_seconds = float(self.config.get('welcome_cache_ttl_seconds', 600))
+        self.cache_max_entries = 256
+        self.member_count_bucket = 100
+        self._response_cache: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+        # ストリーミング: プレースホルダーを先に送り、生成途中の内容で編集していく
+        self.streaming_enabled = bool(self.config.get('welcome_streaming', False))
+        self.stream_edit_interval = float(self.config.get('welcome_stream_edit_interval', 1.5))
+        # ストリーミング時の表示までの秒数 (llm_status で表示)
+        self.stream_latencies: dict[str, deque[float]] = {
+            'placeholder': deque(maxlen=200),
+            'first_text': deque(maxlen=200),
+        }
+
     def _load_config(self):
         """config.yamlから設定を読み込む"""
         try:
@@ -61,6 +115,14 @@ class LLMCog(commands.Cog):
         print(f'👋 ようこそメッセージ: 有効')
         if self.welcome_channel_ids:
             print(f'📍 ようこそチャンネルIDs: {sorted(self.welcome_channel_ids)}')
+        if self.pool_size:
+            # 起動時には生成せず、参加があったサーバーから補充する
+            print(f'📦 ようこそテンプレートの事前生成: {self.pool_size} 件/サーバー')
+
+    def cog_unload(self):
+        for task in (*self._refill_tasks.values(), *self._flush_tasks.values()):
+            if not task.done():
+                task.cancel()
 
     def _to_int_set(self, values) -> set[int]:
         result = set()
@@ -74,7 +136,17 @@ class LLMCog(commands.Cog):
         return result
 
     def _get_welcome_channels(self, guild: discord.Guild):
-        """ようこそメッセージを送信するチャンネルをリストで取得"""
+        """ようこそメッセージを送信するチャンネルをリストで取得 (ギルドごとにキャッシュ)"""
+        cached = self._welcome_channel_cache.get(guild.id)
+        if cached is not None:
+            return cached
+        channels = self._resolve_welcome_channels(guild)
+        # 送信先がない場合は権限が付与されたときにすぐ使えるよう、キャッシュせず毎回解決する
+        if channels:
+            self._welcome_channel_cache[guild.id] = channels
+        return channels
+
+    def _resolve_welcome_channels(self, guild: discord.Guild):
         channels = []
         # 1. config.yamlで指定されたチャンネルIDを優先
         for cid in self.welcome_channel_ids:
@@ -97,6 +169,101 @@ class LLMCog(commands.Cog):
                 channels.append(channel)
         return channels
 
+    def _invalidate_welcome_channels(self, guild: discord.Guild):
+        self._welcome_channel_cache.pop(guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        self._invalidate_welcome_channels(channel.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self._invalidate_welcome_channels(channel.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        self._invalidate_welcome_channels(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        # システムチャンネルの変更に追従する
+        self._invalidate_welcome_channels(after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        # Botのロールや@everyoneの権限が変わると送信できるチャンネルも変わる
+        me = after.guild.me
+        if after.is_default() or (me is not None and after in me.roles):
+            self._invalidate_welcome_channels(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self._invalidate_welcome_channels(role.guild)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        # Bot自身のロールが付け外しされた場合
+        if after.id == self.bot.user.id and before.roles != after.roles:
+            self._invalidate_welcome_channels(after.guild)
+
+    @commands.command(name='llm_status')
+    @commands.has_permissions(administrator=True)
+    async def llm_status(self, ctx: commands.Context):
+        """LLM API の呼び出し状況を表示します"""
+        metrics = self.llm.metrics()
+
+        def ms(value):
+            return f'{value * 1000:.0f} ms' if value is not None else 'N/A'
+
+        def p50(samples):
+            return sorted(samples)[len(samples) // 2] if samples else None
+
+        lines = [
+            f'サーキット: `{metrics["circuit"]}`',
+            f'リクエスト: {metrics["requests"]} (成功 {metrics["successes"]} / 失敗 {metrics["failures"]} / '
+            f'タイムアウト {metrics["timeouts"]} / 遮断 {metrics["short_circuits"]})',
+            f'ヘッジ: {metrics["hedges"]} 回 (セカンダリ採用 {metrics["hedge_wins"]} 回)',
+            f'レイテンシ: p50 {ms(metrics["latency_p50"])} / p95 {ms(metrics["latency_p95"])}',
+        ]
+        if self.streaming_enabled:
+            lines.append(
+                f'ストリーミング: 仮メッセージ表示 p50 {ms(p50(self.stream_latencies["placeholder"]))} / '
+                f'最初の生成テキスト p50 {ms(p50(self.stream_latencies["first_text"]))}'
+            )
+        await ctx.send('\n'.join(lines))
+
+    async def _send_to_channels(
+        self,
+        guild: discord.Guild,
+        channels: list,
+        content: str,
+        allowed_mentions: discord.AllowedMentions,
+    ) -> list[discord.Message]:
+        """複数チャンネルへ並行して送信し、送信できたメッセージを返す"""
+        semaphore = self._send_semaphores.setdefault(guild.id, asyncio.Semaphore(self.send_concurrency))
+
+        async def send(channel):
+            async with semaphore:
+                print(f'📍 送信先チャンネル: #{channel.name} (ID: {channel.id})')
+                return await channel.send(content, allowed_mentions=allowed_mentions)
+
+        results = await asyncio.gather(*(send(ch) for ch in channels), return_exceptions=True)
+        sent = []
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                print(f'❌ #{channel.name} への送信に失敗しました: {result}')
+                if isinstance(result, (discord.Forbidden, discord.NotFound)):
+                    self._invalidate_welcome_channels(guild)
+            else:
+                sent.append(result)
+        return sent
+
+    async def _edit_messages(self, messages: list[discord.Message], content: str):
+        results = await asyncio.gather(*(m.edit(content=content) for m in messages), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f'⚠️ ようこそメッセージの編集に失敗しました: {result}')
+
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         """新しいメンバーが参加したときの処理"""
@@ -104,62 +271,258 @@ class LLMCog(commands.Cog):
         if member.bot:
             return
 
+        guild_id = member.guild.id
+        if self.raid_mode_enabled and self.join_tracker.record_member_join(member):
+            # レイドモード中はLLMを使わず、まとめて1通だけ送る
+            self._pending_joins.setdefault(guild_id, []).append(member)
+            task = self._flush_tasks.get(guild_id)
+            if task is None or task.done():
+                self._flush_tasks[guild_id] = asyncio.create_task(self._flush_pending_joins(member.guild))
+            return
+
+        if self.coalesce_seconds > 0:
+            # 直前の歓迎から一定時間内の参加はまとめて1通で歓迎する
+            task = self._flush_tasks.get(guild_id)
+            if task is not None and not task.done():
+                self._pending_joins.setdefault(guild_id, []).append(member)
+                return
+            self._flush_tasks[guild_id] = asyncio.create_task(self._flush_pending_joins(member.guild))
+
+        await self._welcome_members(member.guild, [member])
+
+    async def _flush_pending_joins(self, guild: discord.Guild):
+        """まとめ待ちの参加者を一定間隔ごとに1通で歓迎する"""
+        while True:
+            raid = self.join_tracker.is_raid(guild.id)
+            await asyncio.sleep(self.raid_batch_seconds if raid else self.coalesce_seconds)
+            members = self._pending_joins.pop(guild.id, [])
+            if not members:
+                return
+            await self._welcome_members(guild, members, use_llm=not self.join_tracker.is_raid(guild.id))
+
+    async def _welcome_members(self, guild: discord.Guild, members: list[discord.Member], use_llm: bool = True):
+        """1人または複数人の参加者にまとめてようこそメッセージを送信"""
         # 送信先チャンネルを決定
-        welcome_channels = self._get_welcome_channels(member.guild)
+        welcome_channels = self._get_welcome_channels(guild)
 
         if not welcome_channels:
-            print(f'⚠️ {member.guild.name} にメッセージを送信できるチャンネルがありません')
+            print(f'⚠️ {guild.name} にメッセージを送信できるチャンネルがありません')
+            return
+
+        shown = members[:self.max_mentions_per_message]
+        mentions = ' '.join(m.mention for m in shown)
+        if len(members) > len(shown):
+            mentions += f' ほか {len(members) - len(shown)} 名'
+        allowed_mentions = discord.AllowedMentions(users=shown)
+
+        if not use_llm:
+            await self._send_to_channels(
+                guild,
+                welcome_channels,
+                f'{mentions} さん、ようこそ {guild.name} へ！👋 ({len(members)} 人)',
+                allowed_mentions,
+            )
+            print(f'🛡️ レイドモード中のため {len(members)} 人へまとめてようこそメッセージを送信しました')
             return
 
         try:
-            # ようこそメッセージを生成
-            welcome_message = await self._generate_welcome_message(member)
+            # プールかキャッシュにあれば即座に使い、なければ生成する
+            template = self._take_ready_template(guild)
+            if template is None and self.streaming_enabled:
+                await self._stream_welcome_message(guild, welcome_channels, shown, mentions, allowed_mentions)
+                return
+            if template is None:
+                template = await self._generate_welcome_template(guild)
+            welcome_message = self._render_welcome_template(template, shown)
 
-            # 各チャンネルに送信
-            for channel in welcome_channels:
-                print(f'📍 送信先チャンネル: #{channel.name} (ID: {channel.id})')
-                await channel.send(
-                    f'{member.mention} さん、ようこそ！🎉\n\n{welcome_message}',
-                    allowed_mentions=discord.AllowedMentions(users=[member])
-                )
+            # 各チャンネルに並行して送信
+            sent = await self._send_to_channels(
+                guild,
+                welcome_channels,
+                f'{mentions} さん、ようこそ！🎉\n\n{welcome_message}',
+                allowed_mentions,
+            )
 
-            print(f'✅ {member.display_name} へのようこそメッセージを {len(welcome_channels)} チャンネルに送信しました')
+            print(f'✅ {len(members)} 人へのようこそメッセージを {len(sent)} チャンネルに送信しました')
 
         except LLMError as e:
             print(f'❌ ようこそメッセージの生成エラー: {e}')
             # エラー時はシンプルなメッセージを送信
-            for channel in welcome_channels:
-                await channel.send(
-                    f'{member.mention} さん、ようこそ {member.guild.name} へ！👋',
-                    allowed_mentions=discord.AllowedMentions(users=[member])
-                )
+            await self._send_to_channels(
+                guild,
+                welcome_channels,
+                f'{mentions} さん、ようこそ {guild.name} へ！👋',
+                allowed_mentions,
+            )
         except Exception as e:
             print(f'❌ 予期しないエラー: {e}')
 
-    async def _generate_welcome_message(self, member: discord.Member) -> str:
-        """OpenAI互換APIを使ってようこそメッセージを生成"""
-        try:
-            # サーバー情報をコンテキストに追加
-            guild_context = f"""
-サーバー名: {member.guild.name}
-メンバー数: {member.guild.member_count}
-新規参加者: {member.display_name}
+    @staticmethod
+    def _render_welcome_template(template: str, members: list[discord.Member]) -> str:
+        names = '、'.join(m.display_name for m in members)
+        # LLMの出力には波括弧が含まれうるので format ではなく置換で埋め込む
+        return template.replace('{member}', names)
+
+    def _take_ready_template(self, guild: discord.Guild) -> Optional[str]:
+        """プール、次いでキャッシュからすぐに使えるテンプレートを取り出す"""
+        pool = self.welcome_pools.get(guild.id)
+        template = None
+        if pool:
+            key, now = self._cache_key(guild), time.monotonic()
+            while pool:
+                expires_at, pooled_key, pooled = pool.popleft()
+                if expires_at > now and pooled_key == key:
+                    template = pooled
+                    break
+        self._schedule_refill(guild)
+        return template if template is not None else self._get_cached_template(guild)
+
+    def _build_welcome_prompt(self, guild: discord.Guild) -> list[dict]:
+        # サーバー情報をコンテキストに追加
+        guild_context = f"""
+サーバー名: {guild.name}
+メンバー数: {guild.member_count}
+新規参加者: {{member}}
+(新規参加者の名前は必ず {{member}} とそのまま書いてください)
 """
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": guild_context}
+        ]
 
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": guild_context}
-            ]
+    def _cache_key(self, guild: discord.Guild) -> tuple:
+        # メンバー数そのものはプロンプトから除き、区分としてキーに含める
+        prompt = f'{self.model}\n{self.system_prompt}\n{guild.name}'
+        prompt_hash = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        return guild.id, prompt_hash, (guild.member_count or 0) // self.member_count_bucket
 
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature
-            )
+    def _get_cached_template(self, guild: discord.Guild) -> Optional[str]:
+        if self.cache_ttl_seconds <= 0:
+            return None
+        key = self._cache_key(guild)
+        entry = self._response_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, template = entry
+        if expires_at <= time.monotonic():
+            del self._response_cache[key]
+            return None
+        self._response_cache.move_to_end(key)
+        return template
+
+    def _store_cached_template(self, guild: discord.Guild, template: str):
+        if self.cache_ttl_seconds <= 0:
+            return
+        now = time.monotonic()
+        self._response_cache[self._cache_key(guild)] = (now + self.cache_ttl_seconds, template)
+        self._response_cache.move_to_end(self._cache_key(guild))
+        # 期限切れと上限超過分を古い順に破棄
+        while self._response_cache:
+            oldest_key, (expires_at, _) = next(iter(self._response_cache.items()))
+            if expires_at > now and len(self._response_cache) <= self.cache_max_entries:
+                break
+            del self._response_cache[oldest_key]
+
+    async def _stream_welcome_message(
+        self,
+        guild: discord.Guild,
+        channels: list,
+        members: list[discord.Member],
+        mentions: str,
+        allowed_mentions: discord.AllowedMentions,
+    ):
+        """プレースホルダーを即座に送信し、生成中の内容で一定間隔ごとに編集する"""
+        started = time.monotonic()
+        header = f'{mentions} さん、ようこそ！🎉\n\n'
+        messages = await self._send_to_channels(guild, channels, f'{header}✍️ ...', allowed_mentions)
+        if not messages:
+            return
+        self.stream_latencies['placeholder'].append(time.monotonic() - started)
+
+        parts: list[str] = []
+        first_text_logged = False
+        last_edit = time.monotonic()
+        try:
+            async with self.llm_semaphore:
+                stream = await self.llm.create(
+                    model=self.model,
+                    messages=self._build_welcome_prompt(guild),
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if not delta:
+                        continue
+                    parts.append(delta)
+                    # 編集はレート制限に収まるよう間引く
+                    if time.monotonic() - last_edit < self.stream_edit_interval:
+                        continue
+                    partial = ''.join(parts)
+                    # 途中で切れたプレースホルダーは表示しない
+                    brace = partial.rfind('{')
+                    if brace != -1 and '}' not in partial[brace:]:
+                        partial = partial[:brace]
+                    await self._edit_messages(
+                        messages, f'{header}{self._render_welcome_template(partial, members)} ✍️'
+                    )
+                    last_edit = time.monotonic()
+                    if not first_text_logged:
+                        first_text_logged = True
+                        self.stream_latencies['first_text'].append(last_edit - started)
+        except Exception as e:
+            print(f'❌ ようこそメッセージのストリーミング生成エラー: {e}')
+            await self._edit_messages(messages, f'{mentions} さん、ようこそ {guild.name} へ！👋')
+            return
+
+        template = ''.join(parts).strip()
+        if not template:
+            await self._edit_messages(messages, f'{mentions} さん、ようこそ {guild.name} へ！👋')
+            return
+        self._store_cached_template(guild, template)
+        await self._edit_messages(messages, f'{header}{self._render_welcome_template(template, members)}')
+        print(f'✅ ストリーミングで {len(messages)} チャンネルにようこそメッセージを送信しました '
+              f'({(time.monotonic() - started) * 1000:.0f} ms)')
+
+    def _schedule_refill(self, guild: discord.Guild):
+        if not self.pool_size:
+            return
+        task = self._refill_tasks.get(guild.id)
+        if task is None or task.done():
+            self._refill_tasks[guild.id] = asyncio.create_task(self._refill_pool(guild))
+
+    async def _refill_pool(self, guild: discord.Guild):
+        """バックグラウンドでテンプレートプールを補充"""
+        pool = self.welcome_pools.setdefault(guild.id, deque(maxlen=self.pool_size))
+        while len(pool) < self.pool_size:
+            key = self._cache_key(guild)
+            try:
+                template = await self._generate_welcome_template(guild)
+                pool.append((time.monotonic() + self.pool_ttl_seconds, key, template))
+            except LLMError as e:
+                print(f'⚠️ ようこそテンプレートの事前生成に失敗しました ({guild.name}): {e}')
+                return
+
+    async def _generate_welcome_template(self, guild: discord.Guild) -> str:
+        """参加者名を {member} としたようこそメッセージのテンプレートを生成"""
+        try:
+            async with self.llm_semaphore:
+                response = await self.llm.create(
+                    model=self.model,
+                    messages=self._build_welcome_prompt(guild),
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature
+                )
 
-            return response.choices[0].message.content.strip()
+            template = response.choices[0].message.content.strip()
+            self._store_cached_template(guild, template)
+            return template
 
+        except LLMError:
+            raise
         except openai.APIError as e:
             raise LLMError(f'API エラー: {str(e)}')
         except Exception as e:
@@ -7,6 +7,8 @@ import discord
 from discord.ext import commands
 import yaml
 
+from ARONA.moderation.raid_mode import account_age_days, get_join_tracker
+
 logger = logging.getLogger(__name__)
 
 
@@ -31,6 +33,8 @@ class AntiNukeCog(commands.Cog):
         self.exempt_role_ids: set[int] = set()
         self.action_thresholds = {}
         self.monitored_guild_ids: set[int] = set()
+        self.raid_settings = {}
+        self.join_tracker = get_join_tracker(bot)
         self.refresh_settings()
 
     # ------------------------------------------------------------------
@@ -54,6 +58,8 @@ class AntiNukeCog(commands.Cog):
         self.exempt_role_ids = self._to_int_set(self.settings.get('exempt_role_ids', []))
         self.action_thresholds = self.settings.get('action_thresholds', {})
         self.monitored_guild_ids = self._to_int_set(self.config.get('monitored_guilds', []))
+        self.raid_settings = self.settings.get('raid_mode') or {}
+        self.join_tracker.configure(self.raid_settings)
         self.recent_actions.clear()
 
         logger.info(
@@ -151,6 +157,28 @@ class AntiNukeCog(commands.Cog):
             note=f'ユーザーBAN: {user} ({user.id})',
         )
 
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        if not self.raid_settings.get('enabled', True):
+            return
+        # 参加レートはようこそメッセージと共有するので、監視対象外のサーバーでも同じ条件で記録する
+        is_raid = self.join_tracker.record_member_join(member)
+        guild = member.guild
+        if not self._is_enabled_for_guild(guild):
+            return
+
+        # 他のCogが先に同じ参加を記録していても、開始の通知はここで1回だけ行う
+        if is_raid and self.join_tracker.claim_raid_start(guild.id):
+            status = self.join_tracker.status(guild.id)
+            await self._log_action(
+                guild,
+                f'🚨 参加の急増を検知しました ({status["recent_joins"]} 人 / '
+                f'{self.join_tracker.window_seconds:g} 秒)。レイドモードに移行します',
+            )
+
+        if is_raid and not member.bot:
+            await self._quarantine_new_account(member)
+
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
         await self._handle_audit_action(
@@ -180,6 +208,19 @@ class AntiNukeCog(commands.Cog):
         ]
         for key, (count, window) in self._iter_thresholds():
             lines.append(f'- {key}: {count} 件 / {window} 秒')
+
+        raid_status = self.join_tracker.status(ctx.guild.id)
+        if raid_status['raid']:
+            lines.append(
+                f'レイドモード: **発動中** (参加 {raid_status["raid_joins"]} 人, '
+                f'残り {raid_status["remaining_seconds"]} 秒)'
+            )
+        else:
+            lines.append('レイドモード: 通常')
+        lines.append(
+            f'- 参加検知: {self.join_tracker.threshold} 人 / {self.join_tracker.window_seconds:g} 秒 '
+            f'(直近 {raid_status["recent_joins"]} 人)'
+        )
         await ctx.send('\n'.join(lines))
 
     def _iter_thresholds(self):
@@ -345,6 +386,33 @@ class AntiNukeCog(commands.Cog):
             if quarantine_role and bot_member.top_role > quarantine_role:
                 await member.add_roles(quarantine_role, reason='Anti-nuke quarantine')
 
+    async def _quarantine_new_account(self, member: discord.Member):
+        """レイドモード中に作成から日が浅いアカウントを隔離する"""
+        if not self.raid_settings.get('quarantine_new_accounts', False):
+            return
+        try:
+            min_age_days = float(self.raid_settings.get('min_account_age_days', 7))
+        except (TypeError, ValueError):
+            min_age_days = 7.0
+        if account_age_days(member) >= min_age_days:
+            return
+        if self._should_ignore_executor(member.guild, member.id):
+            return
+
+        quarantine_role = member.guild.get_role(self.quarantine_role_id) if self.quarantine_role_id else None
+        if quarantine_role is None:
+            logger.warning('レイドモード: quarantine_role_id が未設定のため新規アカウントを隔離できません')
+            return
+        try:
+            await member.add_roles(quarantine_role, reason='Anti-nuke raid mode: 新規アカウント')
+        except discord.Forbidden:
+            logger.warning('レイドモード: 隔離ロールを付与する権限がありません')
+            return
+        except discord.HTTPException as exc:
+            logger.warning('レイドモード: 隔離ロールの付与に失敗しました: %s', exc)
+            return
+        logger.info('レイドモード: 新規アカウント %s (%s) を隔離しました', member, member.id)
+
     async def _kick_member(
         self,
         guild: discord.Guild,
@@ -0,0 +1,143 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+import discord
+
+
+@dataclass
+class _GuildJoinWindow:
+    joins: deque = field(default_factory=deque)  # (timestamp, member_id)
+    member_ids: set = field(default_factory=set)
+    raid_until: float = 0.0
+    raid_started_at: Optional[float] = None
+    raid_join_count: int = 0
+    raid_start_reported: bool = False
+
+
+class JoinRateTracker:
+    """ギルドごとの参加レートをスライディングウィンドウで追跡し、レイドモードを判定する
+
+    参加ごとに追加1回・期限切れ削除の償却O(1)で動作する。
+    同じメンバーの参加を複数のCogから記録しても重複計上しない。
+    参加のないギルドの記録は定期的に削除する。
+    """
+
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self, threshold: int = 10, window_seconds: float = 10, cooldown_seconds: float = 120):
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self._windows: dict[int, _GuildJoinWindow] = {}
+        self._last_prune = time.monotonic()
+
+    def configure(self, settings: Optional[dict]):
+        settings = settings or {}
+        try:
+            self.threshold = max(int(settings.get('join_threshold', 10)), 1)
+            self.window_seconds = max(float(settings.get('window_seconds', 10)), 1.0)
+            self.cooldown_seconds = max(float(settings.get('cooldown_seconds', 120)), 0.0)
+        except (TypeError, ValueError):
+            pass
+
+    def _evict(self, window: _GuildJoinWindow, now: float):
+        cutoff = now - self.window_seconds
+        while window.joins and window.joins[0][0] <= cutoff:
+            _, member_id = window.joins.popleft()
+            window.member_ids.discard(member_id)
+
+    def _prune(self, now: float):
+        """ウィンドウ内の参加がなく、レイドモードでもないギルドの記録を削除する"""
+        self._last_prune = now
+        for guild_id in list(self._windows):
+            window = self._windows[guild_id]
+            self._evict(window, now)
+            if not window.joins and not self.is_raid(guild_id, now):
+                del self._windows[guild_id]
+
+    def record_join(self, guild_id: int, member_id: int, now: Optional[float] = None) -> bool:
+        """参加を記録し、その時点でレイドモードかどうかを返す"""
+        now = time.monotonic() if now is None else now
+        if now - self._last_prune >= self.PRUNE_INTERVAL:
+            self._prune(now)
+        window = self._windows.setdefault(guild_id, _GuildJoinWindow())
+        self._evict(window, now)
+        if member_id not in window.member_ids:
+            window.joins.append((now, member_id))
+            window.member_ids.add(member_id)
+            if window.raid_started_at is not None:
+                window.raid_join_count += 1
+
+        if len(window.joins) >= self.threshold:
+            if window.raid_started_at is None or now >= window.raid_until:
+                window.raid_started_at = now
+                window.raid_join_count = len(window.joins)
+                window.raid_start_reported = False
+            window.raid_until = now + self.cooldown_seconds
+        return self.is_raid(guild_id, now)
+
+    def record_member_join(self, member: discord.Member) -> bool:
+        """
+        メンバーの参加を記録し、その時点でレイドモードかどうかを返す。
+        各Cogはこれを通して記録するので、どのCogが先に呼んでも同じ条件で数える (Botの参加は数えない)。
+        """
+        if member.bot:
+            return self.is_raid(member.guild.id)
+        return self.record_join(member.guild.id, member.id)
+
+    def claim_raid_start(self, guild_id: int, now: Optional[float] = None) -> bool:
+        """
+        レイドモード中で、その開始がまだ報告されていなければTrueを返して報告済みにする。
+        どのCogが先に参加を記録しても、開始の通知は1回だけになる。
+        """
+        if not self.is_raid(guild_id, now):
+            return False
+        window = self._windows[guild_id]
+        if window.raid_start_reported:
+            return False
+        window.raid_start_reported = True
+        return True
+
+    def is_raid(self, guild_id: int, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        window = self._windows.get(guild_id)
+        if window is None or window.raid_started_at is None:
+            return False
+        if now >= window.raid_until:
+            window.raid_started_at = None
+            window.raid_join_count = 0
+            return False
+        return True
+
+    def status(self, guild_id: int, now: Optional[float] = None) -> dict:
+        now = time.monotonic() if now is None else now
+        window = self._windows.get(guild_id)
+        if window is None:
+            return {'raid': False, 'recent_joins': 0, 'raid_joins': 0, 'remaining_seconds': 0}
+        self._evict(window, now)
+        raid = self.is_raid(guild_id, now)
+        return {
+            'raid': raid,
+            'recent_joins': len(window.joins),
+            'raid_joins': window.raid_join_count if raid else 0,
+            'remaining_seconds': max(int(window.raid_until - now), 0) if raid else 0,
+        }
+
+
+def get_join_tracker(bot, settings: Optional[dict] = None) -> JoinRateTracker:
+    """Bot全体で共有する JoinRateTracker を取得 (なければ作成)"""
+    tracker = getattr(bot, 'join_tracker', None)
+    if tracker is None:
+        tracker = JoinRateTracker()
+        bot.join_tracker = tracker
+    if settings is not None:
+        tracker.configure(settings)
+    return tracker
+
+
+def account_age_days(user: discord.abc.Snowflake) -> float:
+    """スノーフレークIDから算出したアカウント作成からの経過日数"""
+    created_at = discord.utils.snowflake_time(user.id)
+    return (discord.utils.utcnow() - created_at).total_seconds() / 86400
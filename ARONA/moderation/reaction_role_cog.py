@@ -1,5 +1,8 @@
+import asyncio
 import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Optional
 
@@ -9,31 +12,276 @@ import yaml
 
 DATA_DIR = Path(__file__).parent.parent.parent / 'data'
 DATA_FILE = DATA_DIR / 'reaction_roles.json'
+JOURNAL_FILE = DATA_DIR / 'reaction_roles.journal'
+CHANNEL_FILE = DATA_DIR / 'reaction_role_channels.json'
+RECONCILE_PROGRESS_FILE = DATA_DIR / 'reaction_roles_reconcile.json'
 DATA_DIR.mkdir(exist_ok=True)
 
+# ジャーナルがこの件数を超えたらスナップショットへ圧縮する
+COMPACT_THRESHOLD = 500
+
 
 def load_config():
     with open('config.yaml', 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
 
 
-def load_reaction_roles() -> Dict[str, Dict[str, int]]:
-    if not DATA_FILE.exists():
+def _backup_path(path: Path) -> Path:
+    return path.with_name(path.name + '.bak')
+
+
+def _atomic_write_json(path: Path, data, keep_backup: bool = False) -> None:
+    """一時ファイルに書き出してからリネームし、途中でクラッシュしても既存ファイルを壊さない
+
+    keep_backup=True の場合は置き換える前のファイルを .bak として残す。
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    if keep_backup and path.exists():
+        os.replace(path, _backup_path(path))
+    os.replace(tmp_path, path)
+
+
+def _apply_op(data: Dict[str, Dict[str, int]], op: dict) -> None:
+    key = op.get('key')
+    emoji = op.get('emoji')
+    if not isinstance(key, str) or not isinstance(emoji, str):
+        return
+    if op.get('op') == 'set':
+        try:
+            data.setdefault(key, {})[emoji] = int(op['role_id'])
+        except (KeyError, TypeError, ValueError):
+            return
+    elif op.get('op') == 'chan':
+        return
+    elif op.get('op') == 'del':
+        emoji_map = data.get(key)
+        if emoji_map is None:
+            return
+        emoji_map.pop(emoji, None)
+        if not emoji_map:
+            del data[key]
+
+
+def _load_channel_index(channel_file: Path) -> Dict[str, int]:
+    """メッセージキー → チャンネルID の索引を読み込む (失われても再探索できるヒント扱い)"""
+    if not channel_file.exists():
         return {}
     try:
-        with DATA_FILE.open('r', encoding='utf-8') as f:
+        with channel_file.open('r', encoding='utf-8') as f:
             raw = json.load(f)
-            return {k: v for k, v in raw.items() if isinstance(v, dict)}
-    except (json.JSONDecodeError, OSError):
+        return {k: int(v) for k, v in raw.items()}
+    except (json.JSONDecodeError, OSError, AttributeError, TypeError, ValueError):
         return {}
 
 
-def save_reaction_roles(data: Dict[str, Dict[str, int]]) -> None:
+def _read_snapshot(path: Path) -> Optional[Dict[str, Dict[str, int]]]:
+    """スナップショットを読み込む。存在しなければ空、壊れていれば .corrupt に退避して None を返す"""
+    if not path.exists():
+        return {}
     try:
-        with DATA_FILE.open('w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with path.open('r', encoding='utf-8') as f:
+            raw = json.load(f)
+        return {k: v for k, v in raw.items() if isinstance(v, dict)}
+    except (json.JSONDecodeError, OSError, AttributeError) as exc:
+        # 壊れたスナップショットは上書きされないよう退避しておく
+        corrupt = path.with_name(path.name + '.corrupt')
+        print(f'⚠️ リアクションロールのスナップショット {path.name} が壊れています ({exc})。{corrupt.name} に退避します')
+        try:
+            os.replace(path, corrupt)
+        except OSError:
+            pass
+        return None
+
+
+def _replay_journal(
+    journal_file: Path,
+    data: Dict[str, Dict[str, int]],
+    channels: Optional[Dict[str, int]] = None,
+) -> None:
+    if not journal_file.exists():
+        return
+    try:
+        with journal_file.open('r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中でクラッシュした末尾行は無視する
+                    continue
+                if isinstance(op, dict):
+                    _apply_op(data, op)
+                    if channels is not None and op.get('channel_id') is not None:
+                        try:
+                            channels[op['key']] = int(op['channel_id'])
+                        except (KeyError, TypeError, ValueError):
+                            pass
     except OSError as exc:
-        print(f'リアクションロールの保存に失敗しました: {exc}')
+        print(f'⚠️ リアクションロールのジャーナル {journal_file.name} の読み込みに失敗しました: {exc}')
+
+
+def load_reaction_roles(
+    data_file: Path = DATA_FILE,
+    journal_file: Path = JOURNAL_FILE,
+    channels: Optional[Dict[str, int]] = None,
+) -> Dict[str, Dict[str, int]]:
+    """スナップショットを読み込み、その後のジャーナルを再生して最新のマッピングを復元する
+
+    スナップショットが壊れているか圧縮の途中で失われている場合は、1つ前のスナップショット (.bak) に
+    その後のジャーナル (.bak と現在のもの) を順に再生して復元する。
+    channels が渡された場合はジャーナル内のチャンネル情報もそこへ反映する。
+    """
+    data_backup = _backup_path(data_file)
+    data = _read_snapshot(data_file)
+    if data is not None and (data_file.exists() or not data_backup.exists()):
+        _replay_journal(journal_file, data, channels)
+        return data
+
+    data = _read_snapshot(data_backup)
+    if data is not None:
+        print(f'⚠️ リアクションロールを 1つ前のスナップショット {data_backup.name} とジャーナルから復元します')
+        # .bak のジャーナルは .bak のスナップショット以降の操作なので、現在のジャーナルより先に再生する
+        _replay_journal(_backup_path(journal_file), data, channels)
+        _replay_journal(journal_file, data, channels)
+        return data
+
+    data = {}
+    _replay_journal(_backup_path(journal_file), data, channels)
+    _replay_journal(journal_file, data, channels)
+    print(
+        f'❌ リアクションロールのスナップショットを復元できませんでした。'
+        f'ジャーナルから復元できたのは {len(data)} 件のメッセージのみで、それ以外の設定は失われています'
+    )
+    return data
+
+
+class ReactionRoleStore:
+    """リアクションロールの永続化 (追記型ジャーナル + 定期的なスナップショット圧縮)
+
+    書き込みは専用の単一スレッドで順番に実行するため、イベントループを止めず、
+    ジャーナルの追記順序も保証される。
+    """
+
+    def __init__(
+        self,
+        data_file: Path = DATA_FILE,
+        journal_file: Path = JOURNAL_FILE,
+        channel_file: Path = CHANNEL_FILE,
+        compact_threshold: int = COMPACT_THRESHOLD,
+    ):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.channel_file = channel_file
+        self.compact_threshold = max(compact_threshold, 1)
+        self.mappings: Dict[str, Dict[str, int]] = {}
+        self.channels: Dict[str, int] = {}
+        self._journal_entries = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reaction-role-store')
+
+    def load(self) -> Dict[str, Dict[str, int]]:
+        self.channels = _load_channel_index(self.channel_file)
+        self.mappings = load_reaction_roles(self.data_file, self.journal_file, self.channels)
+        self._journal_entries = self._count_journal_entries()
+        return self.mappings
+
+    def _count_journal_entries(self) -> int:
+        if not self.journal_file.exists():
+            return 0
+        try:
+            with self.journal_file.open('r', encoding='utf-8') as f:
+                return sum(1 for line in f if line.strip())
+        except OSError:
+            return 0
+
+    async def set(self, key: str, emoji: str, role_id: int, channel_id: Optional[int] = None) -> None:
+        self.mappings.setdefault(key, {})[emoji] = role_id
+        op = {'op': 'set', 'key': key, 'emoji': emoji, 'role_id': role_id}
+        if channel_id is not None:
+            self.channels[key] = channel_id
+            op['channel_id'] = channel_id
+        await self._record(op)
+
+    async def remember_channel(self, key: str, channel_id: int) -> None:
+        if self.channels.get(key) == channel_id:
+            return
+        self.channels[key] = channel_id
+        await self._record({'op': 'chan', 'key': key, 'emoji': '', 'channel_id': channel_id})
+
+    async def delete(self, key: str, emoji: str) -> None:
+        _apply_op(self.mappings, {'op': 'del', 'key': key, 'emoji': emoji})
+        await self._record({'op': 'del', 'key': key, 'emoji': emoji})
+
+    async def _record(self, op: dict) -> None:
+        loop = asyncio.get_running_loop()
+        line = json.dumps(op, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._journal_entries += 1
+        try:
+            await loop.run_in_executor(self._executor, self._append_journal, line)
+            if self._journal_entries >= self.compact_threshold:
+                self._journal_entries = 0
+                # スナップショットはループ上でコピーし、書き込みだけを別スレッドで行う
+                snapshot = {k: dict(v) for k, v in self.mappings.items()}
+                channels = {k: v for k, v in self.channels.items() if k in snapshot}
+                await loop.run_in_executor(self._executor, self._compact, snapshot, channels)
+        except OSError as exc:
+            print(f'リアクションロールの保存に失敗しました: {exc}')
+
+    def _append_journal(self, line: str) -> None:
+        with self.journal_file.open('a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self, snapshot: Dict[str, Dict[str, int]], channels: Dict[str, int]) -> None:
+        _atomic_write_json(self.channel_file, channels)
+        # 1つ前のスナップショットとそれ以降のジャーナルを .bak として残し、新しい方が壊れたときの復元に使う
+        _atomic_write_json(self.data_file, snapshot, keep_backup=True)
+        # スナップショットの置き換え後にジャーナルを切り替える (間でクラッシュしても再生は冪等)
+        if self.journal_file.exists():
+            os.replace(self.journal_file, _backup_path(self.journal_file))
+        with self.journal_file.open('w', encoding='utf-8') as f:
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def compact(self) -> None:
+        loop = asyncio.get_running_loop()
+        snapshot = {k: dict(v) for k, v in self.mappings.items()}
+        channels = {k: v for k, v in self.channels.items() if k in snapshot}
+        self._journal_entries = 0
+        try:
+            await loop.run_in_executor(self._executor, self._compact, snapshot, channels)
+        except OSError as exc:
+            print(f'リアクションロールの保存に失敗しました: {exc}')
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    async def aclose(self) -> None:
+        """書き込み待ちが終わるのを別スレッドで待ってから閉じる (イベントループを止めない)"""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
+class _RateLimiter:
+    """一定間隔でしか通さない単純なレートリミッター"""
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next_at > now:
+                await asyncio.sleep(self._next_at - now)
+                now = self._next_at
+            self._next_at = now + self.interval
 
 
 class ReactionRoleCog(commands.Cog):
@@ -41,7 +289,26 @@ class ReactionRoleCog(commands.Cog):
         self.bot = bot
         self.config = load_config()
         self.monitored_guild_ids = self._to_int_set(self.config.get('monitored_guilds', []))
-        self.mappings = load_reaction_roles()
+        self.store = ReactionRoleStore()
+        self.mappings = self.store.load()
+
+        settings = self.config.get('reaction_roles') or {}
+        self.reconcile_on_startup = bool(settings.get('reconcile_on_startup', True))
+        self.reconcile_remove_roles = bool(settings.get('reconcile_remove_roles', False))
+        self.reconcile_concurrency = max(int(settings.get('reconcile_concurrency', 4)), 1)
+        self.reconcile_rate_per_second = float(settings.get('reconcile_rate_per_second', 5))
+        self.reconcile_scan_channel_limit = max(int(settings.get('reconcile_scan_channel_limit', 20)), 0)
+        self._reconcile_task: Optional[asyncio.Task] = None
+
+    async def cog_load(self):
+        if self.reconcile_on_startup:
+            self._reconcile_task = asyncio.create_task(self._startup_reconcile())
+
+    async def cog_unload(self):
+        if self._reconcile_task and not self._reconcile_task.done():
+            self._reconcile_task.cancel()
+        await self.store.compact()
+        await self.store.aclose()
 
     def _to_int_set(self, values) -> set[int]:
         result = set()
@@ -97,8 +364,7 @@ class ReactionRoleCog(commands.Cog):
             return
 
         key = f'{ctx.guild.id}-{target_message.id}'
-        self.mappings.setdefault(key, {})[emoji] = role_id
-        save_reaction_roles(self.mappings)
+        await self.store.set(key, emoji, role_id, channel_id=ctx.channel.id)
 
         await ctx.send(
             f'✅ リアクションロールを設定しました\n'
@@ -143,10 +409,7 @@ class ReactionRoleCog(commands.Cog):
             await ctx.send('❌ 指定された設定が見つかりません')
             return
 
-        del self.mappings[key][emoji]
-        if not self.mappings[key]:
-            del self.mappings[key]
-        save_reaction_roles(self.mappings)
+        await self.store.delete(key, emoji)
 
         try:
             target_message = await ctx.channel.fetch_message(message_id)
@@ -156,6 +419,196 @@ class ReactionRoleCog(commands.Cog):
 
         await ctx.send('✅ リアクションロールを削除しました')
 
+    @commands.command(name='rrsync')
+    @commands.has_permissions(manage_roles=True)
+    async def reaction_role_sync(self, ctx: commands.Context):
+        """リアクションとロールのずれをこのサーバーで再同期します"""
+        if not self._is_enabled_for_guild(ctx.guild):
+            await ctx.send('⚠️ このサーバーではリアクションロールは無効です')
+            return
+        if self._reconcile_task and not self._reconcile_task.done():
+            await ctx.send('⏳ 再同期は既に実行中です')
+            return
+        await ctx.send('🔄 リアクションロールの再同期を開始します')
+        stats = await self._reconcile_guild(ctx.guild)
+        await ctx.send(
+            f'✅ 再同期が完了しました\n'
+            f'メッセージ: {stats["messages"]} / 付与: {stats["added"]} / 解除: {stats["removed"]}'
+        )
+
+    # ------------------------------------------------------------------
+    # 起動時の再同期
+    # ------------------------------------------------------------------
+    def _load_reconcile_progress(self) -> set[int]:
+        if not RECONCILE_PROGRESS_FILE.exists():
+            return set()
+        try:
+            with RECONCILE_PROGRESS_FILE.open('r', encoding='utf-8') as f:
+                return self._to_int_set(json.load(f).get('completed_guilds', []))
+        except (json.JSONDecodeError, OSError, AttributeError):
+            return set()
+
+    async def _save_reconcile_progress(self, completed: set[int]) -> None:
+        try:
+            await asyncio.to_thread(
+                _atomic_write_json, RECONCILE_PROGRESS_FILE, {'completed_guilds': sorted(completed)}
+            )
+        except OSError as exc:
+            print(f'⚠️ 再同期の進捗保存に失敗しました: {exc}')
+
+    async def _startup_reconcile(self):
+        """オフライン中のリアクション変化をロールへ反映する (ギルド単位で再開可能)"""
+        await self.bot.wait_until_ready()
+        guild_ids = sorted({int(key.split('-', 1)[0]) for key in self.mappings})
+        completed = self._load_reconcile_progress()
+        pending = [gid for gid in guild_ids if gid not in completed]
+        if not pending:
+            RECONCILE_PROGRESS_FILE.unlink(missing_ok=True)
+            return
+
+        print(f'🔄 リアクションロール再同期: {len(pending)}/{len(guild_ids)} サーバー (再開: {len(completed)} 件完了済み)')
+        started = time.monotonic()
+        totals = {'messages': 0, 'added': 0, 'removed': 0}
+        for index, guild_id in enumerate(pending, start=1):
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None and self._is_enabled_for_guild(guild):
+                try:
+                    stats = await self._reconcile_guild(guild)
+                except discord.HTTPException as exc:
+                    print(f'⚠️ {guild.name} の再同期に失敗しました: {exc}')
+                    continue
+                for k in totals:
+                    totals[k] += stats[k]
+            completed.add(guild_id)
+            await self._save_reconcile_progress(completed)
+
+            elapsed = max(time.monotonic() - started, 1e-6)
+            print(
+                f'🔄 再同期進捗: {index}/{len(pending)} サーバー '
+                f'({totals["messages"] / elapsed:.1f} メッセージ/秒, '
+                f'付与 {totals["added"]} / 解除 {totals["removed"]})'
+            )
+
+        RECONCILE_PROGRESS_FILE.unlink(missing_ok=True)
+        print(f'✅ リアクションロール再同期完了 ({time.monotonic() - started:.1f} 秒)')
+
+    async def _find_message(self, guild: discord.Guild, key: str, message_id: int) -> Optional[discord.Message]:
+        channel_id = self.store.channels.get(key)
+        if channel_id is not None:
+            # チャンネルが分かっていて見つからなければメッセージは削除済み (他のチャンネルは探さない)
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                return None
+            try:
+                return await channel.fetch_message(message_id)
+            except (discord.NotFound, discord.Forbidden):
+                return None
+        # チャンネル情報がない古い設定は上限までテキストチャンネルを探索し、見つかれば索引に記録する
+        # (次回からは探索しない。リアクションのイベントでもチャンネルを記録する)
+        channels = [
+            ch for ch in guild.text_channels if ch.permissions_for(guild.me).read_message_history
+        ][:self.reconcile_scan_channel_limit]
+        for channel in channels:
+            try:
+                message = await channel.fetch_message(message_id)
+            except (discord.NotFound, discord.Forbidden):
+                continue
+            await self.store.remember_channel(key, channel.id)
+            return message
+        print(
+            f'⚠️ リアクションロールのメッセージ {key} のチャンネルが分かりません '
+            f'({len(channels)} チャンネルを探索)。メッセージにリアクションが付くと記録されます'
+        )
+        return None
+
+    async def _collect_reactors(
+        self,
+        guild: discord.Guild,
+        key: str,
+        emoji_to_role: Dict[str, int],
+    ) -> Optional[Dict[int, set[int]]]:
+        """メッセージのリアクションを全ページ取得し、ロールID → リアクションしたユーザーID集合を返す"""
+        _, message_id = key.split('-', 1)
+        message = await self._find_message(guild, key, int(message_id))
+        if message is None:
+            return None
+
+        reactors: Dict[int, set[int]] = {}
+        for reaction in message.reactions:
+            role_id = emoji_to_role.get(str(reaction.emoji))
+            if role_id is None:
+                continue
+            users = reactors.setdefault(role_id, set())
+            async for user in reaction.users(limit=None):
+                if user.id != self.bot.user.id:
+                    users.add(user.id)
+        return reactors
+
+    async def _reconcile_guild(self, guild: discord.Guild) -> dict:
+        guild_mappings = {
+            k: v for k, v in self.mappings.items()
+            if k.startswith(f'{guild.id}-')
+        }
+        semaphore = asyncio.Semaphore(self.reconcile_concurrency)
+
+        async def collect(key: str, emoji_to_role: Dict[str, int]):
+            async with semaphore:
+                try:
+                    return await self._collect_reactors(guild, key, emoji_to_role)
+                except discord.HTTPException as exc:
+                    print(f'⚠️ リアクション取得に失敗しました ({key}): {exc}')
+                    return None
+
+        results = await asyncio.gather(*(collect(k, v) for k, v in guild_mappings.items()))
+
+        # 同じロールが複数メッセージに割り当てられている場合はリアクションの和集合で判定する
+        reactors_by_role: Dict[int, set[int]] = {}
+        unresolved_roles: set[int] = set()
+        for (key, emoji_to_role), reactors in zip(guild_mappings.items(), results):
+            if reactors is None:
+                unresolved_roles.update(emoji_to_role.values())
+                continue
+            for role_id in emoji_to_role.values():
+                reactors_by_role.setdefault(role_id, set()).update(reactors.get(role_id, set()))
+
+        changes: list[tuple[discord.Member, discord.Role, bool]] = []
+        for role_id, reactor_ids in reactors_by_role.items():
+            role = guild.get_role(role_id)
+            if role is None:
+                continue
+            holder_ids = {member.id for member in role.members}
+            for user_id in reactor_ids - holder_ids:
+                member = guild.get_member(user_id)
+                if member is not None and not member.guild_permissions.administrator:
+                    changes.append((member, role, True))
+            # 取得できなかったメッセージがあるロールは誤って外さないよう解除しない
+            if self.reconcile_remove_roles and role_id not in unresolved_roles:
+                for user_id in holder_ids - reactor_ids:
+                    member = guild.get_member(user_id)
+                    if member is not None and not member.bot and not member.guild_permissions.administrator:
+                        changes.append((member, role, False))
+
+        added, removed = await self._apply_role_changes(changes)
+        return {'messages': len(guild_mappings), 'added': added, 'removed': removed}
+
+    async def _apply_role_changes(self, changes: list[tuple[discord.Member, discord.Role, bool]]) -> tuple[int, int]:
+        limiter = _RateLimiter(self.reconcile_rate_per_second)
+        added = removed = 0
+        for member, role, grant in changes:
+            await limiter.wait()
+            try:
+                if grant:
+                    await member.add_roles(role, reason='リアクションロール再同期')
+                    added += 1
+                else:
+                    await member.remove_roles(role, reason='リアクションロール再同期')
+                    removed += 1
+            except discord.Forbidden:
+                continue
+            except discord.HTTPException as exc:
+                print(f'⚠️ ロール更新に失敗しました ({member.id}): {exc}')
+        return added, removed
+
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
         if payload.guild_id is None:
@@ -170,6 +623,8 @@ class ReactionRoleCog(commands.Cog):
         role_id = mapping.get(str(payload.emoji))
         if role_id is None:
             return
+        # チャンネル情報のない古い設定は、再同期でチャンネルを探索しなくて済むよう記録する
+        await self.store.remember_channel(key, payload.channel_id)
 
         guild = self.bot.get_guild(payload.guild_id)
         if guild is None:
@@ -206,6 +661,8 @@ class ReactionRoleCog(commands.Cog):
         role_id = mapping.get(str(payload.emoji))
         if role_id is None:
             return
+        # チャンネル情報のない古い設定は、再同期でチャンネルを探索しなくて済むよう記録する
+        await self.store.remember_channel(key, payload.channel_id)
 
         guild = self.bot.get_guild(payload.guild_id)
         if guild is None:
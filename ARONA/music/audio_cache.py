@@ -0,0 +1,161 @@
+# ARONA/music/audio_cache.py
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+from ARONA.music.metadata_cache import normalize_query
+
+
+def cache_key(url: str) -> str:
+    """曲のページURLから保存先のキーを作る (同じ曲の別表記URLは同じキーになる)"""
+    return hashlib.sha1(normalize_query(url).encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """よく再生される曲の音声ファイルを保存するローカルキャッシュ
+
+    ファイルは root/<キーの先頭2文字>/<キー>.<拡張子> に置き、索引 (再生回数・最終アクセス・
+    サイズ) はSQLiteに保存するので再起動後も引き継がれる。合計サイズが上限を超えたら
+    最終アクセスが古いものから削除する (LRU)。
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 5 * 1024 ** 3, download_after_plays: int = 3):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.download_after_plays = max(download_after_plays, 1)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS audio ("
+            " key TEXT PRIMARY KEY,"
+            " path TEXT,"  # 未保存ならNULL (再生回数だけ数えている状態)
+            " acodec TEXT,"
+            " size INTEGER NOT NULL DEFAULT 0,"
+            " plays INTEGER NOT NULL DEFAULT 0,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS audio_last_access ON audio (last_access)")
+
+    def lookup(self, url: str) -> Optional[Tuple[str, Optional[str]]]:
+        """保存済みなら (ファイルパス, コーデック) を返し、最終アクセスを更新する"""
+        key = cache_key(url)
+        with self._lock:
+            row = self._conn.execute("SELECT path, acodec FROM audio WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] is None or not os.path.isfile(row[0]):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE audio SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0], row[1]
+
+    def record_play(self, url: str) -> bool:
+        """再生回数を数え、ダウンロードして保存すべき回数に達したらTrueを返す"""
+        key = cache_key(url)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO audio (key, plays, last_access) VALUES (?, 1, ?)"
+                " ON CONFLICT(key) DO UPDATE SET plays = plays + 1, last_access = excluded.last_access",
+                (key, time.time()),
+            )
+            row = self._conn.execute("SELECT path, plays FROM audio WHERE key = ?", (key,)).fetchone()
+        return row[0] is None and row[1] >= self.download_after_plays
+
+    def store(self, url: str, file_path: str, acodec: Optional[str] = None) -> str:
+        """ダウンロード済みのファイルをキャッシュへ移動して登録し、新しいパスを返す (ブロッキング)"""
+        key = cache_key(url)
+        src = Path(file_path)
+        dest = self.root / key[:2] / f"{key}{src.suffix}"
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if src.resolve() != dest.resolve():
+            os.replace(src, dest)
+        size = dest.stat().st_size
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO audio (key, path, acodec, size, plays, last_access) VALUES (?, ?, ?, ?, 0, ?)"
+                " ON CONFLICT(key) DO UPDATE SET path = excluded.path, acodec = excluded.acodec,"
+                " size = excluded.size, last_access = excluded.last_access",
+                (key, str(dest), acodec, size, time.time()),
+            )
+        self.evict()
+        return str(dest)
+
+    def evict(self):
+        """合計サイズが上限を超えている間、最終アクセスが古いファイルから削除する
+
+        索引から外すところまでをロック内で行い、ファイルの削除はロックの外で行う
+        (削除に時間がかかっても lookup を待たせない)。
+        """
+        with self._lock:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM audio WHERE path IS NOT NULL").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self._conn.execute(
+                "SELECT key, path, size, acodec FROM audio WHERE path IS NOT NULL ORDER BY last_access"
+            ).fetchall()
+            victims = []
+            for key, path, size, acodec in rows:
+                if total <= self.max_bytes:
+                    break
+                # 先に索引から外し、削除中のファイルを lookup が返さないようにする
+                self._conn.execute("UPDATE audio SET path = NULL, size = 0, plays = 0 WHERE key = ?", (key,))
+                victims.append((key, path, size, acodec))
+                total -= size
+
+        for key, path, size, acodec in victims:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # 再生中などで削除できないファイルは索引に戻し、次の機会に回す
+                with self._lock:
+                    self._conn.execute(
+                        "UPDATE audio SET path = ?, size = ?, acodec = ? WHERE key = ? AND path IS NULL",
+                        (path, size, acodec, key),
+                    )
+                continue
+            self.evictions += 1
+
+    def prune(self, max_idle_seconds: float = 30 * 24 * 3600):
+        """消えたファイルの索引と、長く再生されていない再生回数だけの行を削除する (ブロッキング)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, path FROM audio WHERE path IS NOT NULL").fetchall()
+            for key, path in rows:
+                if not os.path.isfile(path):
+                    self._conn.execute("UPDATE audio SET path = NULL, size = 0 WHERE key = ?", (key,))
+            self._conn.execute(
+                "DELETE FROM audio WHERE path IS NULL AND last_access < ?", (time.time() - max_idle_seconds,)
+            )
+        self.evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            files, used = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio WHERE path IS NOT NULL"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "files": files,
+            "bytes": used,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,180 @@
+# ARONA/music/extraction_scheduler.py
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+
+class Priority(IntEnum):
+    """抽出処理の優先度 (小さいほど先に実行する)"""
+    PLAY = 0  # 今から再生する曲・/play の応答待ち
+    BACKFILL = 1  # プレイリストの残りの読み込み
+    PREFETCH = 2  # 先読み・次の曲の準備
+    BACKGROUND = 3  # 入力補完の検索・メタデータの更新
+
+
+class _Job:
+    __slots__ = ("key", "factory", "guild_id", "priority", "future", "waiters", "enqueued_at", "started")
+
+    def __init__(self, key: Optional[Hashable], factory: Callable[[], Awaitable[Any]], guild_id: int,
+                 priority: Priority, future: asyncio.Future):
+        self.key = key
+        self.factory = factory
+        self.guild_id = guild_id
+        self.priority = priority
+        self.future = future
+        self.waiters = 0
+        self.enqueued_at = time.perf_counter()
+        self.started = False
+
+
+class ExtractionScheduler:
+    """yt-dlp の抽出処理の実行順を決めるスケジューラー
+
+    同時に実行する数を max_concurrency に制限し、空いた枠には優先度の高いものから割り当てる。
+    同じ優先度の中ではギルドごとのキューを順番に回すので、1つのギルドが大量に積んでも
+    他のギルドの処理は待たされない。同じ key の処理が待機中・実行中なら結果を共有し、
+    より高い優先度で要求されたら待機中の処理を繰り上げる。
+
+    実行中の処理は中断できないので、reserved_for_play 枠は PLAY 専用に空けておき、
+    それ以外の優先度の処理で全ての枠が埋まって曲の開始が待たされないようにする。
+    """
+
+    def __init__(self, max_concurrency: int = 4, reserved_for_play: int = 1, wait_samples: int = 200):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.reserved_for_play = reserved_for_play
+        self.active = 0
+        self.active_non_play = 0
+        self.deduplicated = 0
+        self.promoted = 0
+        self._queues: Dict[Priority, OrderedDict[int, Deque[_Job]]] = {p: OrderedDict() for p in Priority}
+        self._jobs: Dict[Hashable, _Job] = {}
+        self._completed: Dict[Priority, int] = {p: 0 for p in Priority}
+        self._wait_samples: Dict[Priority, Deque[float]] = {p: deque(maxlen=wait_samples) for p in Priority}
+
+    def _enqueue(self, job: _Job):
+        queues = self._queues[job.priority]
+        guild_queue = queues.get(job.guild_id)
+        if guild_queue is None:
+            guild_queue = queues[job.guild_id] = deque()
+        guild_queue.append(job)
+
+    def _dequeue(self, job: _Job):
+        queues = self._queues[job.priority]
+        guild_queue = queues.get(job.guild_id)
+        if guild_queue is None:
+            return
+        try:
+            guild_queue.remove(job)
+        except ValueError:
+            return
+        if not guild_queue:
+            del queues[job.guild_id]
+
+    @property
+    def non_play_limit(self) -> int:
+        # 枠が1つしかない場合も、PLAY 以外の処理が実行できなくならないようにする
+        return max(self.max_concurrency - self.reserved_for_play, 1)
+
+    def _next_job(self) -> Optional[_Job]:
+        for priority in Priority:
+            queues = self._queues[priority]
+            if not queues:
+                continue
+            if priority != Priority.PLAY and self.active_non_play >= self.non_play_limit:
+                return None  # 残りの枠は PLAY 用
+            # 先頭のギルドから1件取り出し、そのギルドは末尾に回す (ラウンドロビン)
+            guild_id, guild_queue = next(iter(queues.items()))
+            job = guild_queue.popleft()
+            if guild_queue:
+                queues.move_to_end(guild_id)
+            else:
+                del queues[guild_id]
+            return job
+        return None
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            job.started = True
+            self.active += 1
+            if job.priority != Priority.PLAY:
+                self.active_non_play += 1
+            self._wait_samples[job.priority].append(time.perf_counter() - job.enqueued_at)
+            asyncio.create_task(self._execute(job))
+
+    async def _execute(self, job: _Job):
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            job.future.set_exception(e)
+            job.future.exception()  # 待機者がいなくても警告を出さない
+        else:
+            job.future.set_result(result)
+        finally:
+            self.active -= 1
+            if job.priority != Priority.PLAY:
+                self.active_non_play -= 1
+            self._completed[job.priority] += 1
+            if job.key is not None and self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            self._dispatch()
+
+    async def run(self, factory: Callable[[], Awaitable[Any]], *, key: Optional[Hashable] = None,
+                  guild_id: Optional[int] = None, priority: Priority = Priority.PLAY) -> Any:
+        """factory() を実行枠が空いたときに実行して結果を返す。key が同じ処理は1回だけ実行する"""
+        job = self._jobs.get(key) if key is not None else None
+        if job is not None:
+            self.deduplicated += 1
+            if not job.started and priority < job.priority:
+                self._dequeue(job)
+                job.priority = priority
+                self._enqueue(job)
+                self.promoted += 1
+        else:
+            job = _Job(key, factory, guild_id or 0, priority, asyncio.get_running_loop().create_future())
+            if key is not None:
+                self._jobs[key] = job
+            self._enqueue(job)
+            self._dispatch()
+
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if not job.started and job.waiters == 1:
+                # 誰も待っていない処理は実行しない (再生停止やプレイリスト読み込みの中止など)
+                self._dequeue(job)
+                if job.key is not None and self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+                job.future.cancel()
+            raise
+        finally:
+            job.waiters -= 1
+
+    def stats(self) -> dict:
+        classes = {}
+        for priority in Priority:
+            samples = sorted(self._wait_samples[priority])
+            classes[priority.name.lower()] = {
+                "pending": sum(len(q) for q in self._queues[priority].values()),
+                "completed": self._completed[priority],
+                "avg_wait_ms": sum(samples) / len(samples) * 1000 if samples else 0.0,
+                "p95_wait_ms": samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1000 if samples else 0.0,
+            }
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "reserved_for_play": self.max_concurrency - self.non_play_limit,
+            "deduplicated": self.deduplicated,
+            "promoted": self.promoted,
+            "classes": classes,
+        }
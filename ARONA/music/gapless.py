@@ -0,0 +1,195 @@
+# ARONA/music/gapless.py
+from __future__ import annotations
+
+import threading
+import time
+from array import array
+from collections import deque
+from typing import Any, Callable, Deque, Optional, Tuple
+
+import discord
+
+
+def _cleanup_in_background(source: discord.AudioSource):
+    # ffmpegの終了待ちでプレイヤーのスレッドを止めないように別スレッドで片付ける
+    threading.Thread(target=source.cleanup, name="audio-cleanup", daemon=True).start()
+
+
+def _mix_pcm(a: bytes, b: bytes, gain_a: float, gain_b: float) -> bytes:
+    """16bit PCM の2フレームを指定の比率で重ねる"""
+    samples_a, samples_b = array("h", a), array("h", b)
+    if len(samples_a) < len(samples_b):
+        samples_a.extend([0] * (len(samples_b) - len(samples_a)))
+    mixed = array("h", (
+        max(-32768, min(32767, int(x * gain_a + y * gain_b)))
+        for x, y in zip(samples_a, samples_b)
+    ))
+    return mixed.tobytes()
+
+
+class PrimedSource(discord.AudioSource):
+    """先頭のフレームを先に読み込んでおくラッパー (ffmpegの起動と接続の待ち時間を再生前に済ませる)"""
+
+    def __init__(self, original: discord.AudioSource):
+        self.original = original
+        self._frames: Deque[bytes] = deque()
+
+    def prime(self, frame_count: int) -> int:
+        """frame_count 個のフレーム (1フレーム20ms) を読み込む。ブロッキングなのでexecutorから呼ぶ"""
+        while len(self._frames) < frame_count:
+            data = self.original.read()
+            if not data:
+                break
+            self._frames.append(data)
+        return len(self._frames)
+
+    def read(self) -> bytes:
+        if self._frames:
+            return self._frames.popleft()
+        return self.original.read()
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self._frames.clear()
+        self.original.cleanup()
+
+
+_UNSET = object()
+
+
+class GaplessSource(discord.AudioSource):
+    """
+    再生中のソースが終わった次のフレームで、準備済みの次の曲のソースに切り替えるAudioSource。
+
+    プレイヤーは止まらないので after コールバックは呼ばれず、切り替えは
+    on_transition(token, 切り替えにかかった秒数, 次の曲の再生済み秒数) でプレイヤーのスレッドから通知される。
+    両方がPCMの場合はクロスフェードもできる。
+
+    current と次の曲のソースはプレイヤーのスレッドだけが読み書きする。イベントループ側の
+    set_next / clear_next / replace_current は受け渡し用の枠に置くだけで、次の read() で反映される。
+    ffmpegのパイプが詰まってもイベントループが止まらないよう、読み込み中はロックを持たない。
+    """
+
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, source: discord.AudioSource, on_transition: Callable[[Any, float, float], None],
+                 start_seconds: float = 0.0):
+        self.current = source
+        self._on_transition = on_transition
+        self._lock = threading.Lock()  # 受け渡し用の枠だけを守る
+        self._pending_next: Any = _UNSET  # _UNSET: 変更なし / None: 破棄 / (source, token, 開始フレーム, フレーム数)
+        self._pending_current: Optional[Tuple[discord.AudioSource, int]] = None
+        self._next: Optional[Tuple[discord.AudioSource, Any]] = None
+        # 曲の先頭からのフレーム数 (シーク位置から始めた場合はその位置から数える)
+        self._frames_read = int(start_seconds / self.FRAME_SECONDS)
+        self._crossfade_at: Optional[int] = None
+        self._crossfade_frames = 0
+        self._crossfade_done = 0
+
+    def set_next(self, source: discord.AudioSource, token: Any,
+                 crossfade_at_frame: Optional[int] = None, crossfade_frames: int = 0):
+        """次の曲のソースを登録する。曲の先頭から数えて crossfade_at_frame から crossfade_frames かけて重ねる (PCM同士のみ)"""
+        with self._lock:
+            previous, self._pending_next = self._pending_next, (source, token, crossfade_at_frame, crossfade_frames)
+        if isinstance(previous, tuple):
+            _cleanup_in_background(previous[0])
+
+    def clear_next(self):
+        with self._lock:
+            previous, self._pending_next = self._pending_next, None
+        if isinstance(previous, tuple):
+            _cleanup_in_background(previous[0])
+
+    @property
+    def has_next(self) -> bool:
+        pending = self._pending_next
+        if pending is not _UNSET:
+            return pending is not None
+        return self._next is not None
+
+    def replace_current(self, source: discord.AudioSource, start_seconds: float = 0.0):
+        """シークなどで再生中のソースだけを入れ替える。古いソースは切り替えた後に片付ける"""
+        with self._lock:
+            previous, self._pending_current = self._pending_current, (source, int(start_seconds / self.FRAME_SECONDS))
+        if previous is not None:
+            _cleanup_in_background(previous[0])
+
+    def _apply_pending(self):
+        # プレイヤーのスレッドから呼ぶ
+        with self._lock:
+            pending_current, self._pending_current = self._pending_current, None
+            pending_next, self._pending_next = self._pending_next, _UNSET
+        if pending_current is not None:
+            _cleanup_in_background(self.current)
+            self.current, self._frames_read = pending_current
+            self._crossfade_done = 0
+        if pending_next is not _UNSET:
+            if self._next is not None:
+                _cleanup_in_background(self._next[0])
+            self._next, self._crossfade_at, self._crossfade_frames = None, None, 0
+            self._crossfade_done = 0
+            if pending_next is not None:
+                source, token, crossfade_at, crossfade_frames = pending_next
+                self._next = (source, token)
+                if crossfade_frames > 0 and not source.is_opus() and not self.current.is_opus():
+                    self._crossfade_at, self._crossfade_frames = crossfade_at, crossfade_frames
+
+    def _advance(self):
+        # 次の曲を再生中にして (token, 次の曲の再生済みフレーム数) を返す
+        previous = self.current
+        self.current, token = self._next
+        self._next = None
+        played = self._crossfade_done
+        self._frames_read = played
+        self._crossfade_at = None
+        self._crossfade_done = 0
+        _cleanup_in_background(previous)
+        return token, played
+
+    def read(self) -> bytes:
+        if self._pending_current is not None or self._pending_next is not _UNSET:
+            self._apply_pending()
+        data = self.current.read()
+        self._frames_read += 1
+        if not data:
+            if self._next is None:
+                return b""
+            ended_at = time.perf_counter()
+            token, played = self._advance()
+            data = self.current.read()
+            self._on_transition(token, time.perf_counter() - ended_at, played * self.FRAME_SECONDS)
+            return data
+
+        # _frames_read は読み込んだフレーム数なので、今のフレームの位置は _frames_read - 1
+        if self._crossfade_at is not None and self._next is not None and self._frames_read > self._crossfade_at:
+            next_data = self._next[0].read()
+            if not next_data:
+                # 次の曲が読めない場合は重ねるのをやめて通常の切り替えにする
+                self._crossfade_at = None
+                return data
+            self._crossfade_done += 1
+            progress = min(self._crossfade_done / self._crossfade_frames, 1.0)
+            data = _mix_pcm(data, next_data, 1.0 - progress, progress)
+            if progress >= 1.0:
+                # 次の曲はすでに再生位置が進んでいるので、そのまま切り替える
+                token, played = self._advance()
+                self._on_transition(token, 0.0, played * self.FRAME_SECONDS)
+        return data
+
+    def is_opus(self) -> bool:
+        return self.current.is_opus()
+
+    def cleanup(self):
+        with self._lock:
+            pending_current, self._pending_current = self._pending_current, None
+            pending_next, self._pending_next = self._pending_next, _UNSET
+        sources = [self.current] + ([self._next[0]] if self._next else [])
+        self._next = None
+        if pending_current is not None:
+            sources.append(pending_current[0])
+        if isinstance(pending_next, tuple):
+            sources.append(pending_next[0])
+        for source in sources:
+            source.cleanup()
@@ -0,0 +1,134 @@
+# ARONA/music/metadata_cache.py
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# 動画ページを特定しない(=キャッシュキーに含めない)クエリパラメータ
+_IGNORED_QUERY_PARAMS = {"si", "feature", "pp", "t", "start_radio", "ab_channel", "index"}
+
+
+def normalize_query(query: str) -> str:
+    """URLまたは検索語をキャッシュキー用に正規化する"""
+    query = query.strip()
+    if "://" not in query:
+        # 検索語は大文字小文字と連続空白の違いを無視する
+        return "search:" + " ".join(query.lower().split())
+
+    parts = urlsplit(query)
+    host = parts.netloc.lower()
+    if host.startswith("www.") or host.startswith("m."):
+        host = host.split(".", 1)[1]
+    if host == "youtu.be":
+        # 短縮URLは watch?v= 形式に揃える
+        params = [("v", parts.path.lstrip("/"))] + parse_qsl(parts.query)
+        host, path = "youtube.com", "/watch"
+    else:
+        params = parse_qsl(parts.query)
+        path = parts.path.rstrip("/") or "/"
+    params = sorted((k, v) for k, v in params if k not in _IGNORED_QUERY_PARAMS)
+    return urlunsplit(("https", host, path, urlencode(params), ""))
+
+
+class MetadataCache:
+    """extract の結果 (タイトル・長さ・サムネイル・ページURL) を保存するSQLiteキャッシュ
+
+    ストリームURLは期限付きなので保存しない。ヒット率と検索時間を統計として保持する。
+    """
+
+    def __init__(self, db_path: Path, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 50000):
+        self.db_path = Path(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time_total = 0.0
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            " key TEXT PRIMARY KEY,"
+            " entries TEXT NOT NULL,"
+            " is_playlist INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def get(self, query: str) -> Optional[tuple[List[dict], bool, float]]:
+        """(エントリ一覧, プレイリストか, 保存からの経過秒数) を返す。期限切れならNone"""
+        started = time.perf_counter()
+        key = normalize_query(query)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT entries, is_playlist, updated_at FROM metadata WHERE key = ?", (key,)
+            ).fetchone()
+        result = None
+        if row is not None:
+            age = time.time() - row[2]
+            if age < self.ttl_seconds:
+                try:
+                    result = (json.loads(row[0]), bool(row[1]), age)
+                except json.JSONDecodeError:
+                    result = None
+        self.lookup_time_total += time.perf_counter() - started
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, query: str, entries: List[dict], is_playlist: bool):
+        """エントリを保存する (ブロッキングI/Oなのでexecutorから呼ぶ)"""
+        payload = json.dumps(entries, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, entries, is_playlist, updated_at) VALUES (?, ?, ?, ?)",
+                (normalize_query(query), payload, int(is_playlist), time.time()),
+            )
+
+    def recent_titles(self, limit: int = 5000) -> List[tuple[str, str]]:
+        """最近保存した単一の曲の (タイトル, ページURL) を新しい順に返す (ブロッキング)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT entries FROM metadata WHERE is_playlist = 0 ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        titles = []
+        for (payload,) in rows:
+            try:
+                records = json.loads(payload)
+            except json.JSONDecodeError:
+                continue
+            for record in records:
+                if record.get("title") and record.get("webpage_url"):
+                    titles.append((record["title"], record["webpage_url"]))
+        return titles
+
+    def prune(self):
+        """期限切れと上限超過分を削除する"""
+        with self._lock:
+            self._conn.execute("DELETE FROM metadata WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM metadata WHERE key IN ("
+                " SELECT key FROM metadata ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "avg_lookup_ms": self.lookup_time_total / lookups * 1000 if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
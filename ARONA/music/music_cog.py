@@ -2,11 +2,11 @@ import asyncio
 import gc
 import logging
 import math
-import random
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from enum import Enum, auto
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, Dict, List, Optional
 import time
 
 import discord
@@ -15,14 +15,31 @@ from discord import app_commands
 from discord.ext import commands, tasks
 
 try:
+    from ARONA.music import ytdlp_wrapper
     from ARONA.music.ytdlp_wrapper import Track, extract as extract_audio_data, ensure_stream
     from ARONA.music.error.errors import MusicCogExceptionHandler
+    from ARONA.music.track_queue import TrackQueue
+    from ARONA.music.requester_cache import RequesterNameCache
+    from ARONA.music.session_store import SessionStore
+    from ARONA.music.gapless import GaplessSource, PrimedSource
+    from ARONA.music.search_suggest import SearchResultCache, SuggestionIndex, normalize_prefix
+    from ARONA.music.extraction_scheduler import Priority
 except ImportError as e:
     print(f"[CRITICAL] MusicCog: 必須コンポーネントのインポートに失敗しました。エラー: {e}")
+    ytdlp_wrapper = None
     Track = None
     extract_audio_data = None
     ensure_stream = None
     MusicCogExceptionHandler = None
+    TrackQueue = None
+    RequesterNameCache = None
+    SessionStore = None
+    GaplessSource = None
+    PrimedSource = None
+    SearchResultCache = None
+    SuggestionIndex = None
+    normalize_prefix = None
+    Priority = None
 
 logger = logging.getLogger(__name__)
 
@@ -66,13 +83,37 @@ class LoopMode(Enum):
     ALL = auto()
 
 
+class TimedAudioSource(discord.AudioSource):
+    """最初のフレームが読まれるまでの時間を計測するラッパー (シークの応答時間の計測用)"""
+
+    def __init__(self, original: discord.AudioSource, on_first_frame, started_at: float):
+        self.original = original
+        self._on_first_frame = on_first_frame
+        self._started_at = started_at
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if self._on_first_frame is not None:
+            callback, self._on_first_frame = self._on_first_frame, None
+            callback(time.perf_counter() - self._started_at)
+        return data
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
 class GuildState:
-    def __init__(self, bot: commands.Bot, guild_id: int, cog_config: dict):
+    def __init__(self, bot: commands.Bot, guild_id: int, cog_config: dict,
+                 on_activity: Optional[Callable[[int], None]] = None):
         self.bot = bot
+        self._on_activity = on_activity
         self.guild_id = guild_id
         self.voice_client: Optional[discord.VoiceClient] = None
         self.current_track: Optional[Track] = None
-        self.queue: asyncio.Queue[Track] = asyncio.Queue()
+        self.queue: TrackQueue[Track] = TrackQueue()
         self.volume: float = cog_config.get('music', {}).get('default_volume', 50) / 100.0
         self.loop_mode: LoopMode = LoopMode.OFF
         self.is_playing: bool = False
@@ -86,9 +127,19 @@ class GuildState:
         self.seek_position: int = 0
         self.paused_at: Optional[float] = None
         self.is_seeking: bool = False  # 追加: シーク中フラグ
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self.seek_task: Optional[asyncio.Task] = None  # 連続したシーク要求をまとめて処理する
+        self.seek_target: Optional[int] = None
+        self.seek_requested_at: Optional[float] = None
+        self.ingest_task: Optional[asyncio.Task] = None  # プレイリストの逐次読み込み
+        self.last_track_end_time: Optional[float] = None  # 曲間の無音時間の計測用
+        self.gapless_task: Optional[asyncio.Task] = None  # 曲の終わりの前に次の曲のソースを準備する
+        self.prepared_track: Optional[Track] = None
 
     def update_activity(self):
         self.last_activity = datetime.now()
+        if self._on_activity is not None:
+            self._on_activity(self.guild_id)
 
     def update_last_text_channel(self, channel_id: int):
         self.last_text_channel_id = channel_id
@@ -115,14 +166,18 @@ class GuildState:
         self.seek_position = 0
         self.paused_at = None
 
+    def cancel_ingest(self):
+        if self.ingest_task and not self.ingest_task.done():
+            self.ingest_task.cancel()
+        self.ingest_task = None
+
+    def queue_memory_bytes(self) -> int:
+        """キューに積まれた Track のおおよそのメモリ使用量"""
+        return sum(track.approx_size() for track in self.queue)
+
     async def clear_queue(self):
-        while not self.queue.empty():
-            try:
-                self.queue.get_nowait()
-                self.queue.task_done()
-            except asyncio.QueueEmpty:
-                break
-        self.queue = asyncio.Queue()
+        # キューオブジェクトは差し替えない (待機中のタスクが古いキューを参照し続けないように)
+        self.queue.clear()
 
     async def cleanup_voice_client(self):
         if self.cleanup_in_progress:
@@ -151,7 +206,10 @@ class MusicCog(commands.Cog, name="music_cog"):
             raise commands.ExtensionFailed(self.qualified_name, "必須コンポーネントのインポート失敗")
         self.config = self._load_bot_config()
         self.music_config = self.config.get('music', {})
-        self.guild_states: Dict[int, GuildState] = {}
+        # 最終アクティビティが古い順に並ぶ (update_activity で末尾へ移動)
+        self.guild_states: OrderedDict[int, GuildState] = OrderedDict()
+        self.gc_pause_samples: deque[float] = deque(maxlen=100)
+        self._gc_started_at: Optional[float] = None
         self.exception_handler = MusicCogExceptionHandler(self.music_config)
         self.ffmpeg_path = self.music_config.get('ffmpeg_path', 'ffmpeg')
         self.ffmpeg_before_options = self.music_config.get('ffmpeg_before_options',
@@ -161,14 +219,82 @@ class MusicCog(commands.Cog, name="music_cog"):
         self.max_queue_size = self.music_config.get('max_queue_size', 9000)
         self.max_guilds = self.music_config.get('max_guilds', 100000000)
         self.inactive_timeout_minutes = self.music_config.get('inactive_timeout_minutes', 30)
-        self.global_connection_lock = asyncio.Lock()
+        # 接続中のギルドの登録簿 (接続・切断イベントで更新し、接続数を O(1) で得る)
+        self.connected_guilds: set[int] = set()
+        self.connecting_guilds: set[int] = set()
+        # 同時に行う接続処理の数だけを制限し、別ギルドの接続同士は待たせない
+        self.connection_semaphore = asyncio.Semaphore(self.music_config.get('max_concurrent_connects', 10))
+        # 再起動・再読み込み後に再生を再開するためのセッション保存
+        self.session_store: Optional[SessionStore] = None
+        if self.music_config.get('session_persistence', True):
+            self.session_store = SessionStore(Path('./cache/music_sessions.sqlite3'))
+        self.session_save_debounce = self.music_config.get('session_save_debounce', 2.0)
+        self.session_max_age_hours = self.music_config.get('session_max_age_hours', 6)
+        self._dirty_sessions: set[int] = set()
+        self._session_flush_task: Optional[asyncio.Task] = None
         self.cleanup_task = None
+        self.prefetch_count = self.music_config.get('prefetch_count', 2)
+        self.stream_playlists = self.music_config.get('stream_playlists', True)
+        self.track_gap_samples: deque[float] = deque(maxlen=100)
+        self.requester_names = RequesterNameCache(self.music_config.get('requester_cache_size', 5000))
+        # /play の入力補完: 再生した曲のタイトルと、入力に合わせて裏で行った検索の結果から候補を返す
+        self.suggestions = SuggestionIndex(self.music_config.get('autocomplete_index_size', 5000),
+                                           self.music_config.get('autocomplete_share_history', False))
+        self.search_suggestions = SearchResultCache(self.music_config.get('autocomplete_search_ttl_minutes', 60) * 60)
+        self.autocomplete_search = self.music_config.get('autocomplete_search', True)
+        self.autocomplete_debounce = self.music_config.get('autocomplete_debounce', 0.6)
+        self._autocomplete_tasks: Dict[int, asyncio.Task] = {}  # user_id -> 入力が止まるのを待っている検索
+        # Opus のストリームはデコードせずにそのまま送り、音量はffmpegのフィルタで調整する
+        self.opus_passthrough = self.music_config.get('opus_passthrough', True)
+        self.nico_start_timeout = self.music_config.get('nico_start_timeout', 20)
+        self.opus_bitrate = self.music_config.get('opus_bitrate', 128)
+        self.source_mode_counts = {'copy': 0, 'encode': 0, 'pcm': 0}
+        self.seek_coalesce_seconds = self.music_config.get('seek_coalesce_seconds', 0.3)
+        self.seek_latency_samples: deque[float] = deque(maxlen=100)
+        # 曲の終わる少し前に次の曲のffmpegを起動して先頭を読み込んでおき、切れ目なく切り替える
+        self.gapless_enabled = self.music_config.get('gapless_enabled', True) and GaplessSource is not None
+        self.crossfade_seconds = self.music_config.get('crossfade_seconds', 0)
+        self.gapless_prepare_seconds = max(self.music_config.get('gapless_prepare_seconds', 8),
+                                           self.crossfade_seconds + 2)
+        if self.gapless_enabled and self.crossfade_seconds > 0 and self.opus_passthrough:
+            # クロスフェードはPCM同士でしか重ねられないため、Opusの直接送信を使わない
+            logger.info("MusicCog: crossfade_seconds が有効なため opus_passthrough を無効にします。")
+            self.opus_passthrough = False
+        self._cpu_sample = (time.monotonic(), time.process_time())
+        ytdlp_wrapper.configure(self.music_config)
 
     async def cog_load(self):
+        if self._gc_callback not in gc.callbacks:
+            gc.callbacks.append(self._gc_callback)
         if not self.cleanup_task or self.cleanup_task.done():
             self.cleanup_task = self.cleanup_task_loop.start()
+        asyncio.create_task(self._warm_ytdl_pool())
+        if self.suggestions.share_across_guilds:
+            # どのサーバーで再生されたか分からない曲なので、履歴を共有する設定のときだけ読み込む
+            asyncio.create_task(self._load_suggestions())
+        if self.session_store is not None:
+            self.session_checkpoint_loop.start()
+            asyncio.create_task(self._restore_sessions())
         logger.info("MusicCog loaded and cleanup task started")
 
+    async def _warm_ytdl_pool(self):
+        try:
+            started = time.perf_counter()
+            await ytdlp_wrapper.warm_ytdl_pool()
+            logger.info(f"YoutubeDL pool warmed in {(time.perf_counter() - started) * 1000:.0f} ms")
+        except Exception as e:
+            logger.warning(f"YoutubeDL pool warm-up failed: {e}")
+
+    async def _load_suggestions(self):
+        """メタデータキャッシュに残っている曲を入力補完の候補として読み込む"""
+        try:
+            titles = await asyncio.get_running_loop().run_in_executor(
+                None, ytdlp_wrapper.recent_titles, self.suggestions.max_entries)
+            self.suggestions.load(reversed(titles))
+            logger.info(f"Loaded {len(self.suggestions)} titles for /play autocomplete")
+        except Exception as e:
+            logger.warning(f"Failed to load autocomplete titles: {e}")
+
     def _load_bot_config(self) -> dict:
         if hasattr(self.bot, 'config') and self.bot.config:
             return self.bot.config
@@ -180,12 +306,30 @@ class MusicCog(commands.Cog, name="music_cog"):
         except Exception:
             return {}
 
-    def cog_unload(self):
+    async def cog_unload(self):
         logger.info("Unloading MusicCog...")
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
         if hasattr(self, 'cleanup_task') and self.cleanup_task:
             self.cleanup_task.cancel()
         if hasattr(self, 'cleanup_task_loop') and self.cleanup_task_loop.is_running():
             self.cleanup_task_loop.cancel()
+        for task in self._autocomplete_tasks.values():
+            task.cancel()
+        self._autocomplete_tasks.clear()
+        if self.session_store is not None:
+            # 再読み込み後に同じ位置から再開できるよう、切断前に全ギルドの状態を書き出す
+            if self.session_checkpoint_loop.is_running():
+                self.session_checkpoint_loop.cancel()
+            if self._session_flush_task and not self._session_flush_task.done():
+                self._session_flush_task.cancel()
+            # スナップショットはループ上で作り、SQLiteへの書き込みと close は executor で行う
+            snapshots = {gid: self._session_snapshot(state) for gid, state in self.guild_states.items()}
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._save_and_close_sessions, self.session_store, snapshots)
+            except Exception as e:
+                logger.warning(f"Failed to save music sessions on unload: {e}")
         for guild_id in list(self.guild_states.keys()):
             try:
                 state = self.guild_states[guild_id]
@@ -197,25 +341,221 @@ class MusicCog(commands.Cog, name="music_cog"):
                 guild = self.bot.get_guild(guild_id)
                 logger.warning(f"Guild {guild_id} ({guild.name if guild else ''}) unload cleanup error: {e}")
         self.guild_states.clear()
+        self.connected_guilds.clear()
         logger.info("MusicCog unloaded.")
 
+    @staticmethod
+    def _save_and_close_sessions(store: SessionStore, snapshots: Dict[int, Optional[dict]]):
+        try:
+            store.save_many(snapshots)
+        finally:
+            store.close()
+
+    def _touch_guild(self, guild_id: int):
+        if not self._on_bot_loop():
+            # ループ側で guild_states を走査している最中に順序を変えないよう、ループに移して処理する
+            self.bot.loop.call_soon_threadsafe(self._touch_guild, guild_id)
+            return
+        if guild_id in self.guild_states:
+            self.guild_states.move_to_end(guild_id)
+        self._mark_session_dirty(guild_id)
+
+    def _on_bot_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.bot.loop
+        except RuntimeError:
+            return False
+
+    # --- セッションの保存と復元 ---
+    def _mark_session_dirty(self, guild_id: int):
+        """変更のあったギルドを記録し、一定時間後にまとめて保存する"""
+        if self.session_store is None:
+            return
+        if not self._on_bot_loop():
+            # 音声プレイヤーのスレッドなどループの外から呼ばれた場合はループ側で処理する
+            self.bot.loop.call_soon_threadsafe(self._mark_session_dirty, guild_id)
+            return
+        self._dirty_sessions.add(guild_id)
+        if self._session_flush_task is None or self._session_flush_task.done():
+            self._session_flush_task = asyncio.create_task(self._flush_sessions())
+
+    def _session_snapshot(self, state: GuildState) -> Optional[dict]:
+        vc = state.voice_client
+        if not vc or not vc.is_connected() or (not state.current_track and state.queue.empty()):
+            return None  # 保存するものがないセッションは削除する
+        return {
+            'voice_channel_id': vc.channel.id,
+            'text_channel_id': state.last_text_channel_id,
+            'loop': state.loop_mode.name,
+            'volume': state.volume,
+            'position': state.get_current_position() if state.current_track else 0,
+            'current': ytdlp_wrapper.track_to_record(state.current_track) if state.current_track else None,
+            'queue': [ytdlp_wrapper.track_to_record(track) for track in state.queue],
+        }
+
+    async def _flush_sessions(self):
+        await asyncio.sleep(self.session_save_debounce)
+        while self._dirty_sessions:
+            dirty, self._dirty_sessions = self._dirty_sessions, set()
+            snapshots = {
+                gid: self._session_snapshot(self.guild_states[gid]) if gid in self.guild_states else None
+                for gid in dirty
+            }
+            try:
+                # JSONへの変換と書き込みはイベントループの外で行う
+                await asyncio.get_running_loop().run_in_executor(None, self.session_store.save_many, snapshots)
+            except Exception as e:
+                logger.warning(f"Failed to save music sessions: {e}")
+                return
+
+    @tasks.loop(seconds=30)
+    async def session_checkpoint_loop(self):
+        # 再生位置は時間とともに変わるので、再生中のギルドは定期的に保存し直す
+        for guild_id in self.connected_guilds:
+            state = self.guild_states.get(guild_id)
+            if state and state.is_playing:
+                self._mark_session_dirty(guild_id)
+
+    async def _restore_sessions(self):
+        await self.bot.wait_until_ready()
+        started = time.perf_counter()
+        try:
+            sessions = await asyncio.get_running_loop().run_in_executor(
+                None, self.session_store.load_all, self.session_max_age_hours * 3600)
+        except Exception as e:
+            logger.warning(f"Failed to load music sessions: {e}")
+            return
+        if not sessions:
+            return
+        results = await asyncio.gather(
+            *(self._restore_session(guild_id, snapshot) for guild_id, snapshot in sessions.items()),
+            return_exceptions=True)
+        restored = sum(1 for result in results if result is True)
+        for guild_id, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Guild {guild_id}: Failed to restore music session: {result}")
+        logger.info(
+            f"Restored {restored}/{len(sessions)} music sessions in "
+            f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+    async def _restore_session(self, guild_id: int, snapshot: dict) -> bool:
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(snapshot.get('voice_channel_id')) if guild else None
+        if not isinstance(channel, discord.VoiceChannel) or not [m for m in channel.members if not m.bot]:
+            # チャンネルが消えたか誰もいない場合は再開せずに破棄する
+            self._mark_session_dirty(guild_id)
+            return False
+        state = self._get_guild_state(guild_id)
+        if not state or state.voice_client:
+            return False
+
+        state.loop_mode = LoopMode[snapshot.get('loop', 'OFF')]
+        state.volume = snapshot.get('volume', state.volume)
+        state.last_text_channel_id = snapshot.get('text_channel_id')
+        for record in snapshot.get('queue', []):
+            self._enqueue(state, ytdlp_wrapper.track_from_record(record))
+
+        stray_client = guild.voice_client
+        if stray_client is not None:
+            await stray_client.disconnect(force=True)
+        self.connecting_guilds.add(guild_id)
+        try:
+            async with self.connection_semaphore:
+                state.voice_client = await asyncio.wait_for(
+                    channel.connect(timeout=30.0, reconnect=True, self_deaf=True), timeout=35.0)
+        finally:
+            self.connecting_guilds.discard(guild_id)
+        self.connected_guilds.add(guild_id)
+
+        current = snapshot.get('current')
+        position = int(snapshot.get('position') or 0)
+        if current and position >= 1:
+            state.current_track = ytdlp_wrapper.track_from_record(current)
+            await self._play_next_song(guild_id, seek_seconds=position)
+        else:
+            if current:
+                state.queue.put_front(ytdlp_wrapper.track_from_record(current))
+            await self._play_next_song(guild_id)
+        logger.info(f"Guild {guild_id} ({guild.name}): Music session restored at {format_duration(position)}")
+        return True
+
+    def _gc_callback(self, phase: str, info: dict):
+        # 最も重い第2世代のGCだけ停止時間を記録する
+        if info.get('generation') != 2:
+            return
+        if phase == 'start':
+            self._gc_started_at = time.perf_counter()
+        elif self._gc_started_at is not None:
+            self.gc_pause_samples.append(time.perf_counter() - self._gc_started_at)
+            self._gc_started_at = None
+
+    def _find_inactive_guilds(self, inactive_threshold: timedelta):
+        """非アクティブなギルドを古い順に返す (期限内のギルドに達した時点で打ち切る)"""
+        cutoff = datetime.now() - inactive_threshold
+        for gid, state in self.guild_states.items():
+            if state.last_activity >= cutoff:
+                break
+            if not state.is_playing and (not state.voice_client or not state.voice_client.is_connected()):
+                yield gid
+
     @tasks.loop(minutes=5)
     async def cleanup_task_loop(self):
         try:
-            current_time = datetime.now()
-            inactive_threshold = timedelta(minutes=self.inactive_timeout_minutes)
-            guilds_to_cleanup = [
-                gid for gid, state in self.guild_states.items()
-                if (current_time - state.last_activity > inactive_threshold and
-                    not state.is_playing and
-                    (not state.voice_client or not state.voice_client.is_connected()))
-            ]
+            started = time.perf_counter()
+            guilds_to_cleanup = list(self._find_inactive_guilds(timedelta(minutes=self.inactive_timeout_minutes)))
             for guild_id in guilds_to_cleanup:
                 guild = self.bot.get_guild(guild_id)
                 logger.info(f"Cleaning up inactive guild: {guild_id} ({guild.name if guild else ''})")
                 await self._cleanup_guild_state(guild_id)
             if guilds_to_cleanup:
-                gc.collect()
+                logger.info(
+                    f"Inactive guild sweep: {len(guilds_to_cleanup)} cleaned up in "
+                    f"{(time.perf_counter() - started) * 1000:.1f} ms")
+            if self.gc_pause_samples:
+                pauses = sorted(self.gc_pause_samples)
+                logger.info(
+                    f"GC (gen 2) pause: median {pauses[len(pauses) // 2] * 1000:.1f} ms, "
+                    f"max {pauses[-1] * 1000:.1f} ms ({len(pauses)} samples)")
+            await asyncio.get_running_loop().run_in_executor(None, ytdlp_wrapper.prune_metadata_cache)
+            await asyncio.get_running_loop().run_in_executor(None, ytdlp_wrapper.prune_audio_cache)
+            cache_stats = ytdlp_wrapper.metadata_cache_stats()
+            if self.seek_latency_samples:
+                latencies = sorted(self.seek_latency_samples)
+                logger.info(
+                    f"Seek-to-audio latency: median {latencies[len(latencies) // 2] * 1000:.0f} ms, "
+                    f"max {latencies[-1] * 1000:.0f} ms ({len(latencies)} samples)")
+            if self.track_gap_samples:
+                gaps = sorted(self.track_gap_samples)
+                logger.info(
+                    f"Inter-track gap: median {gaps[len(gaps) // 2] * 1000:.0f} ms, "
+                    f"max {gaps[-1] * 1000:.0f} ms ({len(gaps)} samples)")
+            queue_memory = sorted(
+                ((state.queue_memory_bytes(), state.queue.qsize(), gid)
+                 for gid, state in self.guild_states.items() if not state.queue.empty()),
+                reverse=True)
+            if queue_memory:
+                top = ", ".join(f"{gid}: {size / 1024:.0f} KiB/{count} tracks" for size, count, gid in queue_memory[:5])
+                logger.info(
+                    f"Queue memory: {sum(m[0] for m in queue_memory) / 1024:.0f} KiB across "
+                    f"{len(queue_memory)} guilds (largest: {top})")
+            self._log_playback_cpu()
+            pool_stats = ytdlp_wrapper.ytdl_pool_stats()
+            logger.info(
+                f"YoutubeDL pool: queue depth {pool_stats['queue_depth']}, active {pool_stats['active']}, "
+                f"avg wait {pool_stats['avg_wait_ms']:.0f} ms, avg run {pool_stats['avg_run_ms']:.0f} ms, "
+                f"instances {pool_stats['instances_created']} created / {pool_stats['instances_reused']} reused")
+            scheduler_stats = ytdlp_wrapper.scheduler_stats()
+            waits = ", ".join(
+                f"{name} {c['pending']} pending / avg {c['avg_wait_ms']:.0f} ms / p95 {c['p95_wait_ms']:.0f} ms"
+                for name, c in scheduler_stats['classes'].items())
+            logger.info(
+                f"Extraction scheduler: active {scheduler_stats['active']}/{scheduler_stats['max_concurrency']}, "
+                f"deduplicated {scheduler_stats['deduplicated']}, promoted {scheduler_stats['promoted']}; {waits}")
+            if cache_stats:
+                logger.info(
+                    f"Metadata cache: hit rate {cache_stats['hit_rate']:.1%} "
+                    f"({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']}), "
+                    f"avg lookup {cache_stats['avg_lookup_ms']:.3f} ms")
         except Exception as e:
             logger.error(f"Cleanup task error: {e}", exc_info=True)
 
@@ -223,19 +563,21 @@ class MusicCog(commands.Cog, name="music_cog"):
     async def before_cleanup_task(self):
         await self.bot.wait_until_ready()
 
+    @session_checkpoint_loop.before_loop
+    async def before_session_checkpoint(self):
+        await self.bot.wait_until_ready()
+
     def _get_guild_state(self, guild_id: int) -> Optional[GuildState]:
         if guild_id not in self.guild_states:
             if len(self.guild_states) >= self.max_guilds:
-                oldest_guild, oldest_time = None, datetime.now()
-                for gid, state in self.guild_states.items():
-                    if not state.is_playing and state.last_activity < oldest_time:
-                        oldest_guild, oldest_time = gid, state.last_activity
+                # 先頭ほど最終アクティビティが古いので、最初に見つかった再生していないギルドを削除する
+                oldest_guild = next((gid for gid, state in self.guild_states.items() if not state.is_playing), None)
                 if oldest_guild:
                     asyncio.create_task(self._cleanup_guild_state(oldest_guild))
                     guild = self.bot.get_guild(oldest_guild)
                     logger.info(
                         f"Removed oldest inactive guild {oldest_guild} ({guild.name if guild else ''}) to make room")
-            self.guild_states[guild_id] = GuildState(self.bot, guild_id, self.config)
+            self.guild_states[guild_id] = GuildState(self.bot, guild_id, self.config, self._touch_guild)
         self.guild_states[guild_id].update_activity()
         return self.guild_states[guild_id]
 
@@ -285,13 +627,12 @@ class MusicCog(commands.Cog, name="music_cog"):
             return None
 
         async with state.connection_lock:
-            async with self.global_connection_lock:
-                active_connections = sum(
-                    1 for s in self.guild_states.values() if s.voice_client and s.voice_client.is_connected())
-                if active_connections >= self.max_guilds and not state.voice_client:
-                    await self._send_response(interaction, "error_playing", ephemeral=True,
-                                              error="現在接続数が上限に達しています。")
-                    return None
+            guild_id = interaction.guild.id
+            active_connections = len(self.connected_guilds) + len(self.connecting_guilds)
+            if active_connections >= self.max_guilds and not state.voice_client and guild_id not in self.connected_guilds:
+                await self._send_response(interaction, "error_playing", ephemeral=True,
+                                          error="現在接続数が上限に達しています。")
+                return None
 
             vc = state.voice_client
             if vc:
@@ -305,20 +646,24 @@ class MusicCog(commands.Cog, name="music_cog"):
                     await asyncio.sleep(0.5)
                     vc = None
 
-            for voice_client in list(self.bot.voice_clients):
-                if voice_client.guild.id == interaction.guild.id and voice_client != state.voice_client:
-                    try:
-                        await asyncio.wait_for(voice_client.disconnect(force=True), timeout=3.0)
-                    except:
-                        pass
+            # 状態と紐付いていない接続が残っていれば切断する (ギルドごとに1つなので全体を走査しない)
+            stray_client = interaction.guild.voice_client
+            if stray_client is not None and stray_client != state.voice_client:
+                try:
+                    await asyncio.wait_for(stray_client.disconnect(force=True), timeout=3.0)
+                except:
+                    pass
 
             if not vc and connect_if_not_in:
+                self.connecting_guilds.add(guild_id)
                 try:
-                    await asyncio.sleep(0.3)
-                    state.voice_client = await asyncio.wait_for(
-                        user_voice.channel.connect(timeout=30.0, reconnect=True, self_deaf=True),
-                        timeout=35.0
-                    )
+                    async with self.connection_semaphore:
+                        await asyncio.sleep(0.3)
+                        state.voice_client = await asyncio.wait_for(
+                            user_voice.channel.connect(timeout=30.0, reconnect=True, self_deaf=True),
+                            timeout=35.0
+                        )
+                    self.connected_guilds.add(guild_id)
                     logger.info(
                         f"Guild {interaction.guild.id} ({interaction.guild.name}): Connected to {user_voice.channel.name}")
                     return state.voice_client
@@ -326,6 +671,8 @@ class MusicCog(commands.Cog, name="music_cog"):
                     await self._handle_error(interaction, e)
                     state.voice_client = None
                     return None
+                finally:
+                    self.connecting_guilds.discard(guild_id)
             elif not vc:
                 await self._send_response(interaction, "bot_not_in_voice_channel", ephemeral=True)
                 return None
@@ -358,9 +705,8 @@ class MusicCog(commands.Cog, name="music_cog"):
             track_to_play = state.current_track
         elif not state.queue.empty() and not is_seek_operation:
             try:
-                track_to_play = await state.queue.get()
-                state.queue.task_done()
-            except:
+                track_to_play = state.queue.get_nowait()
+            except asyncio.QueueEmpty:
                 pass
 
         if not track_to_play:
@@ -388,27 +734,29 @@ class MusicCog(commands.Cog, name="music_cog"):
         state.paused_at = None
 
         try:
-            if not track_to_play.stream_url or not Path(track_to_play.stream_url).is_file():
-                updated_track = await ensure_stream(track_to_play)
+            # 保存済みの音声ファイルがあればネットワークから取得しない
+            await ytdlp_wrapper.use_cached_audio(track_to_play)
+            # ダウンロード中のニコニコ動画は、完了または十分にバッファされるまで待つ
+            reading_partial_file = await ytdlp_wrapper.prepare_nico_track(track_to_play, self.nico_start_timeout)
+            if not ytdlp_wrapper.is_stream_valid(track_to_play):
+                updated_track = await ensure_stream(track_to_play, guild_id=guild_id, priority=Priority.PLAY)
                 if not (updated_track and updated_track.stream_url):
                     raise RuntimeError("ストリームURLの取得/更新に失敗しました。")
                 track_to_play.stream_url = updated_track.stream_url
 
             # シーク位置を適用
-            ffmpeg_before_opts = self.ffmpeg_before_options
-            if seek_seconds > 0:
-                ffmpeg_before_opts = f"-ss {seek_seconds} {ffmpeg_before_opts}"
+            ffmpeg_before_opts = self._build_before_options(track_to_play, seek_seconds, reading_partial_file)
 
-            source = discord.PCMVolumeTransformer(
-                discord.FFmpegPCMAudio(
-                    track_to_play.stream_url,
-                    executable=self.ffmpeg_path,
-                    before_options=ffmpeg_before_opts,
-                    options=self.ffmpeg_options
-                ),
-                volume=state.volume
-            )
+            source = self._create_audio_source(state, track_to_play, ffmpeg_before_opts)
+            if self.gapless_enabled:
+                source = GaplessSource(source, lambda token, gap, offset: self.bot.loop.call_soon_threadsafe(
+                    self._on_gapless_transition, guild_id, token, gap, offset), start_seconds=seek_seconds)
             state.voice_client.play(source, after=lambda e: self._song_finished_callback(e, guild_id))
+            self._record_track_gap(state)
+            self._schedule_prefetch(guild_id)
+            self._schedule_gapless(guild_id)
+            if not is_seek_operation:
+                self._note_played(guild_id, track_to_play)
 
             guild = self.bot.get_guild(guild_id)
             seek_info = f" (seeking to {format_duration(seek_seconds)})" if seek_seconds > 0 else ""
@@ -416,19 +764,8 @@ class MusicCog(commands.Cog, name="music_cog"):
                 f"Guild {guild_id} ({guild.name if guild else ''}): Now playing - {track_to_play.title}{seek_info}")
 
             # シーク時はメッセージを送らない
-            if state.last_text_channel_id and track_to_play.requester_id and not is_seek_operation:
-                try:
-                    requester = self.bot.get_user(track_to_play.requester_id) or await self.bot.fetch_user(
-                        track_to_play.requester_id)
-                except:
-                    requester = None
-                await self._send_background_message(
-                    state.last_text_channel_id,
-                    "now_playing",
-                    title=track_to_play.title,
-                    duration=format_duration(track_to_play.duration),
-                    requester_display_name=requester.display_name if requester else "不明"
-                )
+            if not is_seek_operation:
+                await self._announce_now_playing(guild_id, track_to_play)
         except Exception as e:
             guild = self.bot.get_guild(guild_id)
             error_message = self.exception_handler.handle_error(e, guild)
@@ -436,15 +773,352 @@ class MusicCog(commands.Cog, name="music_cog"):
                 await self._send_background_message(state.last_text_channel_id, "error_message_wrapper",
                                                     error=error_message)
             if state.loop_mode == LoopMode.ALL and track_to_play and not is_seek_operation:
-                await state.queue.put(track_to_play)
+                self._enqueue(state, track_to_play)
             state.current_track = None
             state.reset_playback_tracking()
             asyncio.create_task(self._play_next_song(guild_id))
 
+    def _note_played(self, guild_id: int, track: Track):
+        """再生回数を音声キャッシュと入力補完の候補に記録する"""
+        if track.url and "://" in track.url:
+            self.suggestions.add(track.title, track.url, guild_id)
+        asyncio.create_task(ytdlp_wrapper.note_play(track))
+
+    async def _announce_now_playing(self, guild_id: int, track: Track):
+        state = self.guild_states.get(guild_id)
+        if state and state.last_text_channel_id and track.requester_id:
+            await self._send_background_message(
+                state.last_text_channel_id,
+                "now_playing",
+                title=track.title,
+                duration=format_duration(track.duration),
+                requester_display_name=await self._requester_name(guild_id, track.requester_id)
+            )
+
+    def _create_audio_source(self, state: GuildState, track: Track, before_options: str) -> discord.AudioSource:
+        """再生用のAudioSourceを作成する
+
+        - Opusかつ音量100%: ffmpegはコンテナの詰め替えだけを行い、デコード・再エンコードしない
+        - それ以外: ffmpeg内で音量フィルタを掛けてOpusにエンコードする (Python側でのPCM処理なし)
+        - opus_passthrough 無効時: 従来どおり PCM + PCMVolumeTransformer
+        """
+        if not self.opus_passthrough:
+            self.source_mode_counts['pcm'] += 1
+            return discord.PCMVolumeTransformer(
+                discord.FFmpegPCMAudio(
+                    track.stream_url,
+                    executable=self.ffmpeg_path,
+                    before_options=before_options,
+                    options=self.ffmpeg_options
+                ),
+                volume=state.volume
+            )
+
+        options = self.ffmpeg_options
+        # discord.py は codec に 'opus' を渡すと -c:a copy、それ以外だと libopus でエンコードする
+        if ytdlp_wrapper.is_opus_stream(track) and math.isclose(state.volume, 1.0):
+            codec = 'opus'
+            self.source_mode_counts['copy'] += 1
+        else:
+            codec = None
+            if not math.isclose(state.volume, 1.0):
+                options = f"{options} -filter:a volume={state.volume:.2f}"
+            self.source_mode_counts['encode'] += 1
+        return discord.FFmpegOpusAudio(
+            track.stream_url,
+            bitrate=self.opus_bitrate,
+            codec=codec,
+            executable=self.ffmpeg_path,
+            before_options=before_options,
+            options=options
+        )
+
+    def _build_before_options(self, track: Track, seek_seconds: int = 0, reading_partial_file: bool = False) -> str:
+        before_options = self.ffmpeg_before_options
+        if seek_seconds > 0:
+            # -i より前の -ss は入力側のシーク。リモートはRangeリクエストで目的の位置付近から取得させ、
+            # ローカルファイルはファイル内を直接シークする
+            is_remote = bool(track.stream_url and "://" in track.stream_url)
+            before_options = f"-ss {seek_seconds} {'-seekable 1 ' if is_remote else ''}{before_options}"
+        if reading_partial_file:
+            # 書き込み中のファイルの末尾に達しても、追記されるまで待って読み続ける
+            before_options = f"-follow 1 -rw_timeout 5000000 {before_options}"
+        return before_options
+
+    def _request_seek(self, guild_id: int, position: int):
+        """シーク要求を受け付ける。短時間に続いた要求は最後の位置だけを処理する"""
+        state = self.guild_states.get(guild_id)
+        if not state:
+            return
+        state.seek_target = position
+        state.seek_requested_at = time.perf_counter()
+        if state.seek_task and not state.seek_task.done():
+            return
+        state.seek_task = asyncio.create_task(self._run_seek(guild_id))
+
+    async def _run_seek(self, guild_id: int):
+        state = self.guild_states.get(guild_id)
+        if not state:
+            return
+        while True:
+            target = state.seek_target
+            await asyncio.sleep(self.seek_coalesce_seconds)
+            if state.seek_target == target:
+                break
+        state.seek_target = None
+        try:
+            await self._swap_source(guild_id, target)
+        except Exception as e:
+            guild = self.bot.get_guild(guild_id)
+            error_message = self.exception_handler.handle_error(e, guild)
+            if state.last_text_channel_id:
+                await self._send_background_message(state.last_text_channel_id, "error_message_wrapper",
+                                                    error=error_message)
+
+    async def _swap_source(self, guild_id: int, position: int):
+        """
+        再生中の曲のffmpegだけを指定位置から作り直し、プレイヤーのソースを差し替える。
+        ストリームURLは残り時間の分だけ有効なら再解決せず、曲の終了コールバックも発生しない。
+        """
+        state = self.guild_states.get(guild_id)
+        if not state or not state.current_track:
+            return
+        track = state.current_track
+        voice_client = state.voice_client
+        if not voice_client or not (voice_client.is_playing() or voice_client.is_paused()):
+            # プレイヤーが止まっている場合は通常の再生処理で指定位置から始める
+            # (0秒だと次の曲の再生として扱われるため1秒目から)
+            await self._play_next_song(guild_id, seek_seconds=max(position, 1))
+            return
+
+        requested_at = state.seek_requested_at or time.perf_counter()
+        await ytdlp_wrapper.use_cached_audio(track)
+        remaining = max((track.duration or 0) - position, 0)
+        if not ytdlp_wrapper.is_stream_valid(track, margin=ytdlp_wrapper.STREAM_EXPIRY_MARGIN + remaining):
+            await ensure_stream(track, guild_id=guild_id, priority=Priority.PLAY)
+            if not track.stream_url:
+                raise RuntimeError("ストリームURLの取得/更新に失敗しました。")
+        reading_partial_file = ytdlp_wrapper.is_download_pending(track) and "://" not in track.stream_url
+
+        source = self._create_audio_source(state, track, self._build_before_options(track, position, reading_partial_file))
+        source = TimedAudioSource(source, lambda latency: self._record_seek_latency(guild_id, latency), requested_at)
+        if state.current_track is not track or not (voice_client.is_playing() or voice_client.is_paused()):
+            # 差し替えの準備中に曲が変わった
+            source.cleanup()
+            return
+        if isinstance(voice_client.source, GaplessSource):
+            # 準備済みの次の曲は残したまま、再生中の曲のソースだけを入れ替える (古いソースはプレイヤー側で片付ける)
+            voice_client.source.replace_current(source, start_seconds=position)
+            old_source = None
+        else:
+            old_source = voice_client.source
+            voice_client.source = source  # プレイヤーのスレッドはそのままでソースだけ入れ替わる
+        if old_source is not None:
+            # プレイヤーが読み取り途中の可能性があるので、少し待ってから古いffmpegを終了する
+            loop = asyncio.get_running_loop()
+            loop.call_later(1.0, loop.run_in_executor, None, old_source.cleanup)
+
+        state.seek_position = position
+        state.playback_start_time = time.time()
+        if state.is_paused:
+            # ソースの差し替えで再開されるので一時停止し直す
+            voice_client.pause()
+            state.paused_at = time.time()
+        else:
+            state.paused_at = None
+        # 残り時間が変わったので次の曲の準備をやり直す
+        self._schedule_gapless(guild_id)
+
+    def _record_seek_latency(self, guild_id: int, latency: float):
+        # プレイヤーのスレッドから呼ばれる
+        self.seek_latency_samples.append(latency)
+        logger.debug(f"Guild {guild_id}: Seek-to-audio latency {latency * 1000:.0f} ms")
+
+    async def _restart_current_source(self, guild_id: int):
+        """音量変更などでffmpegの設定を変えるため、現在の位置から再生し直す"""
+        state = self.guild_states.get(guild_id)
+        if not state or not state.current_track:
+            return
+        state.seek_requested_at = time.perf_counter()
+        await self._swap_source(guild_id, state.get_current_position())
+
+    def _log_playback_cpu(self):
+        """前回からのBotプロセスのCPU使用率を再生中のストリーム数で割って記録する"""
+        now, cpu = time.monotonic(), time.process_time()
+        last_now, last_cpu = self._cpu_sample
+        self._cpu_sample = (now, cpu)
+        streams = sum(1 for state in self.guild_states.values() if state.is_playing and not state.is_paused)
+        if streams and now > last_now:
+            usage = (cpu - last_cpu) / (now - last_now)
+            logger.info(
+                f"Playback CPU: {usage:.1%} of one core for {streams} streams "
+                f"({usage / streams:.2%} per stream), sources {self.source_mode_counts}")
+
+    def _enqueue(self, state: GuildState, track: Track):
+        """キューの末尾に追加する。すぐには再生されない位置の曲はストリームURLを保持しない"""
+        was_empty = state.queue.empty()
+        if state.queue.qsize() >= max(self.prefetch_count, 1):
+            # 署名付きURLは1件で1KBを超えることがあり、再生が近づけば先読みで取り直すため
+            track.drop_stream()
+        state.queue.put_nowait(track)
+        self._mark_session_dirty(state.guild_id)
+        if was_empty and state.current_track:
+            # 次に再生する曲が変わったので準備し直す
+            self._schedule_gapless(state.guild_id)
+
+    async def _requester_name(self, guild_id: int, user_id: Optional[int]) -> str:
+        """リクエストしたユーザーの表示名。通常は追加時に登録したキャッシュから返す"""
+        if not user_id:
+            return "不明"
+        name = self.requester_names.get(guild_id, user_id)
+        if name is not None:
+            return name
+        guild = self.bot.get_guild(guild_id)
+        user = (guild.get_member(user_id) if guild else None) or self.bot.get_user(user_id)
+        if user is None:
+            # Botの起動前に積まれた曲など、ゲートウェイのキャッシュにもいない場合のみRESTで取得
+            try:
+                user = await self.bot.fetch_user(user_id)
+            except discord.HTTPException:
+                return "不明"
+        self.requester_names.remember(user, guild_id)
+        return user.display_name
+
+    def _record_track_gap(self, state: GuildState, gap: Optional[float] = None):
+        """前の曲の終了から次の曲の再生開始までの時間を記録"""
+        if gap is None:
+            if state.last_track_end_time is None:
+                return
+            gap = time.monotonic() - state.last_track_end_time
+        state.last_track_end_time = None
+        self.track_gap_samples.append(gap)
+        logger.debug(f"Guild {state.guild_id}: Inter-track gap {gap * 1000:.0f} ms")
+
+    def _schedule_prefetch(self, guild_id: int):
+        state = self.guild_states.get(guild_id)
+        if not state or self.prefetch_count <= 0:
+            return
+        if state.prefetch_task and not state.prefetch_task.done():
+            return
+        state.prefetch_task = asyncio.create_task(self._prefetch_upcoming(guild_id))
+
+    async def _prefetch_upcoming(self, guild_id: int):
+        """キューの先頭N曲のストリームURLを再生前に解決しておく"""
+        state = self.guild_states.get(guild_id)
+        if not state:
+            return
+        upcoming = state.queue.peek(self.prefetch_count)
+        for track in upcoming:
+            if ytdlp_wrapper.is_stream_valid(track) or ytdlp_wrapper.is_download_pending(track):
+                continue
+            try:
+                await ensure_stream(track, guild_id=guild_id, priority=Priority.PREFETCH)
+            except Exception as e:
+                logger.debug(f"Guild {guild_id}: Prefetch failed for {track.title}: {e}")
+
+    def _peek_next_track(self, state: GuildState) -> Optional[Track]:
+        """今の曲が終わったときに次に再生される曲 (キューは変更しない)"""
+        if state.loop_mode == LoopMode.ONE:
+            return state.current_track
+        if not state.queue.empty():
+            return state.queue[0]
+        if state.loop_mode == LoopMode.ALL:
+            return state.current_track
+        return None
+
+    def _schedule_gapless(self, guild_id: int):
+        """次の曲の準備を (準備済みのものは破棄して) やり直す。キューの並びや音量が変わったときにも呼ぶ"""
+        state = self.guild_states.get(guild_id)
+        if not state or not self.gapless_enabled:
+            return
+        if state.gapless_task and not state.gapless_task.done():
+            state.gapless_task.cancel()
+        state.gapless_task = None
+        state.prepared_track = None
+        source = state.voice_client.source if state.voice_client else None
+        if isinstance(source, GaplessSource):
+            source.clear_next()
+            if state.current_track and state.current_track.duration:
+                state.gapless_task = asyncio.create_task(self._prepare_next_source(guild_id, state.current_track))
+
+    async def _prepare_next_source(self, guild_id: int, playing: Track):
+        """曲の終わる gapless_prepare_seconds 前に次の曲のソースを作り、先頭のフレームを読み込んでおく"""
+        state = self.guild_states.get(guild_id)
+        if not state:
+            return
+        while True:
+            remaining = playing.duration - state.get_current_position()
+            if remaining <= self.gapless_prepare_seconds and not state.is_paused:
+                break
+            await asyncio.sleep(max(remaining - self.gapless_prepare_seconds, 1))
+            if state.current_track is not playing:
+                return
+
+        chain = state.voice_client.source if state.voice_client else None
+        next_track = self._peek_next_track(state)
+        if not isinstance(chain, GaplessSource) or next_track is None:
+            return
+        try:
+            await ytdlp_wrapper.use_cached_audio(next_track)
+            if ytdlp_wrapper.is_download_pending(next_track):
+                return  # ダウンロード中のファイルは通常の再生処理でバッファを待つ
+            if not ytdlp_wrapper.is_stream_valid(next_track):
+                # 曲の終わりが近く、すぐに再生される曲なので再生と同じ優先度で解決する
+                await ensure_stream(next_track, guild_id=guild_id, priority=Priority.PLAY)
+                if not next_track.stream_url:
+                    return
+            source = PrimedSource(self._create_audio_source(state, next_track, self._build_before_options(next_track)))
+            # ffmpegの起動と接続待ちをここで済ませる (0.5秒分)
+            buffered = await asyncio.get_running_loop().run_in_executor(None, source.prime, 25)
+        except Exception as e:
+            logger.debug(f"Guild {guild_id}: Gapless preparation failed for {next_track.title}: {e}")
+            return
+
+        if (not buffered or state.current_track is not playing or state.voice_client is None
+                or state.voice_client.source is not chain or self._peek_next_track(state) is not next_track):
+            source.cleanup()
+            return
+        crossfade_frames = int(self.crossfade_seconds / GaplessSource.FRAME_SECONDS)
+        # GaplessSource は曲の先頭からのフレーム数で数えている (シークやクロスフェードで途中から始まった場合も)
+        crossfade_at = int((playing.duration - self.crossfade_seconds) / GaplessSource.FRAME_SECONDS)
+        chain.set_next(source, next_track, crossfade_at, crossfade_frames)
+        state.prepared_track = next_track
+
+    def _on_gapless_transition(self, guild_id: int, next_track: Track, gap: float, offset: float):
+        """GaplessSource が準備済みの次の曲に切り替わった (after コールバックの代わりにキューを進める)"""
+        state = self.guild_states.get(guild_id)
+        if not state:
+            return
+        finished = state.current_track
+        if next_track is not finished:
+            # 同じ曲のループ (ONE、または1曲だけの ALL) ではキューは変わらない
+            if finished and state.loop_mode == LoopMode.ALL:
+                self._enqueue(state, finished)
+            if not state.queue.empty() and state.queue[0] is next_track:
+                state.queue.get_nowait()
+        state.current_track = next_track
+        state.prepared_track = None
+        state.is_playing = True
+        state.seek_position = int(offset)
+        state.playback_start_time = time.time()
+        state.paused_at = None
+        state.update_activity()
+        self._record_track_gap(state, gap)
+        self._schedule_prefetch(guild_id)
+        self._schedule_gapless(guild_id)
+        self._note_played(guild_id, next_track)
+
+        guild = self.bot.get_guild(guild_id)
+        logger.info(f"Guild {guild_id} ({guild.name if guild else ''}): Now playing (gapless) - {next_track.title}")
+        asyncio.create_task(self._announce_now_playing(guild_id, next_track))
+
     def _song_finished_callback(self, error: Optional[Exception], guild_id: int):
-        state = self._get_guild_state(guild_id)
+        # 音声プレイヤーのスレッドから呼ばれるので、ギルドの状態は作らず、ループ側の処理は call_soon_threadsafe で渡す
+        state = self.guild_states.get(guild_id)
         if not state:
             return
+        state.last_track_end_time = time.monotonic()
+        self.bot.loop.call_soon_threadsafe(state.update_activity)
 
         # シーク中の場合はコールバックを無視
         if state.is_seeking:
@@ -467,7 +1141,7 @@ class MusicCog(commands.Cog, name="music_cog"):
                 )
 
         if finished_track and state.loop_mode == LoopMode.ALL:
-            asyncio.run_coroutine_threadsafe(state.queue.put(finished_track), self.bot.loop)
+            self.bot.loop.call_soon_threadsafe(self._enqueue, state, finished_track)
 
         asyncio.run_coroutine_threadsafe(self._play_next_song(guild_id), self.bot.loop)
 
@@ -495,8 +1169,24 @@ class MusicCog(commands.Cog, name="music_cog"):
             await state.cleanup_voice_client()
             if state.auto_leave_task and not state.auto_leave_task.done():
                 state.auto_leave_task.cancel()
+            if state.prefetch_task and not state.prefetch_task.done():
+                state.prefetch_task.cancel()
+            if state.seek_task and not state.seek_task.done():
+                state.seek_task.cancel()
+            if state.gapless_task and not state.gapless_task.done():
+                state.gapless_task.cancel()
+            state.prepared_track = None
+            state.cancel_ingest()
             await state.clear_queue()
+            self.connected_guilds.discard(guild_id)
+            # 循環参照を残さないように、参照をここで明示的に切る (gc.collect に頼らない)
+            state.current_track = None
+            state.voice_client = None
+            state._on_activity = None
             del self.guild_states[guild_id]
+            if not self.bot.is_closed():
+                # Bot の終了時は再起動後に再開できるよう保存済みのセッションを残す
+                self._mark_session_dirty(guild_id)
             guild = self.bot.get_guild(guild_id)
             logger.info(f"Guild {guild_id} ({guild.name if guild else ''}): State cleaned up")
 
@@ -504,12 +1194,30 @@ class MusicCog(commands.Cog, name="music_cog"):
     async def on_ready(self):
         logger.info(f"{self.bot.user.name} の MusicCog が正常にロードされました。")
 
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.display_name != after.display_name:
+            self.requester_names.invalidate(after.guild.id, after.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User):
+        if before.display_name != after.display_name:
+            self.requester_names.invalidate_user(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.requester_names.invalidate_guild(guild.id)
+
     @commands.Cog.listener()
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState,
                                     after: discord.VoiceState):
-        if member.id == self.bot.user.id and before.channel and not after.channel:
-            await self._cleanup_guild_state(member.guild.id)
-            return
+        if member.id == self.bot.user.id:
+            if after.channel:
+                self.connected_guilds.add(member.guild.id)
+            elif before.channel:
+                self.connected_guilds.discard(member.guild.id)
+                await self._cleanup_guild_state(member.guild.id)
+                return
 
         guild_id = member.guild.id
         if guild_id not in self.guild_states:
@@ -548,8 +1256,21 @@ class MusicCog(commands.Cog, name="music_cog"):
                                       max_size=self.max_queue_size)
             return
 
+        if self.stream_playlists and ytdlp_wrapper.is_playlist_query(query):
+            if state.ingest_task and not state.ingest_task.done():
+                await self._send_response(interaction, "error_playing", ephemeral=True,
+                                          error="別のプレイリストを読み込み中です。")
+                return
+            # 最初の曲が届いた時点で再生を始め、残りはバックグラウンドでキューに追加する
+            state.ingest_task = asyncio.create_task(
+                self._ingest_playlist(interaction, interaction.guild.id, query))
+            return
+
         try:
-            extracted_media = await extract_audio_data(query, shuffle_playlist=False)
+            # プレイリスト全体の読み込みは、他のギルドの再生開始より後に回す
+            priority = Priority.BACKFILL if ytdlp_wrapper.is_playlist_query(query) else Priority.PLAY
+            extracted_media = await extract_audio_data(query, shuffle_playlist=False, guild_id=interaction.guild.id,
+                                                       priority=priority)
         except Exception as e:
             await self._handle_error(interaction, e)
             return
@@ -559,11 +1280,12 @@ class MusicCog(commands.Cog, name="music_cog"):
             return
 
         tracks = extracted_media if isinstance(extracted_media, list) else [extracted_media]
+        self.requester_names.remember(interaction.user, interaction.guild.id)
         added_count, first_track = 0, None
         for track in tracks:
             if state.queue.qsize() < self.max_queue_size:
                 track.requester_id = interaction.user.id
-                await state.queue.put(track)
+                self._enqueue(state, track)
                 if added_count == 0:
                     first_track = track
                 added_count += 1
@@ -582,6 +1304,96 @@ class MusicCog(commands.Cog, name="music_cog"):
         if not state.is_playing:
             await self._play_next_song(interaction.guild.id)
 
+    @play_slash.autocomplete('query')
+    async def play_query_autocomplete(self, interaction: discord.Interaction,
+                                      current: str) -> List[app_commands.Choice[str]]:
+        # Discord は3秒以内の応答を求めるので、ここではメモリ上の候補だけを返し、検索は裏で行う
+        if "://" in current:
+            return []
+        guild_id = interaction.guild.id if interaction.guild else None
+        results = self.suggestions.suggest(current, guild_id, limit=25)
+        if self.autocomplete_search and len(normalize_prefix(current)) >= 3:
+            searched = self.search_suggestions.get(current)
+            if searched is None:
+                self._schedule_autocomplete_search(interaction.user.id, current, guild_id)
+                searched = self._nearest_search_suggestions(current)
+            results += searched
+        choices, seen = [], set()
+        for title, url in results:
+            if url in seen:
+                continue
+            seen.add(url)
+            # value は100文字までなので、長いURLはタイトルで検索させる
+            choices.append(app_commands.Choice(name=title[:100], value=url if len(url) <= 100 else title[:100]))
+            if len(choices) >= 25:
+                break
+        return choices
+
+    def _nearest_search_suggestions(self, current: str) -> list:
+        """入力の途中までで検索済みの結果のうち、最も長く一致するもの (この入力の検索が終わるまでの代わり)"""
+        key = normalize_prefix(current)
+        for end in range(len(key) - 1, 2, -1):
+            results = self.search_suggestions.get(key[:end])
+            if results is not None:
+                return results
+        return []
+
+    def _schedule_autocomplete_search(self, user_id: int, current: str, guild_id: Optional[int]):
+        """入力が autocomplete_debounce 秒止まったら検索する (同じユーザーの前の入力の検索は取り消す)"""
+        previous = self._autocomplete_tasks.get(user_id)
+        if previous and not previous.done():
+            previous.cancel()
+        self._autocomplete_tasks[user_id] = asyncio.create_task(
+            self._run_autocomplete_search(user_id, current, guild_id))
+
+    async def _run_autocomplete_search(self, user_id: int, current: str, guild_id: Optional[int]):
+        try:
+            await asyncio.sleep(self.autocomplete_debounce)
+            results = await ytdlp_wrapper.search(current, limit=5, guild_id=guild_id)
+            self.search_suggestions.put(current, results)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self._autocomplete_tasks.get(user_id) is asyncio.current_task():
+                del self._autocomplete_tasks[user_id]
+
+    async def _ingest_playlist(self, interaction: discord.Interaction, guild_id: int, query: str):
+        """プレイリストを取得しながら順次キューに追加する (/stop や /leave でキャンセル)"""
+        added_count = 0
+        started = time.perf_counter()
+        self.requester_names.remember(interaction.user, guild_id)
+        stream = ytdlp_wrapper.extract_stream(query, max_items=self.max_queue_size)
+        try:
+            async for track in stream:
+                state = self.guild_states.get(guild_id)
+                if not state:
+                    break
+                if state.queue.qsize() >= self.max_queue_size:
+                    await self._send_response(interaction, "max_queue_size_reached", ephemeral=True,
+                                              max_size=self.max_queue_size)
+                    break
+                track.requester_id = interaction.user.id
+                self._enqueue(state, track)
+                added_count += 1
+                if added_count == 1:
+                    logger.info(f"Guild {guild_id}: First playlist entry ready in "
+                                f"{(time.perf_counter() - started) * 1000:.0f} ms")
+                    if not state.is_playing:
+                        asyncio.create_task(self._play_next_song(guild_id))
+        except asyncio.CancelledError:
+            logger.info(f"Guild {guild_id}: Playlist ingestion cancelled after {added_count} tracks")
+            raise
+        except Exception as e:
+            await self._handle_error(interaction, e)
+            return
+        finally:
+            await stream.aclose()
+
+        if added_count == 0:
+            await self._send_response(interaction, "search_no_results", ephemeral=True, query=query)
+        else:
+            await self._send_response(interaction, "added_playlist_to_queue", count=added_count)
+
     @app_commands.command(name="seek", description="再生位置を指定した時刻に移動します。")
     @app_commands.describe(time="移動先の時刻 (例: 1:30 または 90 秒)")
     async def seek_slash(self, interaction: discord.Interaction, time: str):
@@ -609,18 +1421,8 @@ class MusicCog(commands.Cog, name="music_cog"):
                                       duration=format_duration(state.current_track.duration))
             return
 
-        # シーク中フラグを設定してコールバックを無視
-        state.is_seeking = True
-
-        # 現在の再生を停止して、新しい位置から再生
-        if state.voice_client and state.voice_client.is_playing():
-            state.voice_client.stop()
-
-        # 少し待機してからシーク再生を開始
-        await asyncio.sleep(0.1)
-
         await self._send_response(interaction, "seeked_to_position", position=format_duration(seek_seconds))
-        await self._play_next_song(interaction.guild.id, seek_seconds=seek_seconds)
+        self._request_seek(interaction.guild.id, seek_seconds)
 
     @app_commands.command(name="pause", description="再生を一時停止します。")
     async def pause_slash(self, interaction: discord.Interaction):
@@ -688,6 +1490,7 @@ class MusicCog(commands.Cog, name="music_cog"):
             return
 
         state.loop_mode = LoopMode.OFF
+        state.cancel_ingest()
         await state.clear_queue()
         if state.voice_client and state.voice_client.is_playing():
             state.voice_client.stop()
@@ -710,6 +1513,7 @@ class MusicCog(commands.Cog, name="music_cog"):
                 await self._send_response(interaction, "bot_not_in_voice_channel", ephemeral=True)
                 return
             await self._send_response(interaction, "leaving_voice_channel")
+            state.cancel_ingest()
             await state.cleanup_voice_client()
 
     @app_commands.command(name="queue", description="現在の再生キューを表示します。")
@@ -725,9 +1529,8 @@ class MusicCog(commands.Cog, name="music_cog"):
             return
 
         items_per_page = 10
-        queue_list = list(state.queue._queue)
-        total_items = len(queue_list)
-        total_pages = math.ceil(len(queue_list) / items_per_page) if len(queue_list) > 0 else 1
+        total_items = state.queue.qsize()
+        total_pages = math.ceil(total_items / items_per_page) if total_items > 0 else 1
 
         async def get_page_embed(page_num: int):
             embed = discord.Embed(
@@ -738,27 +1541,20 @@ class MusicCog(commands.Cog, name="music_cog"):
             lines = []
             if page_num == 1 and state.current_track:
                 track = state.current_track
-                try:
-                    requester = interaction.guild.get_member(track.requester_id) or await self.bot.fetch_user(
-                        track.requester_id)
-                except:
-                    requester = None
+                requester_name = await self._requester_name(interaction.guild.id, track.requester_id)
                 status_icon = '▶️' if state.is_playing else '⏸️'
                 current_pos = state.get_current_position()
                 lines.append(
-                    f"**{status_icon} {track.title}** (`{format_duration(current_pos)}/{format_duration(track.duration)}`) - Req: **{requester.display_name if requester else '不明'}**\n"
+                    f"**{status_icon} {track.title}** (`{format_duration(current_pos)}/{format_duration(track.duration)}`) - Req: **{requester_name}**\n"
                 )
 
             start = (page_num - 1) * items_per_page
             end = (page_num - 1) * items_per_page + items_per_page
-            for i, track in enumerate(queue_list[start:end], start=start + 1):
-                try:
-                    requester = interaction.guild.get_member(track.requester_id) or await self.bot.fetch_user(
-                        track.requester_id)
-                except:
-                    requester = None
+            for i, track in enumerate(state.queue.slice(start, end), start=start + 1):
+                requester_name = await self._requester_name(interaction.guild.id, track.requester_id)
+                pending_mark = " ⏳" if ytdlp_wrapper.is_download_pending(track) else ""
                 lines.append(
-                    f"`{i}.` **{track.title}** (`{format_duration(track.duration)}`) - Req: **{requester.display_name if requester else '不明'}**"
+                    f"`{i}.` **{track.title}**{pending_mark} (`{format_duration(track.duration)}`) - Req: **{requester_name}**"
                 )
 
             embed.description = "\n".join(lines) if lines else "このページには曲がありません。"
@@ -894,11 +1690,7 @@ class MusicCog(commands.Cog, name="music_cog"):
 
         track = state.current_track
         status_icon = "▶️" if state.is_playing else ("⏸️" if state.is_paused else "⏹️")
-        try:
-            requester = interaction.guild.get_member(track.requester_id) or await self.bot.fetch_user(
-                track.requester_id)
-        except:
-            requester = None
+        requester_name = await self._requester_name(interaction.guild.id, track.requester_id)
 
         current_pos = state.get_current_position()
         progress_bar = self._create_progress_bar(current_pos, track.duration)
@@ -906,7 +1698,7 @@ class MusicCog(commands.Cog, name="music_cog"):
         embed = discord.Embed(
             title=f"{status_icon} {track.title}",
             url=track.url,
-            description=f"{progress_bar}\n`{format_duration(current_pos)}` / `{format_duration(track.duration)}`\n\nリクエスト: **{requester.display_name if requester else '不明'}**\nURL: {track.url}\nループモード: `{state.loop_mode.name.lower()}`",
+            description=f"{progress_bar}\n`{format_duration(current_pos)}` / `{format_duration(track.duration)}`\n\nリクエスト: **{requester_name}**\nURL: {track.url}\nループモード: `{state.loop_mode.name.lower()}`",
             color=discord.Color.green() if state.is_playing else (
                 discord.Color.orange() if state.is_paused else discord.Color.light_grey())
         )
@@ -934,11 +1726,8 @@ class MusicCog(commands.Cog, name="music_cog"):
                                       error="シャッフルするにはキューに2曲以上必要です。")
             return
 
-        queue_list = list(state.queue._queue)
-        random.shuffle(queue_list)
-        state.queue = asyncio.Queue()
-        for item in queue_list:
-            await state.queue.put(item)
+        state.queue.shuffle()
+        self._schedule_gapless(interaction.guild.id)
         await self._send_response(interaction, "queue_shuffled")
 
     @app_commands.command(name="clear", description="再生キューを空にします（再生中の曲は停止しません）。")
@@ -947,7 +1736,9 @@ class MusicCog(commands.Cog, name="music_cog"):
         if not state or not await self._ensure_voice(interaction, connect_if_not_in=False):
             return
 
+        state.cancel_ingest()
         await state.clear_queue()
+        self._schedule_gapless(interaction.guild.id)
         await self._send_response(interaction, "queue_cleared")
 
     @app_commands.command(name="remove", description="キューから指定した番号の曲を削除します。")
@@ -967,13 +1758,34 @@ class MusicCog(commands.Cog, name="music_cog"):
             await self._send_response(interaction, "invalid_queue_number", ephemeral=True)
             return
 
-        queue_list = list(state.queue._queue)
-        removed_track = queue_list.pop(actual_index)
-        state.queue = asyncio.Queue()
-        for item in queue_list:
-            await state.queue.put(item)
+        removed_track = state.queue.remove(actual_index)
+        if actual_index == 0:
+            self._schedule_gapless(interaction.guild.id)
         await self._send_response(interaction, "song_removed", title=removed_track.title)
 
+    @app_commands.command(name="move", description="キュー内の曲を指定した位置に移動します。")
+    @app_commands.describe(index="移動したい曲のキュー番号", position="移動先のキュー番号")
+    async def move_slash(self, interaction: discord.Interaction, index: app_commands.Range[int, 1, None],
+                         position: app_commands.Range[int, 1, None]):
+        state = self._get_guild_state(interaction.guild.id)
+        if not state:
+            await interaction.response.send_message("エラーが発生しました。", ephemeral=True)
+            return
+
+        if state.queue.empty():
+            await interaction.response.send_message(self.exception_handler.get_message("queue_empty"), ephemeral=True)
+            return
+
+        queue_size = state.queue.qsize()
+        if not (1 <= index <= queue_size) or not (1 <= position <= queue_size):
+            await self._send_response(interaction, "invalid_queue_number", ephemeral=True)
+            return
+
+        moved_track = state.queue.move(index - 1, position - 1)
+        if index == 1 or position == 1:
+            self._schedule_gapless(interaction.guild.id)
+        await self._send_response(interaction, "song_moved", title=moved_track.title, position=position)
+
     @app_commands.command(name="volume", description="音量を変更します (0-200)。")
     @app_commands.describe(level="設定したい音量レベル (0-200)")
     async def volume_slash(self, interaction: discord.Interaction, level: app_commands.Range[int, 0, 200]):
@@ -984,9 +1796,21 @@ class MusicCog(commands.Cog, name="music_cog"):
 
         state.volume = level / 100.0
         state.update_activity()
-        if state.voice_client and state.voice_client.source:
-            state.voice_client.source.volume = state.volume
+        source = state.voice_client.source if state.voice_client else None
+        if isinstance(source, GaplessSource):
+            source = source.current
+        if isinstance(source, TimedAudioSource):
+            source = source.original
+        if isinstance(source, discord.PCMVolumeTransformer):
+            source.volume = state.volume
+            # 準備済みの次の曲は以前の音量で作られている
+            self._schedule_gapless(interaction.guild.id)
+            await self._send_response(interaction, "volume_set", volume=level)
+            return
         await self._send_response(interaction, "volume_set", volume=level)
+        if source is not None and state.current_track:
+            # Opus出力では音量をffmpegのフィルタで掛けているので、現在位置から作り直す
+            await self._restart_current_source(interaction.guild.id)
 
     @app_commands.command(name="loop", description="ループ再生モードを設定します。")
     @app_commands.describe(mode="ループのモードを選択してください。")
@@ -1005,6 +1829,7 @@ class MusicCog(commands.Cog, name="music_cog"):
         mode_map = {"off": LoopMode.OFF, "one": LoopMode.ONE, "all": LoopMode.ALL}
         state.loop_mode = mode_map.get(mode.value, LoopMode.OFF)
         state.update_activity()
+        self._schedule_gapless(interaction.guild.id)
         await self._send_response(interaction, f"loop_{mode.value}")
 
     @app_commands.command(name="join", description="ボットをあなたのいるボイスチャンネルに接続します。")
@@ -1013,6 +1838,37 @@ class MusicCog(commands.Cog, name="music_cog"):
         if await self._ensure_voice(interaction, connect_if_not_in=True):
             await interaction.followup.send(self.exception_handler.get_message("already_connected"), ephemeral=True)
 
+    @app_commands.command(name="music_cache", description="音楽キャッシュのヒット率とディスク使用量を表示します。")
+    async def music_cache_slash(self, interaction: discord.Interaction):
+        embed = discord.Embed(title="🗄️ 音楽キャッシュ / Music Cache", color=discord.Color.blue())
+        audio_stats = ytdlp_wrapper.audio_cache_stats()
+        if audio_stats:
+            embed.add_field(
+                name="音声ファイル / Audio",
+                value=(f"ヒット率: **{audio_stats['hit_rate']:.1%}** "
+                       f"({audio_stats['hits']}/{audio_stats['hits'] + audio_stats['misses']})\n"
+                       f"使用量: **{audio_stats['bytes'] / 1024 ** 2:.1f} MiB** / "
+                       f"{audio_stats['max_bytes'] / 1024 ** 3:.1f} GiB ({audio_stats['files']} files)\n"
+                       f"削除済み: {audio_stats['evictions']}"),
+                inline=False)
+        else:
+            embed.add_field(name="音声ファイル / Audio", value="無効 / Disabled", inline=False)
+        metadata_stats = ytdlp_wrapper.metadata_cache_stats()
+        if metadata_stats:
+            embed.add_field(
+                name="曲情報 / Metadata",
+                value=(f"ヒット率: **{metadata_stats['hit_rate']:.1%}** "
+                       f"({metadata_stats['hits']}/{metadata_stats['hits'] + metadata_stats['misses']})"),
+                inline=False)
+        scheduler_stats = ytdlp_wrapper.scheduler_stats()
+        embed.add_field(
+            name="抽出の待ち時間 / Extraction wait",
+            value="\n".join(
+                f"{name}: 平均 **{c['avg_wait_ms']:.0f} ms** / p95 {c['p95_wait_ms']:.0f} ms (待機 {c['pending']})"
+                for name, c in scheduler_stats['classes'].items()),
+            inline=False)
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
     @app_commands.command(name="music_help", description="音楽機能のコマンド一覧と使い方を表示します。")
     async def music_help_slash(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=False)
@@ -1038,11 +1894,15 @@ class MusicCog(commands.Cog, name="music_cog"):
                 {"name": "shuffle", "args": "", "desc_ja": "キューをシャッフル", "desc_en": "Shuffle queue"},
                 {"name": "clear", "args": "", "desc_ja": "キューをクリア", "desc_en": "Clear queue"},
                 {"name": "remove", "args": "<queue number>", "desc_ja": "指定番号の曲を削除", "desc_en": "Remove song"},
+                {"name": "move", "args": "<queue number> <position>", "desc_ja": "指定番号の曲を移動", "desc_en": "Move song"},
                 {"name": "loop", "args": "<off|one|all>", "desc_ja": "ループモード設定", "desc_en": "Set loop mode"}
             ],
             "🔊 ボイスチャンネル / Voice Channel": [
                 {"name": "join", "args": "", "desc_ja": "VCに接続", "desc_en": "Join VC"},
                 {"name": "leave", "args": "", "desc_en": "Leave VC", "desc_ja": "VCから切断"}
+            ],
+            "📊 情報 / Info": [
+                {"name": "music_cache", "args": "", "desc_ja": "キャッシュの状態", "desc_en": "Cache statistics"}
             ]
         }
         cog_command_names = {cmd.name for cmd in self.__cog_app_commands__}
@@ -0,0 +1,56 @@
+# ARONA/music/requester_cache.py
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import discord
+
+
+class RequesterNameCache:
+    """リクエストしたユーザーの表示名を (guild_id, user_id) ごとに保持するLRUキャッシュ
+
+    曲の追加時に interaction.user から登録しておき、キュー表示や再生開始通知で
+    get_member / fetch_user (REST) を呼ばずに済ませる。
+    """
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max(max_entries, 1)
+        self._names: OrderedDict[Tuple[int, int], str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def put(self, guild_id: int, user_id: int, display_name: str):
+        key = (guild_id, user_id)
+        self._names[key] = display_name
+        self._names.move_to_end(key)
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
+
+    def remember(self, user: discord.abc.User, guild_id: int):
+        self.put(guild_id, user.id, user.display_name)
+
+    def get(self, guild_id: int, user_id: int) -> Optional[str]:
+        key = (guild_id, user_id)
+        name = self._names.get(key)
+        if name is None:
+            self.misses += 1
+            return None
+        self._names.move_to_end(key)
+        self.hits += 1
+        return name
+
+    def invalidate(self, guild_id: int, user_id: int):
+        self._names.pop((guild_id, user_id), None)
+
+    def invalidate_user(self, user_id: int):
+        """グローバルな名前の変更時など、全ギルド分の登録を消す"""
+        for key in [k for k in self._names if k[1] == user_id]:
+            del self._names[key]
+
+    def invalidate_guild(self, guild_id: int):
+        for key in [k for k in self._names if k[0] == guild_id]:
+            del self._names[key]
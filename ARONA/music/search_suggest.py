@@ -0,0 +1,140 @@
+# ARONA/music/search_suggest.py
+from __future__ import annotations
+
+import bisect
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def normalize_prefix(text: str) -> str:
+    """入力途中の文字列とタイトルを同じ形に揃える (大文字小文字と連続空白の違いを無視)"""
+    return " ".join(text.casefold().split())
+
+
+@dataclass(slots=True)
+class _Entry:
+    title: str
+    url: str
+    plays: int = 0
+    last_played: float = 0.0
+    guild_plays: Dict[int, int] = field(default_factory=dict)
+    keys: Tuple[str, ...] = ()
+
+
+class SuggestionIndex:
+    """/play の入力補完に使う、再生したことのある曲タイトルの前方一致インデックス
+
+    タイトルの各単語から始まる文字列をソート済みのリストに入れておき、二分探索で前方一致する曲を探す。
+    候補はそのギルドでの再生回数、全体での再生回数、最近再生した順に並べる。
+    上限を超えたら最後に再生されたのが古い曲から削除する。
+
+    ギルドを指定した場合、既定ではそのギルドで再生した曲だけを候補にする (他のサーバーの再生履歴を見せない)。
+    share_across_guilds=True なら全ギルドの曲と、再生回数のない読み込み済みの曲も候補にする。
+    """
+
+    def __init__(self, max_entries: int = 5000, share_across_guilds: bool = False):
+        self.max_entries = max(max_entries, 1)
+        self.share_across_guilds = share_across_guilds
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()  # url -> 曲 (最後に再生した順)
+        self._keys: List[Tuple[str, str]] = []  # (正規化したタイトルの途中から末尾まで, url)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _index_keys(title: str) -> Tuple[str, ...]:
+        words = normalize_prefix(title).split(" ")
+        return tuple(dict.fromkeys(" ".join(words[i:]) for i in range(len(words)) if words[i]))
+
+    def _insert(self, entry: _Entry):
+        for key in entry.keys:
+            bisect.insort(self._keys, (key, entry.url))
+
+    def _remove(self, entry: _Entry):
+        for key in entry.keys:
+            i = bisect.bisect_left(self._keys, (key, entry.url))
+            if i < len(self._keys) and self._keys[i] == (key, entry.url):
+                del self._keys[i]
+
+    def add(self, title: str, url: str, guild_id: Optional[int] = None, played: bool = True):
+        """曲を登録する。played=False は再生回数を数えずに候補として登録するだけ (起動時の読み込みなど)"""
+        if not title or not url:
+            return
+        entry = self._entries.get(url)
+        if entry is None:
+            entry = _Entry(title=title, url=url, keys=self._index_keys(title))
+            self._entries[url] = entry
+            self._insert(entry)
+        elif entry.title != title:
+            self._remove(entry)
+            entry.title, entry.keys = title, self._index_keys(title)
+            self._insert(entry)
+        if played:
+            entry.plays += 1
+            entry.last_played = time.time()
+            if guild_id is not None:
+                entry.guild_plays[guild_id] = entry.guild_plays.get(guild_id, 0) + 1
+            self._entries.move_to_end(url)
+        while len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._remove(evicted)
+
+    def load(self, records: Iterable[Tuple[str, str]]):
+        """(タイトル, URL) の一覧を再生回数0の候補として登録する"""
+        for title, url in records:
+            if url not in self._entries:
+                self.add(title, url, played=False)
+
+    def suggest(self, prefix: str, guild_id: Optional[int] = None, limit: int = 25) -> List[Tuple[str, str]]:
+        """前方一致する曲を (タイトル, URL) で返す"""
+        prefix = normalize_prefix(prefix)
+        if not prefix:
+            # 未入力ならそのギルドで最近再生した曲
+            recent = [e for e in reversed(self._entries.values()) if guild_id is None or guild_id in e.guild_plays]
+            return [(e.title, e.url) for e in recent[:limit]]
+        only_guild = guild_id is not None and not self.share_across_guilds
+        matches: Dict[str, _Entry] = {}
+        i = bisect.bisect_left(self._keys, (prefix, ""))
+        # 短い入力で大量に一致しても応答が遅れないよう、並べ替える候補の数に上限を設ける
+        while i < len(self._keys) and self._keys[i][0].startswith(prefix) and len(matches) < limit * 20:
+            url = self._keys[i][1]
+            entry = self._entries[url]
+            if not only_guild or guild_id in entry.guild_plays:
+                matches[url] = entry
+            i += 1
+        ranked = sorted(
+            matches.values(),
+            key=lambda e: (e.guild_plays.get(guild_id, 0) if guild_id is not None else 0, e.plays, e.last_played),
+            reverse=True,
+        )
+        return [(e.title, e.url) for e in ranked[:limit]]
+
+
+class SearchResultCache:
+    """入力途中の文字列に対する検索結果 (タイトル, URL) を一定時間保持するLRUキャッシュ"""
+
+    def __init__(self, ttl_seconds: float = 3600, max_entries: int = 2000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(max_entries, 1)
+        self._results: OrderedDict[str, Tuple[float, List[Tuple[str, str]]]] = OrderedDict()
+
+    def get(self, prefix: str) -> Optional[List[Tuple[str, str]]]:
+        key = normalize_prefix(prefix)
+        cached = self._results.get(key)
+        if cached is None:
+            return None
+        stored_at, results = cached
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return results
+
+    def put(self, prefix: str, results: List[Tuple[str, str]]):
+        key = normalize_prefix(prefix)
+        self._results[key] = (time.monotonic(), results)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
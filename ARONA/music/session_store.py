@@ -0,0 +1,71 @@
+# ARONA/music/session_store.py
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+
+class SessionStore:
+    """ギルドごとの再生セッション (キュー・再生位置・ループ・音量) を保存するSQLiteストア
+
+    再起動や Cog の再読み込み後に再生を再開するために使う。書き込みはまとめて1トランザクションで行い、
+    呼び出し側は executor から使う。
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " guild_id INTEGER PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def save_many(self, snapshots: Dict[int, Optional[dict]]):
+        """スナップショットをまとめて保存する。値が None のギルドは削除する"""
+        now = time.time()
+        upserts = [
+            (guild_id, json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")), now)
+            for guild_id, snapshot in snapshots.items() if snapshot is not None
+        ]
+        deletes = [(guild_id,) for guild_id, snapshot in snapshots.items() if snapshot is None]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO sessions (guild_id, payload, updated_at) VALUES (?, ?, ?)", upserts
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM sessions WHERE guild_id = ?", deletes)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def load_all(self, max_age_seconds: Optional[float] = None) -> Dict[int, dict]:
+        """保存済みのセッションを読み込む。古すぎるものは削除して返さない"""
+        with self._lock:
+            if max_age_seconds is not None:
+                self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - max_age_seconds,))
+            rows = self._conn.execute("SELECT guild_id, payload FROM sessions").fetchall()
+        sessions = {}
+        for guild_id, payload in rows:
+            try:
+                sessions[guild_id] = json.loads(payload)
+            except json.JSONDecodeError:
+                continue
+        return sessions
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
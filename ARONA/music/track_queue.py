@@ -0,0 +1,120 @@
+# ARONA/music/track_queue.py
+from __future__ import annotations
+
+import asyncio
+import itertools
+import random
+from collections import deque
+from typing import Deque, Generic, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class TrackQueue(Generic[T]):
+    """ギルドの再生キュー (asyncio.Queue の内部に触らずに並べ替えや削除ができる)
+
+    先頭/末尾への追加と取り出しはO(1)。シャッフル・削除・移動はキューオブジェクトを
+    作り直さずにその場で行うので、get() で待っているタスクもそのまま動き続ける。
+    """
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._items: Deque[T] = deque()
+        self._not_empty = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._items)
+
+    def __getitem__(self, index: int) -> T:
+        return self._items[index]
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._items)
+
+    def _changed(self):
+        if self._items:
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+
+    def put_nowait(self, item: T):
+        self._items.append(item)
+        self._not_empty.set()
+
+    async def put(self, item: T):
+        # asyncio.Queue と同じ呼び出し方ができるように残している (上限はCog側で判定する)
+        self.put_nowait(item)
+
+    def put_front(self, item: T):
+        """次に再生されるように先頭へ追加"""
+        self._items.appendleft(item)
+        self._not_empty.set()
+
+    def extend(self, items) -> int:
+        before = len(self._items)
+        self._items.extend(items)
+        self._changed()
+        return len(self._items) - before
+
+    def get_nowait(self) -> T:
+        if not self._items:
+            raise asyncio.QueueEmpty
+        item = self._items.popleft()
+        self._changed()
+        return item
+
+    async def get(self) -> T:
+        while not self._items:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+    async def wait_not_empty(self):
+        """キューに曲が入るまで待つ"""
+        await self._not_empty.wait()
+
+    def peek(self, count: int) -> List[T]:
+        """先頭からcount件を取り出さずに返す"""
+        return list(itertools.islice(self._items, count))
+
+    def slice(self, start: int, stop: int) -> List[T]:
+        """ページ表示用に start..stop の範囲を返す"""
+        start = max(start, 0)
+        if start >= len(self._items):
+            return []
+        return list(itertools.islice(self._items, start, max(stop, start)))
+
+    def shuffle(self, rng: Optional[random.Random] = None):
+        # deque の添字アクセスは中央付近でO(n)なので、一度リストにしてから戻す
+        items = list(self._items)
+        (rng or random).shuffle(items)
+        self._items.clear()
+        self._items.extend(items)
+
+    def remove(self, index: int) -> T:
+        """index番目 (0始まり) の曲を削除して返す。範囲外なら IndexError"""
+        if not -len(self._items) <= index < len(self._items):
+            raise IndexError("queue index out of range")
+        item = self._items[index]
+        del self._items[index]
+        self._changed()
+        return item
+
+    def move(self, src: int, dst: int) -> T:
+        """src番目の曲をdst番目へ移動する"""
+        item = self.remove(src)
+        self._items.insert(min(max(dst, 0), len(self._items)), item)
+        self._not_empty.set()
+        return item
+
+    def clear(self):
+        self._items.clear()
+        self._not_empty.clear()
@@ -0,0 +1,121 @@
+# ARONA/music/ytdl_pool.py
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import yt_dlp
+
+
+def _profile_key(profile: str, opts: dict) -> Tuple[str, str]:
+    # オプションが同じなら同じインスタンスを使い回せる (ログイン情報などが違えば別扱い)
+    return profile, json.dumps(opts, sort_keys=True, default=str)
+
+
+class YoutubeDLPool:
+    """オプションのプロファイルごとに温まった YoutubeDL インスタンスを保持する専用スレッドプール
+
+    YoutubeDL はスレッドセーフではないため、1インスタンスは同時に1スレッドだけが借りる。
+    ループの既定executorとは分けて、他のブロッキング処理と取り合わないようにする。
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max(max_workers, 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ytdl")
+        self._idle: Dict[Tuple[str, str], List[yt_dlp.YoutubeDL]] = {}
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.instances_created = 0
+        self.instances_reused = 0
+        self.wait_time_total = 0.0
+        self.run_time_total = 0.0
+
+    def _borrow(self, key: Tuple[str, str], opts: dict) -> yt_dlp.YoutubeDL:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.instances_reused += 1
+                return idle.pop()
+            self.instances_created += 1
+        return yt_dlp.YoutubeDL(opts)
+
+    def _release(self, key: Tuple[str, str], ytdl: yt_dlp.YoutubeDL):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_workers:
+                idle.append(ytdl)
+                return
+        ytdl.close()
+
+    def _run_sync(self, key: Tuple[str, str], opts: dict, fn: Callable[[yt_dlp.YoutubeDL], Any], submitted: float):
+        started = time.perf_counter()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_time_total += started - submitted
+        ytdl = self._borrow(key, opts)
+        broken = False
+        try:
+            return fn(ytdl)
+        except BaseException:
+            # 例外後のインスタンスは内部状態が不明なので破棄する
+            broken = True
+            raise
+        finally:
+            if broken:
+                ytdl.close()
+            else:
+                self._release(key, ytdl)
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.run_time_total += time.perf_counter() - started
+
+    async def run(self, profile: str, opts: dict, fn: Callable[[yt_dlp.YoutubeDL], Any]):
+        """プロファイルの YoutubeDL を借りて fn(ytdl) を専用スレッドで実行する"""
+        loop = asyncio.get_running_loop()
+        key = _profile_key(profile, opts)
+        with self._lock:
+            self.queued += 1
+        return await loop.run_in_executor(self._executor, self._run_sync, key, opts, fn, time.perf_counter())
+
+    async def warm(self, profile: str, opts: dict, count: int = 1):
+        """エクストラクタの読み込みを先に済ませたインスタンスを用意しておく"""
+        def _create():
+            ytdl = yt_dlp.YoutubeDL(opts)
+            with self._lock:
+                self.instances_created += 1
+            self._release(_profile_key(profile, opts), ytdl)
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _create) for _ in range(count)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queue_depth": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "instances_created": self.instances_created,
+                "instances_reused": self.instances_reused,
+                "idle_instances": sum(len(v) for v in self._idle.values()),
+                "avg_wait_ms": self.wait_time_total / self.completed * 1000 if self.completed else 0.0,
+                "avg_run_ms": self.run_time_total / self.completed * 1000 if self.completed else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            instances = [y for idle in self._idle.values() for y in idle]
+            self._idle.clear()
+        for ytdl in instances:
+            try:
+                ytdl.close()
+            except Exception:
+                pass
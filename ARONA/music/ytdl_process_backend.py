@@ -0,0 +1,132 @@
+# ARONA/music/ytdl_process_backend.py
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+# ワーカープロセス内で使い回す YoutubeDL (プロセスごとに保持)
+_worker_instances: Dict[str, yt_dlp.YoutubeDL] = {}
+
+# ワーカーの入れ替え (ProcessPoolExecutor の max_tasks_per_child) に必要なバージョン
+MIN_PYTHON = (3, 11)
+
+
+def unavailable_reason() -> Optional[str]:
+    """この環境でプロセスバックエンドが使えない理由。使えるなら None"""
+    if sys.version_info < MIN_PYTHON:
+        return f"Python {MIN_PYTHON[0]}.{MIN_PYTHON[1]} 以降が必要です (現在 {sys.version.split()[0]})"
+    if "spawn" not in multiprocessing.get_all_start_methods():
+        return "spawn でプロセスを起動できません"
+    return None
+
+
+def run_extract_info(ytdl: yt_dlp.YoutubeDL, query: str, download: bool = False,
+                     cookie_path: Optional[str] = None) -> Optional[dict]:
+    """extract_info を実行し、必要ならクッキーを保存する (スレッド/プロセス共通)"""
+    info = ytdl.extract_info(query, download=download)
+    if cookie_path:
+        # ニコニコ動画のクッキー保存 (ログイン成功時など)
+        try:
+            ytdl.cookiejar.save(cookie_path, ignore_discard=True, ignore_expires=True)
+        except Exception as e_cookie:
+            print(f"[ytdlp_wrapper Warning] ニコニコ動画のクッキー保存に失敗: {e_cookie}")
+    return info
+
+
+def _worker_extract_info(profile: str, opts: dict, query: str, download: bool,
+                         cookie_path: Optional[str]) -> Optional[dict]:
+    """ワーカープロセスで実行される抽出処理。親へは pickle 可能な素の dict を返す"""
+    key = profile + json.dumps(opts, sort_keys=True, default=str)
+    ytdl = _worker_instances.get(key)
+    if ytdl is None:
+        ytdl = _worker_instances[key] = yt_dlp.YoutubeDL(opts)
+    try:
+        info = run_extract_info(ytdl, query, download, cookie_path)
+    except Exception as e:
+        # yt-dlp の例外は pickle できないことがあるので文字列化して返す
+        _worker_instances.pop(key, None)
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    if info is None:
+        return None
+    # プレイリストの遅延リストなどを通常のリスト・dictに変換する
+    return yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=False)
+
+
+class ProcessExtractionBackend:
+    """yt-dlp の抽出をプロセスプールで行うバックエンド (GILの競合を避ける)
+
+    一定件数ごとにワーカーを入れ替えてメモリの増加を抑え、ワーカーが落ちた場合は
+    プールを作り直して1回だけ再試行する。
+    """
+
+    def __init__(self, max_workers: int = 2, max_tasks_per_child: int = 50, max_concurrency: Optional[int] = None):
+        self.max_workers = max(max_workers, 1)
+        self.max_tasks_per_child = max(max_tasks_per_child, 1)
+        self.max_concurrency = max(max_concurrency or self.max_workers, 1)
+        self._executor = self._create_executor()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.completed = 0
+        self.crashes = 0
+        self.run_time_total = 0.0
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # max_tasks_per_child は fork と併用できないので spawn を明示する。
+        # spawn のワーカーは起動スクリプト (__main__) を読み込み直すため、起動処理は
+        # if __name__ == '__main__': の中に置くこと (main.py はそうなっている)
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=self.max_tasks_per_child,
+        )
+
+    def _restart(self, broken: ProcessPoolExecutor):
+        if self._executor is broken:
+            self.crashes += 1
+            logger.warning("yt-dlp process pool crashed; restarting workers")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._create_executor()
+
+    async def extract_info(self, profile: str, opts: dict, query: str, download: bool = False,
+                           cookie_path: Optional[str] = None) -> Optional[dict]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            started = time.perf_counter()
+            for attempt in range(2):
+                executor = self._executor
+                try:
+                    result = await loop.run_in_executor(
+                        executor, _worker_extract_info, profile, opts, query, download, cookie_path
+                    )
+                    break
+                except BrokenProcessPool:
+                    self._restart(executor)
+                    if attempt == 1:
+                        raise RuntimeError("yt-dlp ワーカープロセスが異常終了しました")
+            self.completed += 1
+            self.run_time_total += time.perf_counter() - started
+            return result
+
+    def stats(self) -> dict:
+        return {
+            "backend": "process",
+            "workers": self.max_workers,
+            "completed": self.completed,
+            "crashes": self.crashes,
+            "avg_run_ms": self.run_time_total / self.completed * 1000 if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -2,17 +2,33 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import random
-from dataclasses import dataclass
+import re
+import shutil
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Union, Optional
+from typing import AsyncIterator, Dict, List, Tuple, Union, Optional
+from urllib.parse import parse_qs, urlsplit
 
 import yt_dlp
 from yt_dlp.utils import ExtractorError  # 個別のエラーをキャッチするため
 
+from ARONA.music.audio_cache import AudioCache
+from ARONA.music.extraction_scheduler import ExtractionScheduler, Priority
+from ARONA.music.metadata_cache import MetadataCache, normalize_query
+from ARONA.music.ytdl_pool import YoutubeDLPool
+from ARONA.music.ytdl_process_backend import ProcessExtractionBackend, run_extract_info, unavailable_reason
+
 
 # Trackクラス定義
-@dataclass
+# キューに数千曲積まれることがあるので __slots__ で1件あたりのメモリを抑える
+@dataclass(slots=True)
 class Track:
     url: str
     title: str
@@ -21,6 +37,29 @@ class Track:
     stream_url: Optional[str] = None
     requester_id: Optional[int] = None
     original_query: Optional[str] = None
+    stream_expires_at: Optional[float] = None  # stream_url の有効期限 (UNIX時刻)
+    acodec: Optional[str] = None  # stream_url の音声コーデック (yt-dlpのメタデータ)
+
+    def __post_init__(self):
+        # 同じプレイリスト・同じ検索から作られた曲でクエリ文字列を共有する
+        if self.original_query is not None:
+            self.original_query = sys.intern(self.original_query)
+
+    def drop_stream(self):
+        """期限付きのストリームURLを手放す (ローカルファイルは保持)。再生前に ensure_stream で再取得される"""
+        if self.stream_url and "://" in self.stream_url:
+            self.stream_url = None
+            self.stream_expires_at = None
+            self.acodec = None
+
+    def approx_size(self) -> int:
+        """このTrackが保持しているおおよそのバイト数 (共有されるクエリ文字列は含めない)"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.url) + sys.getsizeof(self.title)
+        if self.thumbnail:
+            size += sys.getsizeof(self.thumbnail)
+        if self.stream_url:
+            size += sys.getsizeof(self.stream_url)
+        return size
 
 
 # --- yt-dlp 設定 ---
@@ -31,6 +70,37 @@ NICO_COOKIE_PATH = Path("./nico_cookies.txt")
 if not NICO_COOKIE_PATH.exists():
     NICO_COOKIE_PATH.touch(exist_ok=True)  # 存在しない場合のみ作成
 
+# extract結果のメタデータキャッシュ (configure で無効化・TTL変更が可能)
+METADATA_CACHE: Optional[MetadataCache] = MetadataCache(CACHE_DIR / "metadata.sqlite3")
+_metadata_refreshing: set[str] = set()
+
+# YoutubeDL インスタンスを使い回す専用スレッドプール (プロファイル: stream / nico / ensure)
+YTDL_POOL = YoutubeDLPool()
+# music.extraction_backend: process のときに使うプロセスプール (thread のときは None)
+PROCESS_BACKEND: Optional[ProcessExtractionBackend] = None
+
+# ストリームURLの期限に対する余裕 (秒)。再生中に期限切れにならないよう曲の長さも加味する
+STREAM_EXPIRY_MARGIN = 60
+_EXPIRE_PATH_RE = re.compile(r"/expire/(\d+)")
+
+# 抽出処理の実行順 (優先度とギルド間の公平性) と、同じURLの同時実行の共有を管理する
+SCHEDULER = ExtractionScheduler(4)
+
+# よく再生される曲の音声ファイルを保存するキャッシュ (configure で有効化)
+AUDIO_CACHE: Optional[AudioCache] = None
+AUDIO_CACHE_MAX_TRACK_SECONDS = 20 * 60
+_audio_cache_downloads: set[str] = set()
+# ダウンロードは1件に数分かかることがあるので、抽出用のプール・スケジューラーとは別の小さなプールで行う
+_audio_cache_executor: Optional[ThreadPoolExecutor] = None
+_audio_cache_concurrency = 2
+
+# ニコニコ動画のバックグラウンドダウンロード (全ギルド共通で同時実行数を制限)
+NICO_DOWNLOAD_CONCURRENCY = 2
+NICO_BUFFER_BYTES = 512 * 1024  # この量がダウンロードされたら途中のファイルから再生を始める
+_nico_executor: Optional[ThreadPoolExecutor] = None  # 抽出用のプールとは別の、ダウンロード専用のプール
+# ダウンロードごとの作業フォルダ。再生中のffmpegが読んでいるファイルは名前を変えない (下記参照)
+NICO_WORK_DIR = CACHE_DIR / "nico_downloads"
+
 COMMON_YTDL_OPTS: dict = {
     "format": "bestaudio[acodec=opus][asr=48000]/bestaudio/best",  # Opusを優先、48kHz
     "noplaylist": False,  # プレイリストも処理対象
@@ -49,6 +119,366 @@ COMMON_YTDL_OPTS: dict = {
 }
 
 
+def configure(music_config: dict):
+    """MusicCogのmusic設定をラッパーに反映する"""
+    global METADATA_CACHE
+    if not music_config.get("metadata_cache_enabled", True):
+        if METADATA_CACHE is not None:
+            METADATA_CACHE.close()
+        METADATA_CACHE = None
+    elif METADATA_CACHE is not None:
+        METADATA_CACHE.ttl_seconds = float(music_config.get("metadata_cache_ttl_hours", 168)) * 3600
+
+    global YTDL_POOL
+    workers = int(music_config.get("ytdl_workers", 4))
+    if workers != YTDL_POOL.max_workers:
+        YTDL_POOL.shutdown()
+        YTDL_POOL = YoutubeDLPool(workers)
+    # 待ちはスケジューラー側で優先度順に並べたいので、既定ではプールのスレッド数と同じにする
+    SCHEDULER.max_concurrency = max(int(music_config.get("extraction_concurrency") or workers), 1)
+    SCHEDULER.reserved_for_play = max(int(music_config.get("extraction_reserved_for_play", 1)), 0)
+
+    global PLAYLIST_STREAM_CONCURRENCY, _playlist_executor
+    playlist_concurrency = max(int(music_config.get("playlist_stream_concurrency", 2)), 1)
+    if playlist_concurrency != PLAYLIST_STREAM_CONCURRENCY and _playlist_executor is not None:
+        _playlist_executor.shutdown(wait=False)
+        _playlist_executor = None
+    PLAYLIST_STREAM_CONCURRENCY = playlist_concurrency
+
+    global AUDIO_CACHE, AUDIO_CACHE_MAX_TRACK_SECONDS, _audio_cache_concurrency
+    if music_config.get("audio_cache_enabled", True):
+        max_bytes = int(float(music_config.get("audio_cache_max_gb", 5)) * 1024 ** 3)
+        download_after = int(music_config.get("audio_cache_download_after_plays", 3))
+        if AUDIO_CACHE is None:
+            AUDIO_CACHE = AudioCache(CACHE_DIR / "audio", max_bytes, download_after)
+        else:
+            AUDIO_CACHE.max_bytes, AUDIO_CACHE.download_after_plays = max_bytes, max(download_after, 1)
+        AUDIO_CACHE_MAX_TRACK_SECONDS = int(music_config.get("audio_cache_max_track_minutes", 20)) * 60
+        concurrency = max(int(music_config.get("audio_cache_download_concurrency", 2)), 1)
+        if concurrency != _audio_cache_concurrency:
+            _audio_cache_concurrency = concurrency
+            _reset_audio_cache_executor()
+    elif AUDIO_CACHE is not None:
+        AUDIO_CACHE.close()
+        AUDIO_CACHE = None
+        _reset_audio_cache_executor()
+
+    global NICO_DOWNLOAD_CONCURRENCY, NICO_BUFFER_BYTES, _nico_executor
+    nico_concurrency = max(int(music_config.get("nico_download_concurrency", 2)), 1)
+    if nico_concurrency != NICO_DOWNLOAD_CONCURRENCY and _nico_executor is not None:
+        _nico_executor.shutdown(wait=False)
+        _nico_executor = None
+    NICO_DOWNLOAD_CONCURRENCY = nico_concurrency
+    if not _nico_downloads:
+        # 前回の実行で残った作業フォルダ (中断されたダウンロードなど) を片付ける
+        shutil.rmtree(NICO_WORK_DIR, ignore_errors=True)
+    NICO_BUFFER_BYTES = int(music_config.get("nico_buffer_kb", 512)) * 1024
+
+    global PROCESS_BACKEND
+    if str(music_config.get("extraction_backend", "thread")).lower() == "process":
+        if PROCESS_BACKEND is None:
+            # 使えない環境では設定の読み込みを失敗させず、スレッドのバックエンドで動かす
+            reason = unavailable_reason()
+            if reason is None:
+                try:
+                    PROCESS_BACKEND = ProcessExtractionBackend(
+                        max_workers=int(music_config.get("process_workers", 2)),
+                        max_tasks_per_child=int(music_config.get("process_max_tasks_per_child", 50)),
+                        max_concurrency=music_config.get("process_max_concurrency"),
+                    )
+                except (OSError, ValueError, TypeError, NotImplementedError) as e:
+                    reason = str(e)
+            if reason is not None:
+                print(f"[ytdlp_wrapper Warning] extraction_backend: process は使用できないため thread で動作します: {reason}")
+    elif PROCESS_BACKEND is not None:
+        PROCESS_BACKEND.shutdown()
+        PROCESS_BACKEND = None
+
+
+async def warm_ytdl_pool():
+    """よく使うプロファイルの YoutubeDL を先に生成しておく"""
+    if PROCESS_BACKEND is not None:
+        return
+    await YTDL_POOL.warm("stream", _build_stream_opts(50))
+    await YTDL_POOL.warm("ensure", _build_ensure_opts())
+
+
+def ytdl_pool_stats() -> dict:
+    if PROCESS_BACKEND is not None:
+        return PROCESS_BACKEND.stats()
+    return YTDL_POOL.stats()
+
+
+async def _extract_info(profile: str, opts: dict, query: str, *, download: bool = False,
+                        cookie_path: Optional[str] = None, guild_id: Optional[int] = None,
+                        priority: Priority = Priority.PLAY) -> Optional[dict]:
+    """
+    設定されたバックエンド (スレッド or プロセス) で extract_info を実行する。
+    実行順はスケジューラーが決め、同じプロファイル・同じURLの実行中の処理があれば結果を共有する。
+    """
+    async def _run():
+        if PROCESS_BACKEND is not None:
+            return await PROCESS_BACKEND.extract_info(profile, opts, query, download, cookie_path)
+        return await YTDL_POOL.run(
+            profile, opts, functools.partial(run_extract_info, query=query, download=download, cookie_path=cookie_path)
+        )
+
+    key = (profile, normalize_query(query), download)
+    return await SCHEDULER.run(_run, key=key, guild_id=guild_id, priority=priority)
+
+
+def scheduler_stats() -> dict:
+    return SCHEDULER.stats()
+
+
+def metadata_cache_stats() -> Optional[dict]:
+    return METADATA_CACHE.stats() if METADATA_CACHE is not None else None
+
+
+def prune_metadata_cache():
+    """期限切れのメタデータを削除する (ブロッキングなのでexecutorから呼ぶ)"""
+    if METADATA_CACHE is not None:
+        METADATA_CACHE.prune()
+
+
+async def _get_cached_metadata(query: str):
+    """メタデータキャッシュを引く。SQLiteの読み込みと put / prune 中のロック待ちでループを止めないよう executor で行う"""
+    cache = METADATA_CACHE
+    if cache is None:
+        return None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, cache.get, query)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] メタデータキャッシュの読み込みに失敗: {e} (Query: {query})")
+        return None
+
+
+# --- ローカル音声キャッシュ ---
+def _find_cached_audio(track: Track) -> Optional[Tuple[str, Optional[str]]]:
+    # SQLiteの読み書きとファイルの確認を行うので executor から呼ぶ
+    if track.stream_url and "://" not in track.stream_url and Path(track.stream_url).is_file():
+        return track.stream_url, track.acodec
+    return AUDIO_CACHE.lookup(track.url)
+
+
+async def use_cached_audio(track: Track) -> bool:
+    """キャッシュ済みの音声ファイルがあれば track の再生元をそのファイルに差し替える"""
+    if AUDIO_CACHE is None or not track.url:
+        return False
+    try:
+        cached = await asyncio.get_running_loop().run_in_executor(None, _find_cached_audio, track)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] 音声キャッシュの確認に失敗: {e} (Track: {track.title})")
+        return False
+    if cached is None:
+        return False
+    track.stream_url, track.acodec = cached
+    track.stream_expires_at = None
+    return True
+
+
+async def note_play(track: Track):
+    """再生回数を記録し、規定回数に達した曲を裏でダウンロードしてキャッシュする"""
+    if AUDIO_CACHE is None or not track.url or "://" not in track.url:
+        return
+    if not 0 < track.duration <= AUDIO_CACHE_MAX_TRACK_SECONDS:  # ライブ配信や長すぎる曲は対象外
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        should_download = await loop.run_in_executor(None, AUDIO_CACHE.record_play, track.url)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] 再生回数の記録に失敗: {e} (Track: {track.title})")
+        return
+    if should_download and track.url not in _audio_cache_downloads:
+        asyncio.create_task(_download_to_cache(track.url, track.title))
+
+
+def _build_cache_download_opts() -> dict:
+    opts = COMMON_YTDL_OPTS.copy()
+    opts.update({
+        "format": "bestaudio[acodec=opus]/bestaudio/best",
+        "noplaylist": True,
+        "extract_flat": False,
+        "skip_download": False,
+        "paths": {"home": str(CACHE_DIR / "audio" / "tmp")},
+        "outtmpl": {"default": "%(id)s.%(ext)s"},
+        "postprocessors": [],  # 変換せずに元の形式 (Opusならそのまま送信できる) で保存する
+    })
+    return opts
+
+
+def _reset_audio_cache_executor():
+    global _audio_cache_executor
+    if _audio_cache_executor is not None:
+        _audio_cache_executor.shutdown(wait=False)
+        _audio_cache_executor = None
+
+
+def _cache_download_sync(url: str) -> Optional[dict]:
+    # 使い捨ての YoutubeDL で十分 (生成にかかる時間はダウンロードに比べて無視できる)
+    with yt_dlp.YoutubeDL(_build_cache_download_opts()) as ytdl:
+        return run_extract_info(ytdl, url, download=True)
+
+
+async def _download_to_cache(url: str, title: str):
+    global _audio_cache_executor
+    if _audio_cache_executor is None:
+        _audio_cache_executor = ThreadPoolExecutor(max_workers=_audio_cache_concurrency,
+                                                   thread_name_prefix="audio-cache")
+    _audio_cache_downloads.add(url)
+    try:
+        loop = asyncio.get_running_loop()
+        info = await loop.run_in_executor(_audio_cache_executor, _cache_download_sync, url)
+        if not info or AUDIO_CACHE is None:
+            return
+        downloads = info.get("requested_downloads") or [info]
+        file_path = downloads[0].get("filepath")
+        if not file_path or not Path(file_path).is_file():
+            return
+        await loop.run_in_executor(None, AUDIO_CACHE.store, url, file_path, _intern_codec(info.get("acodec")))
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] 音声キャッシュのダウンロードに失敗: {e} (Track: {title})")
+    finally:
+        _audio_cache_downloads.discard(url)
+
+
+@dataclass
+class _NicoDownload:
+    title: str
+    future: asyncio.Future  # 完了時に最終的なファイルパスが入る
+    buffered: asyncio.Event = field(default_factory=asyncio.Event)  # 再生を始められる量が揃った (または終了した)
+    partial_path: Optional[str] = None
+    downloaded_bytes: int = 0
+    final_path: Optional[str] = None
+
+
+_nico_downloads: Dict[str, _NicoDownload] = {}
+
+
+def is_download_pending(track: Track) -> bool:
+    """ニコニコ動画のダウンロードがまだ終わっていない曲か"""
+    return track.url in _nico_downloads
+
+
+def _start_nico_download(track: Track, opts: dict, cookie_path: Optional[str]):
+    if track.url in _nico_downloads:
+        return
+    download = _NicoDownload(track.title, asyncio.get_running_loop().create_future())
+    _nico_downloads[track.url] = download
+    asyncio.create_task(_run_nico_download(track.url, download, opts, cookie_path))
+
+
+def _nico_download_sync(ytdl: yt_dlp.YoutubeDL, url: str, download: _NicoDownload,
+                        loop: asyncio.AbstractEventLoop, cookie_path: Optional[str]) -> Optional[str]:
+    """ワーカースレッドでダウンロードし、進捗と実際の出力パスをフックで受け取る"""
+    def on_progress(d: dict):
+        if d.get("status") != "downloading":
+            return
+        download.partial_path = d.get("tmpfilename") or d.get("filename")
+        download.downloaded_bytes = d.get("downloaded_bytes") or 0
+        if download.downloaded_bytes >= NICO_BUFFER_BYTES and not download.buffered.is_set():
+            loop.call_soon_threadsafe(download.buffered.set)
+
+    def on_postprocess(d: dict):
+        # 音声抽出・ファイル移動などの後処理が終わるたびに info_dict の filepath が実際のパスになる
+        if d.get("status") == "finished":
+            download.final_path = (d.get("info_dict") or {}).get("filepath") or download.final_path
+
+    ytdl.add_progress_hook(on_progress)
+    ytdl.add_postprocessor_hook(on_postprocess)
+    info = run_extract_info(ytdl, url, download=True, cookie_path=cookie_path)
+    if not download.final_path and info:
+        # 既にダウンロード済みで後処理が走らなかった場合
+        download.final_path = (info.get("requested_downloads") or [info])[0].get("filepath")
+    return download.final_path
+
+
+def _nico_download_fresh(opts: dict, url: str, download: _NicoDownload, loop: asyncio.AbstractEventLoop,
+                         cookie_path: Optional[str]) -> Optional[str]:
+    # フックは呼び出しごとに異なるので、使い回しのインスタンスではなく使い捨てのものを使う
+    with yt_dlp.YoutubeDL(opts) as ytdl:
+        return _nico_download_sync(ytdl, url, download, loop, cookie_path)
+
+
+async def _remove_work_dir(work_dir: Path, attempts: int = 20, interval: float = 30):
+    """作業フォルダを削除する。Windowsではffmpegが開いている間は削除できないので、閉じられるまで再試行する"""
+    loop = asyncio.get_running_loop()
+    for _ in range(attempts):
+        await loop.run_in_executor(None, functools.partial(shutil.rmtree, work_dir, ignore_errors=True))
+        if not work_dir.exists():
+            return
+        await asyncio.sleep(interval)
+    print(f"[ytdlp_wrapper Warning] ダウンロードの作業フォルダを削除できませんでした: {work_dir}")
+
+
+async def _run_nico_download(url: str, download: _NicoDownload, opts: dict, cookie_path: Optional[str]):
+    global _nico_executor
+    if _nico_executor is None:
+        _nico_executor = ThreadPoolExecutor(max_workers=NICO_DOWNLOAD_CONCURRENCY, thread_name_prefix="nico-dl")
+    loop = asyncio.get_running_loop()
+    # 再生はダウンロード途中のファイルを ffmpeg (-follow 1) で読む。Windowsでは開かれているファイルの
+    # 名前を変えられず、yt-dlp が .part から最終的な名前へ変更する時点で失敗するため、.part を使わずに
+    # 最終的な名前へ直接書き込む。中断された書きかけのファイルを完成品と誤認しないよう、作業フォルダは毎回新しくする
+    work_dir = NICO_WORK_DIR / uuid.uuid4().hex
+    opts = {**opts, "nopart": True, "paths": {"home": str(work_dir)}}
+    try:
+        path = await loop.run_in_executor(
+            _nico_executor, _nico_download_fresh, opts, url, download, loop, cookie_path)
+        if not path or not Path(path).is_file():
+            raise RuntimeError("ダウンロードしたファイルが見つかりません")
+        if AUDIO_CACHE is not None:
+            # 容量上限の対象にするためキャッシュの管理下に移す
+            path = await loop.run_in_executor(None, AUDIO_CACHE.store, url, path, "opus")
+        else:
+            # 作業フォルダは削除するので、変換後のファイルだけキャッシュフォルダへ移す
+            dest = CACHE_DIR / Path(path).name
+            await loop.run_in_executor(None, shutil.move, path, dest)
+            path = str(dest)
+        download.future.set_result(path)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Error] ニコニコ動画のダウンロードに失敗: {e} (Track: {download.title})")
+        download.future.set_exception(e)
+        download.future.exception()  # 待機者がいなくても警告を出さない
+    finally:
+        _nico_downloads.pop(url, None)
+        download.buffered.set()
+        # 変換前のファイルは再生中のffmpegが開いていることがある (Windowsでは yt-dlp の削除も警告だけで失敗する)
+        asyncio.create_task(_remove_work_dir(work_dir))
+
+
+async def prepare_nico_track(track: Track, timeout: float = 20) -> bool:
+    """
+    ダウンロード中のニコニコ動画を再生できる状態にする。
+    完了していれば保存先のファイル、未完了でも十分にバッファされていれば途中のファイルを再生元にする。
+    途中のファイルから再生する場合は True を返す (ffmpeg に追記を待たせる必要がある)。
+    """
+    download = _nico_downloads.get(track.url)
+    if download is None:
+        return False
+    try:
+        await asyncio.wait_for(asyncio.shield(download.buffered.wait()), timeout)
+    except asyncio.TimeoutError:
+        return False
+    if download.future.done():
+        if download.future.exception() is None:
+            track.stream_url, track.acodec, track.stream_expires_at = download.future.result(), "opus", None
+        return False
+    if download.partial_path and Path(download.partial_path).is_file():
+        track.stream_url, track.acodec, track.stream_expires_at = download.partial_path, None, None
+        return True
+    return False
+
+
+def audio_cache_stats() -> Optional[dict]:
+    return AUDIO_CACHE.stats() if AUDIO_CACHE is not None else None
+
+
+def prune_audio_cache():
+    """消えたファイルの索引を整理する (ブロッキングなのでexecutorから呼ぶ)"""
+    if AUDIO_CACHE is not None:
+        AUDIO_CACHE.prune()
+
+
 # --- ヘルパー関数 ---
 def _is_nico(url_or_query: str) -> bool:
     """ニコニコ動画のURLか判定する"""
@@ -83,41 +513,42 @@ def _build_nico_opts(login: bool, nico_email: Optional[str] = None, nico_passwor
     return opts
 
 
-def _inject_local_path_nico(entry: dict, ytdl: yt_dlp.YoutubeDL):
-    """ニコニコ動画ダウンロード後のローカルパスをentryに注入する"""
-    if not entry: return
-    # yt-dlpがダウンロード後に設定するキーは 'filepath'
-    if entry.get('filepath'):
-        entry['local_path'] = entry['filepath']
-    elif entry.get("requested_downloads"):  # requested_downloads はダウンロード前の情報
-        # 実際にダウンロードされたファイルパスを取得する必要がある
-        # ここでは、ダウンロードが成功したと仮定してファイル名を構築するが、確実ではない
-        # より確実なのは、yt-dlpのダウンロード後の情報を使うこと
-        try:
-            # yt-dlp.prepare_filename(entry) は entry['ext'] などが必要
-            # ダウンロード後のファイルパスは ytdl.prepare_filename よりも
-            # 実際に生成されたファイルパスを特定する方が良い
-            # ここでは 'id' と 'ext' (通常 'opus') から推測する
-            if 'id' in entry and 'acodec' in entry:  # 'opus' など
-                entry['local_path'] = str(CACHE_DIR / f"{entry['id']}.{entry['acodec']}")
-            elif 'id' in entry and 'ext' in entry:
-                entry['local_path'] = str(CACHE_DIR / f"{entry['id']}.{entry['ext']}")
-
-        except Exception as e:
-            print(f"[ytdlp_wrapper Warning] ニコニコ動画のローカルパス注入に失敗: {e} (Entry: {entry.get('id')})")
-            pass  # 失敗しても処理は続ける
-
-
-def _entry_to_track(entry: dict, *, is_downloaded_nico: bool = False) -> Track:
+def parse_stream_expiry(stream_url: Optional[str]) -> Optional[float]:
+    """googlevideo などのストリームURLに含まれる expire パラメータを読み取る"""
+    if not stream_url or "://" not in stream_url:
+        return None
+    try:
+        parts = urlsplit(stream_url)
+        values = parse_qs(parts.query).get("expire")
+        if values:
+            return float(values[0])
+        match = _EXPIRE_PATH_RE.search(parts.path)
+        if match:
+            return float(match.group(1))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+def is_stream_valid(track: Track, margin: Optional[float] = None) -> bool:
+    """stream_url が再生を終えるまで有効と見込めるか"""
+    if not track.stream_url:
+        return False
+    if Path(track.stream_url).is_file():
+        return True
+    if track.stream_expires_at is None:
+        return False
+    if margin is None:
+        margin = STREAM_EXPIRY_MARGIN + (track.duration or 0)
+    return track.stream_expires_at - time.time() > margin
+
+
+def _entry_to_track(entry: dict, *, original_query: Optional[str] = None) -> Track:
     """yt-dlpのentry辞書をTrackオブジェクトに変換する"""
-    stream_url_val = None
-    if is_downloaded_nico:
-        stream_url_val = entry.get("local_path")  # ニコニコダウンロード後はローカルパス
-
-    if not stream_url_val:  # ストリーミング再生の場合 (YouTubeなど、またはニコニコのローカルパス取得失敗時)
-        # 'url' は format で選択されたオーディオストリームのURL
-        # 'webpage_url' は元の動画ページのURL
-        stream_url_val = entry.get("url")  # ストリームURL (YouTube等)
+    # 'url' は format で選択されたオーディオストリームのURL
+    # 'webpage_url' は元の動画ページのURL
+    # (ニコニコ動画のダウンロード後のローカルパスは _run_nico_download が設定する)
+    stream_url_val = entry.get("url")  # ストリームURL (YouTube等)
 
     # タイトルがない場合は "タイトルなし" や "id" を使う
     title = entry.get("title", "タイトルなし")
@@ -130,14 +561,30 @@ def _entry_to_track(entry: dict, *, is_downloaded_nico: bool = False) -> Track:
         duration=int(entry.get("duration") or 0),
         thumbnail=entry.get("thumbnail"),
         stream_url=stream_url_val,
-        original_query=entry.get("original_query")  # extractで設定されていれば
+        original_query=original_query,
+        stream_expires_at=parse_stream_expiry(stream_url_val),
+        acodec=_intern_codec(entry.get("acodec")),
     )
 
 
-async def ensure_stream(track: Track, ytdl_opts_override: Optional[dict] = None) -> Track:
+def _intern_codec(acodec: Optional[str]) -> Optional[str]:
+    if not acodec or acodec == "none":
+        return None
+    return sys.intern(acodec)
+
+
+def is_opus_stream(track: Track) -> bool:
+    """stream_url が Opus 音声で、デコードせずに Discord へ送れるか"""
+    return bool(track.stream_url and track.acodec and track.acodec.startswith("opus"))
+
+
+async def ensure_stream(track: Track, ytdl_opts_override: Optional[dict] = None, *,
+                        guild_id: Optional[int] = None, priority: Priority = Priority.PLAY) -> Track:
     """
     Trackオブジェクトのstream_urlを検証・更新する (主にYouTubeなどの時間経過で無効になるURL用)。
     ローカルファイルやニコニコのダウンロード済みファイルは対象外。
+    先読みと再生開始が同じ曲を同時に解決しようとした場合はスケジューラーが1回の抽出にまとめ、
+    先読みの処理が待機中なら再生の優先度に繰り上げる。
     """
     if not track.url or track.url.startswith("ytsearch:"):  # 元のURLがないか検索クエリなら解決不可
         return track
@@ -145,8 +592,14 @@ async def ensure_stream(track: Track, ytdl_opts_override: Optional[dict] = None)
         return track
     if _is_nico(track.url) and track.stream_url and Path(track.stream_url).exists():  # ニコニコダウンロード済みもOK
         return track
+    if is_stream_valid(track):  # 期限内のストリームURLは再抽出しない
+        return track
 
-    loop = asyncio.get_running_loop()
+    await _resolve_stream(track, ytdl_opts_override, guild_id=guild_id, priority=priority)
+    return track
+
+
+def _build_ensure_opts(ytdl_opts_override: Optional[dict] = None) -> dict:
     # ensure_stream 用のオプション (常に単一動画の詳細情報を取得、ダウンロードはしない)
     opts_for_ensure = (ytdl_opts_override or COMMON_YTDL_OPTS).copy()
     opts_for_ensure.update({
@@ -154,22 +607,26 @@ async def ensure_stream(track: Track, ytdl_opts_override: Optional[dict] = None)
         "extract_flat": False,  # 詳細情報を得るためにFalse
         "skip_download": True,
     })
+    return opts_for_ensure
 
-    def _run_extract_single_info():
-        with yt_dlp.YoutubeDL(opts_for_ensure) as ytdl:
-            # extract_info で対象URLの最新情報を取得
-            info = ytdl.extract_info(track.url, download=False)
-            # プレイリストが返ってくる場合もあるので、最初の要素をチェック
-            entry_to_use = info.get("entries")[0] if info.get("_type") == "playlist" and info.get("entries") else info
 
-            # _entry_to_track を使って新しいストリームURLを取得
-            temp_track = _entry_to_track(entry_to_use, is_downloaded_nico=False)  # ストリームURLを期待
-            return temp_track.stream_url
+async def _resolve_stream(track: Track, ytdl_opts_override: Optional[dict] = None, *,
+                          guild_id: Optional[int] = None, priority: Priority = Priority.PLAY):
+    opts_for_ensure = _build_ensure_opts(ytdl_opts_override)
 
     try:
-        new_stream_url = await loop.run_in_executor(None, _run_extract_single_info)
-        if new_stream_url:
-            track.stream_url = new_stream_url
+        # extract_info で対象URLの最新情報を取得
+        info = await _extract_info("ensure", opts_for_ensure, track.url, guild_id=guild_id, priority=priority)
+        resolved = None
+        if info:
+            # プレイリストが返ってくる場合もあるので、最初の要素をチェック
+            entry_to_use = info.get("entries")[0] if info.get("_type") == "playlist" and info.get("entries") else info
+            # _entry_to_track を使って新しいストリームURLを取得
+            resolved = _entry_to_track(entry_to_use)  # ストリームURLを期待
+        if resolved and resolved.stream_url:
+            track.stream_url = resolved.stream_url
+            track.stream_expires_at = resolved.stream_expires_at
+            track.acodec = resolved.acodec
         else:
             # ストリームURLが取得できなかった場合 (元のURLが無効になっている可能性など)
             # ここではエラーを発生させるか、stream_urlをNoneのままにする
@@ -183,7 +640,87 @@ async def ensure_stream(track: Track, ytdl_opts_override: Optional[dict] = None)
     except Exception as e:
         print(f"[ytdlp_wrapper Error] ストリーム解決中に予期せぬエラー: {e} (Track: {track.title})")
         raise RuntimeError(f"ストリーム解決中の予期せぬエラー: {e}") from e
-    return track
+
+
+def _entry_to_cache_record(entry: dict) -> dict:
+    """キャッシュに保存するメタデータだけを取り出す (ストリームURLは期限付きなので保存しない)"""
+    track = _entry_to_track(entry)
+    return {
+        "webpage_url": track.url,
+        "title": track.title,
+        "duration": track.duration,
+        "thumbnail": track.thumbnail,
+    }
+
+
+def track_to_record(track: Track) -> list:
+    """セッション保存用の小さな表現 (期限付きのストリームURLは含めない)"""
+    return [track.url, track.title, track.duration, track.thumbnail, track.requester_id, track.original_query]
+
+
+def track_from_record(record: list) -> Track:
+    url, title, duration, thumbnail, requester_id, original_query = record
+    return Track(url=url, title=title, duration=duration, thumbnail=thumbnail,
+                 requester_id=requester_id, original_query=original_query)
+
+
+def _tracks_from_cache(records: List[dict], query: str) -> List[Track]:
+    return [
+        Track(
+            url=r.get("webpage_url") or query,
+            title=r.get("title") or "タイトルなし",
+            duration=int(r.get("duration") or 0),
+            thumbnail=r.get("thumbnail"),
+            original_query=query,
+        )
+        for r in records
+    ]
+
+
+def _store_metadata(query: str, info: dict):
+    """抽出結果をキャッシュに保存する (executor上で実行)"""
+    if METADATA_CACHE is None or not info:
+        return
+    try:
+        if "entries" in info and info["entries"]:
+            entries = [e for e in info["entries"] if e]
+            records = [_entry_to_cache_record(e) for e in entries]
+            METADATA_CACHE.put(query, records, is_playlist=True)
+            # 単一結果の検索は動画URLでも引けるようにしておく
+            if len(records) == 1 and records[0]["webpage_url"].startswith("http"):
+                METADATA_CACHE.put(records[0]["webpage_url"], records, is_playlist=False)
+        else:
+            record = _entry_to_cache_record(info)
+            METADATA_CACHE.put(query, [record], is_playlist=False)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] メタデータキャッシュの保存に失敗: {e} (Query: {query})")
+
+
+def _build_stream_opts(max_playlist_items: Optional[int]) -> dict:
+    # YouTubeやその他のサイト: ストリーミング用情報を取得
+    ytdl_final_opts = COMMON_YTDL_OPTS.copy()
+    ytdl_final_opts["skip_download"] = True  # ストリーミングなのでダウンロードしない
+    ytdl_final_opts["noplaylist"] = False  # プレイリストも処理
+    ytdl_final_opts["extract_flat"] = "in_playlist"
+    if max_playlist_items and max_playlist_items > 0:
+        ytdl_final_opts["playlistend"] = max_playlist_items  # プレイリストの読み込み上限
+    return ytdl_final_opts
+
+
+async def _refresh_metadata(query: str, max_playlist_items: Optional[int]):
+    """キャッシュ済みのメタデータをバックグラウンドで更新する"""
+    key = query
+    if key in _metadata_refreshing:
+        return
+    _metadata_refreshing.add(key)
+    try:
+        info = await _extract_info("stream", _build_stream_opts(max_playlist_items), query,
+                                   priority=Priority.BACKGROUND)
+        await asyncio.get_running_loop().run_in_executor(None, _store_metadata, query, info)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] メタデータのバックグラウンド更新に失敗: {e} (Query: {query})")
+    finally:
+        _metadata_refreshing.discard(key)
 
 
 async def extract(
@@ -192,88 +729,233 @@ async def extract(
         shuffle_playlist: bool = False,
         nico_email: Optional[str] = None,
         nico_password: Optional[str] = None,
-        max_playlist_items: Optional[int] = 50
+        max_playlist_items: Optional[int] = 50,
+        guild_id: Optional[int] = None,
+        priority: Priority = Priority.PLAY
 ) -> Union[Track, List[Track], None]:
     """
     与えられたクエリ (URLまたは検索語) から音楽情報を抽出する。
     ニコニコ動画の場合はダウンロードを試み、それ以外はストリームURLを取得する。
+    キャッシュ済みのクエリはネットワークアクセスなしで返し、古くなっていれば裏で更新する。
     """
     loop = asyncio.get_running_loop()
     is_nico_query = _is_nico(query)
-
+    use_metadata_cache = METADATA_CACHE is not None and not is_nico_query
+
+    if use_metadata_cache:
+        cached = await _get_cached_metadata(query)
+        if cached is not None:
+            records, is_playlist, age = cached
+            if METADATA_CACHE is not None and age > METADATA_CACHE.ttl_seconds / 2:
+                asyncio.create_task(_refresh_metadata(query, max_playlist_items))
+            tracks = _tracks_from_cache(records, query)
+            if not tracks:
+                return None
+            if not is_playlist:
+                return tracks[0]
+            if shuffle_playlist:
+                random.shuffle(tracks)
+            return tracks
     ytdl_final_opts: dict
-    perform_download_for_nico = False
+    nico_download_opts: Optional[dict] = None
 
     if is_nico_query:
-        # ニコニコ動画の場合: ダウンロードを試みる
-        ytdl_final_opts = _build_nico_opts(
+        # ニコニコ動画の場合: ここでは情報だけ取得し、ダウンロードは裏で行う
+        nico_download_opts = _build_nico_opts(
             login=bool(not NICO_COOKIE_PATH.stat().st_size or (nico_email and nico_password)),
             nico_email=nico_email,
             nico_password=nico_password
         )
-        perform_download_for_nico = True
+        ytdl_final_opts = {**nico_download_opts, "skip_download": True}
         # ニコニコ動画のプレイリストは特殊なので、extract_flat=False, noplaylist=True で1件ずつ処理する想定
         # もしニコニコのプレイリストURLが渡された場合、yt-dlpは個々の動画情報を取得する
-        # ytdl_final_opts["noplaylist"] = False # プレイリストも展開させる
-        # ytdl_final_opts["extract_flat"] = "in_playlist" # ただしフラットに
     else:
-        # YouTubeやその他のサイト: ストリーミング用情報を取得
-        ytdl_final_opts = COMMON_YTDL_OPTS.copy()
-        ytdl_final_opts["skip_download"] = True  # ストリーミングなのでダウンロードしない
-        ytdl_final_opts["noplaylist"] = False  # プレイリストも処理
-        ytdl_final_opts["extract_flat"] = "in_playlist"
-        if max_playlist_items and max_playlist_items > 0:
-            ytdl_final_opts["playlistend"] = max_playlist_items  # プレイリストの読み込み上限
+        ytdl_final_opts = _build_stream_opts(max_playlist_items)
 
     extracted_info: Optional[dict] = None
-
-    def _run_yt_dlp_extraction():
-        nonlocal extracted_info  # クロージャ内の変数を更新するため
-        try:
-            with yt_dlp.YoutubeDL(ytdl_final_opts) as ytdl:
-                # extract_info を実行
-                info_result = ytdl.extract_info(query, download=perform_download_for_nico)
-
-                if perform_download_for_nico and info_result:  # ニコニコ動画ダウンロード後処理
-                    if info_result.get("entries"):  # プレイリストの場合
-                        for entry in info_result["entries"]:
-                            if entry: _inject_local_path_nico(entry, ytdl)
-                    else:  # 単一動画の場合
-                        _inject_local_path_nico(info_result, ytdl)
-
-                    # ニコニコ動画のクッキー保存 (ログイン成功時など)
-                    try:
-                        ytdl.cookiejar.save(str(NICO_COOKIE_PATH), ignore_discard=True, ignore_expires=True)
-                    except Exception as e_cookie:
-                        print(f"[ytdlp_wrapper Warning] ニコニコ動画のクッキー保存に失敗: {e_cookie}")
-
-                extracted_info = info_result  # 抽出結果を保存
-        except ExtractorError as e_ext:  # yt-dlpが処理できないURLや検索結果なしなど
-            print(f"[ytdlp_wrapper Info] 情報抽出失敗 (ExtractorError): {e_ext} (Query: {query})")
-            # extracted_info は None のまま
-        except Exception as e_gen:  # その他の予期せぬyt-dlpエラー
-            print(f"[ytdlp_wrapper Error] yt-dlp実行中に予期せぬエラー: {e_gen} (Query: {query})", exc_info=True)
-            # extracted_info は None のまま
-
-    await loop.run_in_executor(None, _run_yt_dlp_extraction)
+    profile = "nico" if is_nico_query else "stream"
+    try:
+        # extract_info を実行 (ニコニコ動画はログイン成功時などのクッキーも保存)
+        extracted_info = await _extract_info(
+            profile,
+            ytdl_final_opts,
+            query,
+            cookie_path=str(NICO_COOKIE_PATH) if is_nico_query else None,
+            guild_id=guild_id,
+            priority=priority,
+        )
+    except ExtractorError as e_ext:  # yt-dlpが処理できないURLや検索結果なしなど
+        print(f"[ytdlp_wrapper Info] 情報抽出失敗 (ExtractorError): {e_ext} (Query: {query})")
+        # extracted_info は None のまま
+    except Exception as e_gen:  # その他の予期せぬyt-dlpエラー
+        print(f"[ytdlp_wrapper Error] yt-dlp実行中に予期せぬエラー: {e_gen} (Query: {query})")
+        # extracted_info は None のまま
 
     if not extracted_info:  # 情報抽出に失敗した場合
         return None
 
+    if use_metadata_cache:
+        loop.run_in_executor(None, _store_metadata, query, extracted_info)
+
     # 結果をTrackオブジェクトに変換
     tracks: List[Track] = []
     if "entries" in extracted_info and extracted_info["entries"]:  # プレイリストの場合
         valid_entries = [entry for entry in extracted_info["entries"] if entry]  # Noneエントリを除外
         for entry_data in valid_entries:
-            entry_data["original_query"] = query  # 元のクエリ情報を付加
-            tracks.append(_entry_to_track(entry_data, is_downloaded_nico=perform_download_for_nico))
+            tracks.append(_entry_to_track(entry_data, original_query=query))
+        if nico_download_opts is not None:
+            await _queue_nico_downloads(tracks, nico_download_opts)
 
         if shuffle_playlist and tracks:
             random.shuffle(tracks)
         return tracks if tracks else None  # 空のプレイリストならNone
     elif extracted_info:  # 単一の動画/曲の場合
-        extracted_info["original_query"] = query
-        single_track = _entry_to_track(extracted_info, is_downloaded_nico=perform_download_for_nico)
+        single_track = _entry_to_track(extracted_info, original_query=query)
+        if nico_download_opts is not None:
+            await _queue_nico_downloads([single_track], nico_download_opts)
         return single_track
 
-    return None  # 何も見つからなかった場合
\ No newline at end of file
+    return None  # 何も見つからなかった場合
+
+
+async def search(query: str, limit: int = 5, *, guild_id: Optional[int] = None) -> List[Tuple[str, str]]:
+    """検索語から (タイトル, ページURL) の候補を返す。個々の動画の情報は取得しないので軽い"""
+    opts = _build_stream_opts(limit)
+    try:
+        info = await _extract_info("stream", opts, f"ytsearch{limit}:{query}", guild_id=guild_id,
+                                   priority=Priority.BACKGROUND)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] 候補の検索に失敗: {e} (Query: {query})")
+        return []
+    results = []
+    for entry in (info or {}).get("entries") or []:
+        if not entry or not entry.get("title"):
+            continue
+        url = entry.get("webpage_url") or entry.get("url")
+        if url and "://" not in url and entry.get("id"):
+            url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if url:
+            results.append((entry["title"], url))
+    return results
+
+
+def recent_titles(limit: int = 5000) -> List[Tuple[str, str]]:
+    """メタデータキャッシュに残っている曲の (タイトル, URL)。ブロッキングなのでexecutorから呼ぶ"""
+    return METADATA_CACHE.recent_titles(limit) if METADATA_CACHE is not None else []
+
+
+async def _queue_nico_downloads(tracks: List[Track], opts: dict):
+    """ニコニコ動画の曲をダウンロード待ちの状態にして、裏でダウンロードを始める"""
+    for track in tracks:
+        track.stream_url, track.stream_expires_at, track.acodec = None, None, None
+        if not await use_cached_audio(track):
+            _start_nico_download(track, opts, str(NICO_COOKIE_PATH))
+
+
+# --- プレイリストの逐次読み込み ---
+_STREAM_END = object()
+# プレイリスト全体を読み終えるまでスレッドを占有するので、抽出用のプール・スケジューラーとは別のプールで行う
+# (1ギルドで同時に読み込むプレイリストは1つまで)
+PLAYLIST_STREAM_CONCURRENCY = 2
+_playlist_executor: Optional[ThreadPoolExecutor] = None
+
+
+def is_playlist_query(query: str) -> bool:
+    """逐次読み込みの対象になるプレイリストURLか判定する"""
+    if "://" not in query or _is_nico(query):
+        return False
+    return any(marker in query for marker in ("list=", "/playlist", "/sets/", "/album/"))
+
+
+def _iterate_playlist_entries(ytdl: yt_dlp.YoutubeDL, query: str, loop: asyncio.AbstractEventLoop,
+                              queue: asyncio.Queue, cancel_event: threading.Event, max_items: Optional[int]):
+    """プレイリストのエントリを取得できた順にイベントループ側のキューへ送る (ワーカースレッドで実行)"""
+    def push(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:  # ループが既に閉じている
+            cancel_event.set()
+
+    try:
+        # process=False ならエントリはページ単位で遅延取得されるジェネレーターのまま返る
+        info = ytdl.extract_info(query, download=False, process=False)
+        if not info:
+            return
+        entries = info.get("entries")
+        if entries is None:
+            push(info)
+            return
+        count = 0
+        for entry in entries:
+            if cancel_event.is_set():
+                return
+            if not entry:
+                continue
+            push(dict(entry))
+            count += 1
+            if max_items and count >= max_items:
+                return
+    except Exception as e:
+        push(e)
+    finally:
+        push(_STREAM_END)
+
+
+def _stream_playlist_sync(opts: dict, **kwargs):
+    with yt_dlp.YoutubeDL(opts) as ytdl:
+        _iterate_playlist_entries(ytdl, **kwargs)
+
+
+async def extract_stream(query: str, *, max_items: Optional[int] = None) -> AsyncIterator[Track]:
+    """
+    プレイリストを取得しながら1曲ずつ Track を返す非同期ジェネレーター。
+    途中で閉じられる (呼び出し側のタスクがキャンセルされる) と読み込みも中断する。
+    """
+    if METADATA_CACHE is not None:
+        cached = await _get_cached_metadata(query)
+        if cached is not None and cached[1]:
+            for track in _tracks_from_cache(cached[0][:max_items] if max_items else cached[0], query):
+                yield track
+            return
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    cancel_event = threading.Event()
+    opts = _build_stream_opts(None)
+    global _playlist_executor
+    if _playlist_executor is None:
+        _playlist_executor = ThreadPoolExecutor(max_workers=PLAYLIST_STREAM_CONCURRENCY,
+                                                thread_name_prefix="playlist")
+    # エントリを取り出す間ずっと1スレッドを占有する
+    # (ジェネレーターはプロセスを跨げないため、この処理は常にスレッドで行う)
+    worker = loop.run_in_executor(_playlist_executor, functools.partial(
+        _stream_playlist_sync, opts, query=query, loop=loop, queue=queue,
+        cancel_event=cancel_event, max_items=max_items))
+    records: List[dict] = []
+    completed = False
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                completed = True
+                break
+            if isinstance(item, Exception):
+                print(f"[ytdlp_wrapper Error] プレイリストの逐次取得中にエラー: {item} (Query: {query})")
+                break
+            records.append(_entry_to_cache_record(item))
+            yield _entry_to_track(item, original_query=query)
+    finally:
+        cancel_event.set()
+        worker.cancel()  # まだ開始前なら取り消す (実行中ならcancel_eventで止まる)
+        worker.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if completed and records and METADATA_CACHE is not None:
+            loop.run_in_executor(None, _put_playlist_records, query, records)
+
+
+def _put_playlist_records(query: str, records: List[dict]):
+    if METADATA_CACHE is None:
+        return
+    try:
+        METADATA_CACHE.put(query, records, is_playlist=True)
+    except Exception as e:
+        print(f"[ytdlp_wrapper Warning] メタデータキャッシュの保存に失敗: {e} (Query: {query})")
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+from ARONA.music.extraction_scheduler import ExtractionScheduler, Priority
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 5))
+
+
+def recorder(order, name, gate=None, result=None):
+    async def factory():
+        order.append(name)
+        if gate is not None:
+            await gate.wait()
+        return name if result is None else result
+    return factory
+
+
+async def fill_then_release(scheduler, submit):
+    """1つしかない枠を埋めてから submit で積み、枠を空けて実行順を返す"""
+    order = []
+    gate = asyncio.Event()
+    blocker = asyncio.create_task(scheduler.run(recorder(order, "blocker", gate)))
+    await asyncio.sleep(0)
+    tasks = submit(order)
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(blocker, *tasks)
+    return order[1:]
+
+
+def test_higher_priority_runs_first():
+    async def scenario():
+        scheduler = ExtractionScheduler(max_concurrency=1, reserved_for_play=0)
+
+        def submit(order):
+            return [
+                asyncio.create_task(scheduler.run(recorder(order, p.name), priority=p))
+                for p in (Priority.BACKGROUND, Priority.PREFETCH, Priority.BACKFILL, Priority.PLAY)
+            ]
+        return await fill_then_release(scheduler, submit)
+
+    assert run(scenario()) == ["PLAY", "BACKFILL", "PREFETCH", "BACKGROUND"]
+
+
+def test_guilds_take_turns_within_a_priority():
+    async def scenario():
+        scheduler = ExtractionScheduler(max_concurrency=1, reserved_for_play=0)
+
+        def submit(order):
+            tasks = [
+                asyncio.create_task(scheduler.run(recorder(order, f"a{i}"), guild_id=1, priority=Priority.BACKFILL))
+                for i in range(4)
+            ]
+            tasks += [
+                asyncio.create_task(scheduler.run(recorder(order, f"b{i}"), guild_id=2, priority=Priority.BACKFILL))
+                for i in range(2)
+            ]
+            return tasks
+        return await fill_then_release(scheduler, submit)
+
+    assert run(scenario()) == ["a0", "b0", "a1", "b1", "a2", "a3"]
+
+
+def test_same_key_runs_once_and_is_promoted():
+    async def scenario():
+        scheduler = ExtractionScheduler(max_concurrency=1, reserved_for_play=0)
+
+        def submit(order):
+            return [
+                asyncio.create_task(scheduler.run(recorder(order, "other"), priority=Priority.PREFETCH)),
+                asyncio.create_task(scheduler.run(recorder(order, "shared"), key="x", priority=Priority.BACKGROUND)),
+                asyncio.create_task(scheduler.run(recorder(order, "dup"), key="x", priority=Priority.PLAY)),
+            ]
+        order = await fill_then_release(scheduler, submit)
+        return order, scheduler.stats()
+
+    order, stats = run(scenario())
+    assert order == ["shared", "other"]
+    assert stats["deduplicated"] == 1
+    assert stats["promoted"] == 1
+
+
+def test_cancelled_waiting_job_is_never_run():
+    async def scenario():
+        scheduler = ExtractionScheduler(max_concurrency=1, reserved_for_play=0)
+        order = []
+        gate = asyncio.Event()
+        blocker = asyncio.create_task(scheduler.run(recorder(order, "blocker", gate)))
+        await asyncio.sleep(0)
+        dropped = asyncio.create_task(scheduler.run(recorder(order, "dropped"), key="y"))
+        kept = asyncio.create_task(scheduler.run(recorder(order, "kept")))
+        await asyncio.sleep(0)
+        dropped.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(blocker, kept)
+        assert dropped.cancelled()
+        return order, scheduler
+
+    order, scheduler = run(scenario())
+    assert order == ["blocker", "kept"]
+    assert scheduler._jobs == {}
+
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        scheduler = ExtractionScheduler(max_concurrency=2)
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise ValueError("boom")
+
+        return await asyncio.gather(
+            scheduler.run(failing, key="z"), scheduler.run(failing, key="z"), return_exceptions=True
+        )
+
+    results = run(scenario())
+    assert [type(r) for r in results] == [ValueError, ValueError]
+
+
+def test_play_is_not_stuck_behind_background_work():
+    # 入力補完やプレイリストの読み込みで枠が埋まっていても、曲の開始は待たされない
+    async def scenario():
+        scheduler = ExtractionScheduler(max_concurrency=4, reserved_for_play=1)
+
+        async def slow():
+            await asyncio.sleep(0.2)
+
+        background = [
+            asyncio.create_task(scheduler.run(slow, guild_id=i % 3, priority=Priority.BACKGROUND))
+            for i in range(30)
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.active == scheduler.non_play_limit == 3
+
+        started = time.perf_counter()
+        await scheduler.run(lambda: asyncio.sleep(0))
+        play_latency = time.perf_counter() - started
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        return play_latency
+
+    assert run(scenario()) < 0.1
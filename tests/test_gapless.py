@@ -0,0 +1,154 @@
+import threading
+import time
+import wave
+from array import array
+
+import pytest
+
+discord = pytest.importorskip("discord")
+
+from ARONA.music.gapless import GaplessSource  # noqa: E402
+
+FRAME_BYTES = 3840  # 48kHz / 16bit / 2ch の20ms
+FRAME_SECONDS = GaplessSource.FRAME_SECONDS
+
+
+def write_wav(path, seconds: float, level: int):
+    samples = array("h", [level]) * int(48000 * seconds * 2)
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(48000)
+        f.writeframes(samples.tobytes())
+    return path
+
+
+class WavSource(discord.AudioSource):
+    """ffmpegの代わりにWAVファイルのPCMをそのまま返すソース"""
+
+    def __init__(self, path, start_seconds: float = 0.0):
+        self._file = wave.open(str(path), "rb")
+        self._file.setpos(int(48000 * start_seconds))
+
+    def read(self) -> bytes:
+        data = self._file.readframes(FRAME_BYTES // 4)
+        return data if len(data) == FRAME_BYTES else b""
+
+    def cleanup(self):
+        self._file.close()
+
+
+def levels(frame: bytes):
+    return set(array("h", frame))
+
+
+def play_all(chain: GaplessSource):
+    frames = []
+    while True:
+        data = chain.read()
+        if not data:
+            return frames
+        frames.append(data)
+
+
+@pytest.fixture
+def tracks(tmp_path):
+    return [write_wav(tmp_path / f"{i}.wav", 2.0, level) for i, level in enumerate((1000, 2000, 3000))]
+
+
+def test_switches_to_next_track_without_gap(tracks):
+    transitions = []
+    chain = GaplessSource(WavSource(tracks[0]), lambda token, gap, offset: transitions.append((token, offset)))
+    chain.set_next(WavSource(tracks[1]), "b")
+
+    frames = play_all(chain)
+
+    assert len(frames) == 200  # 2曲分のフレームが途切れずに続く
+    assert levels(frames[99]) == {1000} and levels(frames[100]) == {2000}
+    assert transitions == [("b", 0.0)]
+
+
+def test_crossfade_starts_at_same_position_for_every_track(tracks):
+    crossfade_seconds, duration = 0.5, 2.0
+    crossfade_frames = int(crossfade_seconds / FRAME_SECONDS)
+    crossfade_at = int((duration - crossfade_seconds) / FRAME_SECONDS)
+    chain = None
+    remaining = [WavSource(tracks[2])]
+    transitions = []
+
+    def on_transition(token, gap, offset):
+        transitions.append((token, offset))
+        # MusicCog と同じく、切り替わったら次の曲を同じ位置 (曲の先頭から数えたフレーム) で登録する
+        if remaining:
+            chain.set_next(remaining.pop(), "c", crossfade_at, crossfade_frames)
+
+    chain = GaplessSource(WavSource(tracks[0]), on_transition)
+    chain.set_next(WavSource(tracks[1]), "b", crossfade_at, crossfade_frames)
+
+    frames = play_all(chain)
+
+    # 3曲 × 100フレームから、重なった2回分を引いた長さ
+    assert len(frames) == 300 - 2 * crossfade_frames
+    assert transitions == [("b", crossfade_seconds), ("c", crossfade_seconds)]
+    # どちらのクロスフェードも出ていく曲の残り0.5秒から始まる
+    assert levels(frames[crossfade_at - 1]) == {1000}
+    assert len(levels(frames[crossfade_at])) == 1 and levels(frames[crossfade_at]) != {1000}
+    second_fade = 2 * crossfade_at  # Bは再生済みの crossfade_frames を除いた残りから数える
+    assert levels(frames[second_fade - 1]) == {2000}
+    assert levels(frames[second_fade]) != {2000}
+    assert levels(frames[-1]) == {3000}
+
+
+def test_crossfade_position_after_seek(tracks):
+    crossfade_frames = 25
+    crossfade_at = int((2.0 - 0.5) / FRAME_SECONDS)
+    chain = GaplessSource(WavSource(tracks[0], start_seconds=1.0), lambda *args: None, start_seconds=1.0)
+    chain.set_next(WavSource(tracks[1]), "b", crossfade_at, crossfade_frames)
+
+    frames = play_all(chain)
+
+    # 1秒の位置から始めても、重ねるのは曲の残り0.5秒から
+    assert len(frames) == 50 + 100 - crossfade_frames
+    assert levels(frames[24]) == {1000} and levels(frames[25]) != {1000}
+
+
+def test_replace_current_is_applied_on_next_read(tracks):
+    chain = GaplessSource(WavSource(tracks[0]), lambda *args: None)
+    chain.read()
+    chain.replace_current(WavSource(tracks[1], start_seconds=1.5), start_seconds=1.5)
+
+    frames = play_all(chain)
+
+    assert len(frames) == 25
+    assert levels(frames[0]) == {2000}
+
+
+class StalledSource(discord.AudioSource):
+    """ネットワークが詰まったffmpegのように、解放されるまで read() が返らないソース"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def read(self) -> bytes:
+        self.release.wait(5)
+        return b"\0" * FRAME_BYTES
+
+
+def test_event_loop_side_calls_do_not_wait_for_stalled_read(tracks):
+    stalled = StalledSource()
+    chain = GaplessSource(stalled, lambda *args: None)
+    reader = threading.Thread(target=chain.read)
+    reader.start()
+    time.sleep(0.05)
+
+    started = time.perf_counter()
+    chain.set_next(WavSource(tracks[1]), "b")
+    chain.clear_next()
+    chain.replace_current(WavSource(tracks[2]))
+    elapsed = time.perf_counter() - started
+
+    stalled.release.set()
+    reader.join()
+    assert elapsed < 0.1
+    assert levels(chain.read()) == {3000}
+    assert not chain.has_next
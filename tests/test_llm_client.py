@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+
+openai = pytest.importorskip("openai")
+
+from ARONA.message.error.errors import CircuitOpenError, LLMTimeoutError  # noqa: E402
+from ARONA.message.llm_client import CircuitBreaker, ResilientLLMClient  # noqa: E402
+
+
+def test_breaker_opens_after_threshold_and_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open' and not breaker.allow()
+
+    breaker.opened_at = time.monotonic() - 61
+    assert breaker.state == 'half_open'
+    assert breaker.allow()
+    assert not breaker.allow()  # 試行中は2件目を通さない
+
+    breaker.record_success()
+    assert breaker.state == 'closed' and breaker.allow()
+
+
+def test_failed_trial_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=60)
+    breaker.opened_at = time.monotonic() - 61
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+
+class FakeStream:
+    def __init__(self, chunks, delay=0.0):
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+def make_client(create, timeout=1.0):
+    client = ResilientLLMClient(api_key='test', timeout=timeout, hedge_delay=timeout, failure_threshold=1,
+                                reset_seconds=0)
+    client.primary.chat.completions.create = create
+    return client
+
+
+def half_open(client):
+    client.breaker.consecutive_failures = 1
+    client.breaker.opened_at = time.monotonic() - 1
+
+
+def test_cancelled_trial_is_released():
+    async def main():
+        async def slow(**kwargs):
+            await asyncio.sleep(10)
+
+        client = make_client(slow)
+        half_open(client)
+        task = asyncio.create_task(client.create(model='m', messages=[]))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert client.breaker.allow()  # 次の1件を試行として通せる
+
+    asyncio.run(main())
+
+
+def test_abandoned_stream_releases_trial_and_closes_upstream():
+    async def main():
+        stream = FakeStream(['a', 'b', 'c'])
+
+        async def create(**kwargs):
+            return stream
+
+        client = make_client(create)
+        half_open(client)
+        relay = await client.create(model='m', messages=[], stream=True)
+        async for _ in relay:
+            break
+        await relay.aclose()
+        assert stream.closed
+        assert client.breaker.allow()
+
+    asyncio.run(main())
+
+
+def test_stream_timeout_closes_upstream_and_counts_timeout():
+    async def main():
+        stream = FakeStream(['a'], delay=0.2)
+
+        async def create(**kwargs):
+            return stream
+
+        client = make_client(create, timeout=0.05)
+        relay = await client.create(model='m', messages=[], stream=True)
+        with pytest.raises(LLMTimeoutError):
+            async for _ in relay:
+                pass
+        assert stream.closed
+        assert client.counters['timeouts'] == 1
+
+    asyncio.run(main())
+
+
+def test_completed_stream_records_success():
+    async def main():
+        stream = FakeStream(['a', 'b'])
+
+        async def create(**kwargs):
+            return stream
+
+        client = make_client(create)
+        relay = await client.create(model='m', messages=[], stream=True)
+        assert [chunk async for chunk in relay] == ['a', 'b']
+        assert client.counters['successes'] == 1 and not stream.closed
+
+    asyncio.run(main())
+
+
+def test_sdk_timeout_is_counted_as_timeout():
+    async def main():
+        async def create(**kwargs):
+            raise openai.APITimeoutError(request=None)
+
+        client = make_client(create)
+        with pytest.raises(LLMTimeoutError):
+            await client.create(model='m', messages=[])
+        assert client.counters['timeouts'] == 1
+        with pytest.raises(CircuitOpenError):
+            client.breaker.reset_seconds = 60
+            await client.create(model='m', messages=[])
+
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+import asyncio
+import importlib
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("yt_dlp")
+
+PAGE_SECONDS = 0.05  # 1エントリごとのページ取得にかかる時間の代わり
+
+
+@pytest.fixture
+def wrapper(tmp_path, monkeypatch):
+    # 読み込み時に ./cache と Cookie ファイルを作るので、一時フォルダで読み込む
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module("ARONA.music.ytdlp_wrapper")
+    monkeypatch.setattr(module, "METADATA_CACHE", None)
+    monkeypatch.setattr(module, "_playlist_executor", None)
+    return module
+
+
+class FakeYoutubeDL:
+    """extract_info(process=False) がエントリを遅延取得するジェネレーターを返す yt-dlp の代わり"""
+    produced = 0
+    finished = threading.Event()
+
+    def __init__(self, opts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        FakeYoutubeDL.finished.set()
+
+    def extract_info(self, query, download=False, process=True):
+        assert not process
+
+        def entries():
+            for i in range(20):
+                time.sleep(PAGE_SECONDS)
+                FakeYoutubeDL.produced += 1
+                yield {"id": str(i), "title": f"track {i}", "webpage_url": f"https://example.com/{i}", "duration": 60}
+
+        return {"_type": "playlist", "entries": entries()}
+
+
+@pytest.fixture
+def fake_ytdl(wrapper, monkeypatch):
+    FakeYoutubeDL.produced = 0
+    FakeYoutubeDL.finished = threading.Event()
+    monkeypatch.setattr(wrapper.yt_dlp, "YoutubeDL", FakeYoutubeDL)
+    return FakeYoutubeDL
+
+
+def test_first_track_arrives_before_playlist_is_read(wrapper, fake_ytdl):
+    async def scenario():
+        started = time.perf_counter()
+        first_at = None
+        titles = []
+        async for track in wrapper.extract_stream("https://example.com/playlist?list=x"):
+            if first_at is None:
+                first_at = time.perf_counter() - started
+            titles.append(track.title)
+        return first_at, time.perf_counter() - started, titles
+
+    first_at, total, titles = asyncio.run(scenario())
+    assert titles == [f"track {i}" for i in range(20)]
+    assert first_at < 5 * PAGE_SECONDS
+    assert first_at < total / 4
+
+
+def test_max_items_and_early_close_stop_the_worker(wrapper, fake_ytdl):
+    async def take(count, max_items=None):
+        stream = wrapper.extract_stream("https://example.com/playlist?list=y", max_items=max_items)
+        tracks = []
+        async for track in stream:
+            tracks.append(track)
+            if len(tracks) == count:
+                break
+        await stream.aclose()
+        return tracks
+
+    assert len(asyncio.run(take(20, max_items=3))) == 3
+    assert fake_ytdl.finished.wait(1)
+
+    fake_ytdl.produced = 0
+    fake_ytdl.finished.clear()
+    assert len(asyncio.run(take(2))) == 2
+    # 呼び出し側が止めたら、残りのページは取りに行かない
+    assert fake_ytdl.finished.wait(1)
+    assert fake_ytdl.produced <= 4
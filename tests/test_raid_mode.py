@@ -0,0 +1,85 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("discord")
+
+from ARONA.moderation.raid_mode import JoinRateTracker  # noqa: E402
+
+
+def make_member(member_id, guild_id=1, bot=False):
+    return SimpleNamespace(id=member_id, bot=bot, guild=SimpleNamespace(id=guild_id))
+
+
+def test_raid_starts_at_threshold_and_ends_after_cooldown():
+    tracker = JoinRateTracker(threshold=3, window_seconds=10, cooldown_seconds=30)
+    assert not tracker.record_join(1, 1, now=100)
+    assert not tracker.record_join(1, 2, now=101)
+    assert tracker.record_join(1, 3, now=102)
+    assert tracker.is_raid(1, now=131)
+    assert not tracker.is_raid(1, now=132)
+
+
+def test_joins_outside_window_do_not_count():
+    tracker = JoinRateTracker(threshold=3, window_seconds=10, cooldown_seconds=30)
+    tracker.record_join(1, 1, now=100)
+    tracker.record_join(1, 2, now=105)
+    assert not tracker.record_join(1, 3, now=111)
+    assert tracker.status(1, now=111)['recent_joins'] == 2
+
+
+def test_same_join_recorded_by_two_cogs_counts_once():
+    tracker = JoinRateTracker(threshold=3, window_seconds=10, cooldown_seconds=30)
+    for member_id in (1, 2):
+        tracker.record_join(1, member_id, now=100)
+        tracker.record_join(1, member_id, now=100)
+    assert not tracker.is_raid(1, now=100)
+
+
+def test_raid_start_is_claimed_once_whichever_cog_records_first():
+    tracker = JoinRateTracker(threshold=3, window_seconds=10, cooldown_seconds=30)
+    claims = []
+    for member_id in range(6):
+        now = 100 + member_id * 0.1
+        tracker.record_join(1, member_id, now=now)  # ようこそメッセージ側が先に記録
+        tracker.record_join(1, member_id, now=now)  # Anti-nuke 側
+        claims.append(tracker.claim_raid_start(1, now=now))
+    assert claims == [False, False, True, False, False, False]
+
+    # クールダウン後の新しいレイドはもう一度通知する
+    for member_id in range(10, 13):
+        tracker.record_join(1, member_id, now=200 + member_id * 0.1)
+    assert tracker.claim_raid_start(1, now=201.3)
+
+
+def test_bots_are_not_counted():
+    tracker = JoinRateTracker(threshold=2, window_seconds=10, cooldown_seconds=30)
+    assert not tracker.record_member_join(make_member(1, bot=True))
+    assert not tracker.record_member_join(make_member(2, bot=True))
+    assert not tracker.record_member_join(make_member(3))
+    assert tracker.record_member_join(make_member(4))
+
+
+def test_idle_guilds_are_pruned():
+    tracker = JoinRateTracker(threshold=2, window_seconds=10, cooldown_seconds=100)
+    base = time.monotonic()
+    tracker.record_join(1, 1, now=base + 1)
+    tracker.record_join(2, 1, now=base + 2)
+    tracker.record_join(2, 2, now=base + 2)  # ギルド2はレイドモード
+    tracker.record_join(3, 1, now=base + tracker.PRUNE_INTERVAL + 5)
+    assert set(tracker._windows) == {2, 3}
+    tracker.record_join(4, 1, now=base + 2 * tracker.PRUNE_INTERVAL + 10)
+    assert set(tracker._windows) == {4}
+
+
+def test_raid_burst_is_tracked_in_constant_time_per_join():
+    tracker = JoinRateTracker(threshold=10, window_seconds=10, cooldown_seconds=120)
+    joins = 100_000
+    started = time.perf_counter()
+    for i in range(joins):
+        tracker.record_join(i % 50, i, now=1000 + i * 0.001)
+    elapsed = time.perf_counter() - started
+    assert all(tracker.is_raid(guild_id, now=1100) for guild_id in range(50))
+    # 1件あたり数マイクロ秒 (ウィンドウ内の参加数に比例しない)
+    assert elapsed / joins < 50e-6
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("discord")
+
+from ARONA.moderation.reaction_role_cog import ReactionRoleStore, load_reaction_roles  # noqa: E402
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return tmp_path / 'rr.json', tmp_path / 'rr.journal', tmp_path / 'rr_channels.json'
+
+
+def make_store(paths, compact_threshold=3):
+    data_file, journal_file, channel_file = paths
+    return ReactionRoleStore(data_file, journal_file, channel_file, compact_threshold=compact_threshold)
+
+
+def fill(store, count=7):
+    async def main():
+        for i in range(count):
+            await store.set(f'1-{i}', '👍', 100 + i, channel_id=10)
+        await store.delete('1-0', '👍')
+        await store.aclose()
+
+    asyncio.run(main())
+    return {k: dict(v) for k, v in store.mappings.items()}
+
+
+def test_journal_is_replayed_after_snapshot(paths):
+    expected = fill(make_store(paths))
+    store = make_store(paths)
+    assert store.load() == expected
+    assert store.channels['1-6'] == 10
+
+
+def test_torn_last_journal_line_is_ignored(paths):
+    expected = fill(make_store(paths, compact_threshold=100))
+    with paths[1].open('a', encoding='utf-8') as f:
+        f.write('{"op":"set","key":"1-9"')
+    assert make_store(paths).load() == expected
+
+
+def test_corrupt_snapshot_falls_back_to_backup(paths):
+    expected = fill(make_store(paths))
+    paths[0].write_text('{broken', encoding='utf-8')
+    assert make_store(paths).load() == expected
+    assert paths[0].with_name(paths[0].name + '.corrupt').exists()
+
+
+def test_snapshot_missing_mid_compaction_falls_back_to_backup(paths):
+    expected = fill(make_store(paths))
+    paths[0].unlink()
+    assert make_store(paths).load() == expected
+
+
+def test_reports_loss_when_both_snapshots_are_corrupt(paths, capsys):
+    fill(make_store(paths))
+    paths[0].write_text('{broken', encoding='utf-8')
+    paths[0].with_name(paths[0].name + '.bak').write_text('{broken', encoding='utf-8')
+
+    recovered = make_store(paths).load()
+
+    journal_keys = set()
+    for journal in (paths[1].with_name(paths[1].name + '.bak'), paths[1]):
+        for line in journal.read_text(encoding='utf-8').splitlines():
+            op = json.loads(line)
+            if op['op'] == 'set':
+                journal_keys.add(op['key'])
+    assert set(recovered) <= journal_keys
+    assert '❌' in capsys.readouterr().out
+
+
+def test_load_without_files_is_empty(paths):
+    assert load_reaction_roles(paths[0], paths[1]) == {}
@@ -0,0 +1,60 @@
+import time
+
+from ARONA.music.search_suggest import SearchResultCache, SuggestionIndex, normalize_prefix
+
+
+def test_matches_any_word_prefix_case_insensitively():
+    index = SuggestionIndex()
+    index.add("Never Gonna Give You Up", "https://e.com/1")
+    assert index.suggest("gonna") == [("Never Gonna Give You Up", "https://e.com/1")]
+    assert index.suggest("NEVER  gon") == [("Never Gonna Give You Up", "https://e.com/1")]
+    assert index.suggest("up down") == []
+
+
+def test_other_guilds_history_is_not_suggested_by_default():
+    index = SuggestionIndex()
+    index.add("Song A", "https://e.com/a", guild_id=1)
+    index.add("Song B", "https://e.com/b", guild_id=2)
+    assert index.suggest("song", guild_id=1) == [("Song A", "https://e.com/a")]
+    assert index.suggest("", guild_id=2) == [("Song B", "https://e.com/b")]
+
+
+def test_shared_history_ranks_own_guild_first():
+    index = SuggestionIndex(share_across_guilds=True)
+    for _ in range(3):
+        index.add("Song B", "https://e.com/b", guild_id=2)
+    index.add("Song A", "https://e.com/a", guild_id=1)
+    index.load([("Song C", "https://e.com/c")])
+    assert [url for _, url in index.suggest("song", guild_id=1)] == [
+        "https://e.com/a", "https://e.com/b", "https://e.com/c"]
+
+
+def test_retitled_entry_is_reindexed_and_oldest_is_evicted():
+    index = SuggestionIndex(max_entries=2)
+    index.add("Old Title", "https://e.com/1")
+    index.add("New Title", "https://e.com/1")
+    assert index.suggest("old") == []
+    index.add("Second", "https://e.com/2")
+    index.add("Third", "https://e.com/3")
+    assert len(index) == 2
+    assert index.suggest("new") == []
+
+
+def test_lookup_stays_fast_on_full_index():
+    index = SuggestionIndex(max_entries=5000)
+    for i in range(5000):
+        index.add(f"Artist {i % 100} - Track number {i}", f"https://e.com/{i}", guild_id=i % 10)
+    started = time.perf_counter()
+    for _ in range(200):
+        index.suggest("artist 4", guild_id=3)
+    assert (time.perf_counter() - started) / 200 < 0.005
+
+
+def test_search_result_cache_expires_and_normalizes():
+    cache = SearchResultCache(ttl_seconds=60, max_entries=1)
+    cache.put("Lo-Fi  Beats", [("Lo-Fi Beats", "https://e.com/1")])
+    assert cache.get("lo-fi beats") == [("Lo-Fi Beats", "https://e.com/1")]
+    cache.put("other", [])
+    assert cache.get("lo-fi beats") is None
+    cache._results[normalize_prefix("other")] = (time.monotonic() - 61, [])
+    assert cache.get("other") is None
@@ -0,0 +1,113 @@
+import asyncio
+import importlib
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("yt_dlp")
+
+COALESCE_SECONDS = 0.05
+
+
+class FakeSource:
+    def __init__(self, before_options):
+        self.before_options = before_options
+        self.cleaned_up = False
+
+    def read(self):
+        return b"\0" * 3840
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class FakeVoiceClient:
+    def __init__(self, source):
+        self.source = source
+
+    def is_playing(self):
+        return True
+
+    def is_paused(self):
+        return False
+
+
+@pytest.fixture
+def music(tmp_path, monkeypatch):
+    # 読み込み時に ./cache を作るので、一時フォルダで読み込む
+    monkeypatch.chdir(tmp_path)
+    module = importlib.import_module("ARONA.music.music_cog")
+    bot = SimpleNamespace(config={"music": {
+        "session_persistence": False,
+        "gapless_enabled": False,
+        "audio_cache_enabled": False,
+        "seek_coalesce_seconds": COALESCE_SECONDS,
+    }})
+    cog = module.MusicCog(bot)
+    monkeypatch.setattr(cog, "_create_audio_source", lambda state, track, before: FakeSource(before))
+
+    async def no_restart(*args, **kwargs):
+        raise AssertionError("シークで再生処理をやり直してはいけない")
+    monkeypatch.setattr(cog, "_play_next_song", no_restart)
+
+    resolved = []
+
+    async def fake_ensure_stream(track, **kwargs):
+        resolved.append(kwargs.get("priority"))
+        track.stream_url = str(local_file)
+    monkeypatch.setattr(module, "ensure_stream", fake_ensure_stream)
+
+    local_file = tmp_path / "track.webm"
+    local_file.write_bytes(b"")
+    state = module.GuildState(bot, 1, cog.config)
+    state.current_track = module.Track(url="https://example.com/a", title="a", duration=300,
+                                       stream_url=str(local_file))
+    state.voice_client = FakeVoiceClient(FakeSource(""))
+    state.is_playing = True
+    cog.guild_states[1] = state
+    return SimpleNamespace(module=module, cog=cog, state=state, resolved=resolved)
+
+
+def test_rapid_seeks_swap_the_source_once_without_resolving(music):
+    async def scenario():
+        old_source = music.state.voice_client.source
+        for target in (30, 60, 90):
+            music.cog._request_seek(1, target)
+            await asyncio.sleep(COALESCE_SECONDS / 5)
+        await asyncio.wait_for(music.state.seek_task, 2)
+
+        source = music.state.voice_client.source
+        assert isinstance(source, music.module.TimedAudioSource)
+        assert source.original.before_options.startswith("-ss 90 ")
+        assert music.state.seek_position == 90
+        assert music.resolved == []
+
+        # プレイヤーが最初のフレームを読んだ時点で応答時間が記録される
+        source.read()
+        source.read()
+        assert len(music.cog.seek_latency_samples) == 1
+        await asyncio.sleep(1.1)
+        assert old_source.cleaned_up
+        return music.cog.seek_latency_samples[0]
+
+    latency = asyncio.run(scenario())
+    # まとめる待ち時間の分を除けば、ffmpegの再起動だけで済んでいる
+    assert latency < COALESCE_SECONDS * 2 + 0.1
+
+
+def test_seek_resolves_again_only_when_the_stream_would_expire(music):
+    track = music.state.current_track
+    track.stream_url = "https://example.com/stream"
+    track.stream_expires_at = time.time() + 3600
+    asyncio.run(music.cog._swap_source(1, 200))
+    assert music.resolved == []
+
+    track.stream_url = "https://example.com/stream"
+    track.stream_expires_at = time.time() + 100
+    asyncio.run(music.cog._swap_source(1, 10))
+    assert music.resolved == [music.module.Priority.PLAY]
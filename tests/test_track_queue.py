@@ -0,0 +1,78 @@
+import asyncio
+import random
+import time
+
+import pytest
+
+from ARONA.music.track_queue import TrackQueue
+
+
+def make_queue(count):
+    queue = TrackQueue()
+    queue.extend(range(count))
+    return queue
+
+
+def test_fifo_order_and_put_front():
+    queue = make_queue(3)
+    queue.put_front("next")
+    assert [queue.get_nowait() for _ in range(4)] == ["next", 0, 1, 2]
+    assert queue.empty()
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_nowait()
+
+
+def test_remove_and_move_keep_order():
+    queue = make_queue(5)
+    assert queue.remove(1) == 1
+    assert list(queue) == [0, 2, 3, 4]
+    assert queue.move(3, 0) == 4
+    assert list(queue) == [4, 0, 2, 3]
+    assert queue.move(0, 100) == 4  # 範囲外の移動先は末尾に丸める
+    assert list(queue) == [0, 2, 3, 4]
+    with pytest.raises(IndexError):
+        queue.remove(4)
+
+
+def test_peek_slice_and_shuffle():
+    queue = make_queue(10)
+    assert queue.peek(3) == [0, 1, 2]
+    assert queue.slice(8, 20) == [8, 9]
+    assert queue.slice(20, 30) == []
+    queue.shuffle(random.Random(1))
+    assert sorted(queue) == list(range(10))
+    assert len(queue) == 10
+
+
+def test_waiting_getter_survives_in_place_edits():
+    async def scenario():
+        queue = TrackQueue()
+        getter = asyncio.create_task(queue.get())
+        await asyncio.sleep(0)
+        queue.put_nowait("a")
+        queue.clear()  # 取り出される前に消されても待ち続ける
+        await asyncio.sleep(0)
+        assert not getter.done()
+        queue.extend(["b", "c"])
+        queue.move(1, 0)
+        return await asyncio.wait_for(getter, 1)
+
+    assert asyncio.run(scenario()) == "c"
+
+
+def test_head_and_tail_ops_do_not_scale_with_queue_length():
+    # 以前は asyncio.Queue._queue をリストに作り直していたので長いキューほど遅かった
+    def time_ops(size, rounds=2000):
+        queue = make_queue(size)
+        started = time.perf_counter()
+        for i in range(rounds):
+            queue.put_front(i)
+            queue.get_nowait()
+            queue.put_nowait(i)
+            queue.remove(-1)
+            queue.peek(10)
+        return time.perf_counter() - started
+
+    small = min(time_ops(10) for _ in range(3))
+    large = min(time_ops(100_000) for _ in range(3))
+    assert large < small * 10
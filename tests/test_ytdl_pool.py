@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("yt_dlp")
+
+from ARONA.music import ytdl_pool  # noqa: E402
+from ARONA.music.ytdl_pool import YoutubeDLPool  # noqa: E402
+
+CONSTRUCT_SECONDS = 0.1  # エクストラクタの読み込みにかかる時間の代わり
+
+
+class FakeYoutubeDL:
+    def __init__(self, opts):
+        time.sleep(CONSTRUCT_SECONDS)
+        self.opts = opts
+        self.in_use = threading.Lock()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(ytdl_pool.yt_dlp, "YoutubeDL", FakeYoutubeDL)
+    pool = YoutubeDLPool(max_workers=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_warm_instance_skips_construction(pool):
+    async def scenario():
+        await pool.warm("stream", {"quiet": True})
+        started = time.perf_counter()
+        ytdl = await pool.run("stream", {"quiet": True}, lambda y: y)
+        return time.perf_counter() - started, ytdl
+
+    latency, ytdl = asyncio.run(scenario())
+    assert latency < CONSTRUCT_SECONDS / 2
+    assert not ytdl.closed
+    stats = pool.stats()
+    assert (stats["instances_created"], stats["instances_reused"]) == (1, 1)
+
+
+def test_profiles_do_not_share_instances(pool):
+    async def scenario():
+        first = await pool.run("stream", {"quiet": True}, lambda y: y)
+        same = await pool.run("stream", {"quiet": True}, lambda y: y)
+        other = await pool.run("nico", {"quiet": True}, lambda y: y)
+        return first, same, other
+
+    first, same, other = asyncio.run(scenario())
+    assert first is same
+    assert other is not first
+
+
+def test_instance_is_never_used_by_two_threads(pool):
+    def use(ytdl):
+        assert ytdl.in_use.acquire(blocking=False), "同じインスタンスを2つのスレッドが同時に使っている"
+        try:
+            time.sleep(0.01)
+        finally:
+            ytdl.in_use.release()
+
+    async def scenario():
+        await asyncio.gather(*(pool.run("stream", {}, use) for _ in range(20)))
+
+    asyncio.run(scenario())
+    assert pool.stats()["instances_created"] <= pool.max_workers
+
+
+def test_instance_is_discarded_after_an_error(pool):
+    seen = []
+
+    def fail(ytdl):
+        seen.append(ytdl)
+        raise ValueError("extract failed")
+
+    async def scenario():
+        with pytest.raises(ValueError):
+            await pool.run("stream", {}, fail)
+        return await pool.run("stream", {}, lambda y: y)
+
+    fresh = asyncio.run(scenario())
+    assert seen[0].closed
+    assert fresh is not seen[0]
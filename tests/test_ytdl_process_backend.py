@@ -0,0 +1,59 @@
+import asyncio
+import importlib
+
+import pytest
+
+pytest.importorskip("yt_dlp")
+
+from ARONA.music import ytdl_process_backend  # noqa: E402
+from ARONA.music.ytdl_process_backend import ProcessExtractionBackend, unavailable_reason  # noqa: E402
+
+# ネットワークに出ずにワーカー内で yt-dlp の例外を起こすクエリ
+OFFLINE_OPTS = {"quiet": True, "no_warnings": True, "default_search": "error"}
+
+
+@pytest.fixture
+def backend():
+    if unavailable_reason() is not None:
+        pytest.skip(unavailable_reason())
+    backend = ProcessExtractionBackend(max_workers=1, max_tasks_per_child=2)
+    yield backend
+    backend.shutdown()
+
+
+def test_worker_errors_come_back_as_runtime_errors(backend):
+    async def scenario():
+        with pytest.raises(RuntimeError, match="DownloadError"):
+            await backend.extract_info("stream", OFFLINE_OPTS, "not a url")
+
+    asyncio.run(asyncio.wait_for(scenario(), 60))
+
+
+def test_crashed_pool_is_restarted_and_the_call_retried(backend):
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await backend.extract_info("stream", OFFLINE_OPTS, "warm up")
+        for process in list(backend._executor._processes.values()):
+            process.kill()
+            process.join()
+        with pytest.raises(RuntimeError, match="DownloadError"):
+            await backend.extract_info("stream", OFFLINE_OPTS, "after crash")
+
+    asyncio.run(asyncio.wait_for(scenario(), 60))
+    assert backend.crashes == 1
+
+
+def test_configure_falls_back_to_threads_when_unavailable(tmp_path, monkeypatch, capsys):
+    # 読み込み時に ./cache を作るので、一時フォルダで読み込む
+    monkeypatch.chdir(tmp_path)
+    wrapper = importlib.import_module("ARONA.music.ytdlp_wrapper")
+    monkeypatch.setattr(wrapper, "PROCESS_BACKEND", None)
+    monkeypatch.setattr(wrapper, "unavailable_reason", lambda: "Python 3.11 以降が必要です")
+    wrapper.configure({"extraction_backend": "process", "audio_cache_enabled": False})
+    assert wrapper.PROCESS_BACKEND is None
+    assert "thread で動作します" in capsys.readouterr().out
+
+
+def test_unavailable_below_minimum_python(monkeypatch):
+    monkeypatch.setattr(ytdl_process_backend.sys, "version_info", (3, 10, 12))
+    assert "3.11" in unavailable_reason()